@@ -5,6 +5,7 @@ import pjs.conf.conf
 import logging
 
 from pjs.db import DB, sqlite
+from pjs.migrations import migrate
 
 class PJSLauncher:
     """The one and only instance of the server. This controls all other
@@ -19,7 +20,11 @@ class PJSLauncher:
 
         self.hostname = 'localhost'
 
+        # True to acknowledge offline messages only once they're committed
+        self.durableOffline = False
+
         self._c2s, self._s2s = (None, None)
+        self.offlineWriter = None
 
     def run(self):
         """Creates one C2S and one S2S server and runs them.
@@ -33,25 +38,45 @@ class PJSLauncher:
         self._s2s = S2SServer(self.hostname, self.s2sport, self)
         self.servers.append(self._s2s)
 
-        from pjs.connection import LocalTriggerConnection
+        from pjs.async.trigger import Trigger
+        from pjs.async.core import set_wakeup
+        from pjs.handlers.base import poll
 
-        # see connection.LocalTriggerConnection.__doc__
-        self.triggerConn = LocalTriggerConnection(self.hostname, self.c2sport)
+        # see pjs.async.trigger.__doc__
+        self.trigger = Trigger()
+        # output queued from worker threads wakes up the loop
+        set_wakeup(self.trigger.pullTrigger)
 
-        def notifyFunc():
-            """Function that gets executed when a job in a threadpool
-            completes.
+        def makeNotifyFunc(server):
+            """Makes the function that gets executed when a job in server's
+            threadpool completes. It wakes up the loop, which then picks up
+            the completed jobs from the main thread.
             """
-            self.triggerConn.send(' ')
+            def drain():
+                poll(server.threadpool)
+            def notifyFunc():
+                self.trigger.pullTrigger(drain)
+            return notifyFunc
+
+        self._c2s.createThreadpool(5, makeNotifyFunc(self._c2s))
+        self._s2s.createThreadpool(5, makeNotifyFunc(self._s2s))
 
-        self._c2s.createThreadpool(5, notifyFunc)
-        self._s2s.createThreadpool(5, notifyFunc)
+        # see pjs.offline.__doc__
+        from pjs.offline import OfflineWriter
+        self.offlineWriter = OfflineWriter(durable=self.durableOffline)
+        self.offlineWriter.start()
 
     def stop(self):
         """Shuts down the servers"""
-        self.triggerConn.handle_close()
-        self._c2s.handle_close(True)
-        self._s2s.handle_close(True)
+        from pjs.async.core import set_wakeup
+        set_wakeup(None)
+        try:
+            self.trigger.close()
+            self._c2s.handle_close(True)
+            self._s2s.handle_close(True)
+        finally:
+            # queued offline messages are written out even if closing failed
+            self.offlineWriter.stop()
 
     def getC2SServer(self):
         """Returns the C2S server"""
@@ -62,33 +87,11 @@ class PJSLauncher:
 
 def populateDB():
     """Creates a sample database"""
+    migrate()
+
     con = DB()
     c = con.cursor()
     try:
-        c.execute("CREATE TABLE IF NOT EXISTS jids (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,\
-                                        jid TEXT NOT NULL,\
-                                        password TEXT NOT NULL,\
-                                        UNIQUE(jid))")
-        c.execute("CREATE TABLE IF NOT EXISTS roster (userid INTEGER REFERENCES jids NOT NULL,\
-                                        contactid INTEGER REFERENCES jids NOT NULL,\
-                                        name TEXT,\
-                                        subscription INTEGER DEFAULT 0,\
-                                        PRIMARY KEY (userid, contactid)\
-                                        )")
-        c.execute("CREATE TABLE IF NOT EXISTS offline (fromid INTEGER REFERENCES jids NOT NULL,\
-                                        toid INTEGER REFERENCES jids NOT NULL,\
-                                        time TIMESTAMP,\
-                                        content TEXT\
-                                        )")
-        c.execute("CREATE TABLE IF NOT EXISTS rostergroups (groupid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,\
-                                              userid INTEGER REFERENCES jids NOT NULL,\
-                                              name TEXT NOT NULL,\
-                                              UNIQUE(userid, name)\
-                                              )")
-        c.execute("CREATE TABLE IF NOT EXISTS rostergroupitems\
-                    (groupid INTEGER REFERENCES rostergroup NOT NULL,\
-                     contactid INTEGER REFERENCES jids NOT NULL,\
-                     PRIMARY KEY (groupid, contactid))")
         c.execute("INSERT OR IGNORE INTO jids (jid, password) VALUES ('foo@localhost', 'foo')")
         c.execute("INSERT OR IGNORE INTO jids (jid, password) VALUES ('bar@localhost', 'bar')")
         c.execute("INSERT OR IGNORE INTO jids (jid, password) VALUES ('test@localhost', 'test')")
@@ -149,8 +152,12 @@ if __name__ == '__main__':
     import pjs.async.core
 
     try:
-        pjs.async.core.loop()
+        pjs.async.core.loop(use_epoll=True)
     except KeyboardInterrupt:
         # clean up
         logging.info("KeyboardInterrupt sent. Shutting down...")
-        logging.shutdown()
+        try:
+            # writes out the offline messages that are still queued
+            launcher.stop()
+        finally:
+            logging.shutdown()
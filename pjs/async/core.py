@@ -50,13 +50,20 @@ import select
 import socket
 import sys
 import time
+import thread
+import threading
+
+from collections import deque
+from itertools import islice
 
 import pjs.utils
 import pjs.queues
 
+from pjs.async.timers import TimerWheel
+
 import os
 from errno import EALREADY, EINPROGRESS, EWOULDBLOCK, ECONNRESET, \
-     ENOTCONN, ESHUTDOWN, EINTR, EISCONN, errorcode
+     ENOTCONN, ESHUTDOWN, EINTR, EISCONN, ENOENT, errorcode
 
 try:
     socket_map
@@ -68,6 +75,64 @@ try:
 except NameError:
     func_map = {}
 
+try:
+    epoll_map # dictionary of id(socket map) => _epoll_pollster
+except NameError:
+    epoll_map = {}
+
+try:
+    timer_wheel # timers scheduled with call_later()
+except NameError:
+    timer_wheel = TimerWheel()
+
+# thread ident of the thread running loop(), once it's been called
+_loop_thread = None
+# called to wake up the loop from other threads. See set_wakeup().
+_wakeup = None
+
+def set_wakeup(func):
+    """Sets the function that wakes up the loop when interest changes from
+    another thread (ie. output queued from a worker thread), so that it
+    doesn't wait out the poll timeout. It's called with an optional thunk
+    to run from the loop. The launcher uses its Trigger's pullTrigger().
+    """
+    global _wakeup
+    _wakeup = func
+
+def in_loop():
+    """Returns True if called from the thread running loop() or if the loop
+    hasn't run yet.
+    """
+    return _loop_thread is None or thread.get_ident() == _loop_thread
+
+def wake_loop():
+    """Wakes up the loop, unless we're running in it"""
+    wakeup = _wakeup
+    if wakeup is not None and not in_loop():
+        wakeup()
+
+def call_in_loop(func, *args):
+    """Calls func(*args) right away when in the loop (see in_loop()).
+    Otherwise hands it to the loop through the wakeup function, which takes
+    it as a thunk to run from the loop. Calls it right away if there's no
+    wakeup function.
+    """
+    wakeup = _wakeup
+    if wakeup is None or in_loop():
+        func(*args)
+    else:
+        wakeup(lambda: func(*args))
+
+def call_later(delay, func, *args, **kwargs):
+    """Call func(*args, **kwargs) from the loop in delay seconds. Returns a
+    pjs.async.timers.Timer that can be cancelled with cancel().
+    """
+    return timer_wheel.call_later(delay, func, *args, **kwargs)
+
+def cancel(timer):
+    """Cancel a timer returned by call_later()"""
+    timer_wheel.cancel(timer)
+
 class ExitNow(Exception):
     pass
 
@@ -114,6 +179,7 @@ def poll(timeout=0.0, map=None):
 
     if map is None:
         map = socket_map
+    timeout = timer_wheel.timeout(timeout)
     if map:
         r = []; w = []; e = []
         for fd, obj in map.items():
@@ -154,6 +220,9 @@ def poll(timeout=0.0, map=None):
                 continue
             _exception(obj)
 
+    if timer_wheel:
+        timer_wheel.run()
+
     if func_map:
         funcCheck()
 
@@ -161,6 +230,7 @@ def poll2(timeout=0.0, map=None):
     # Use the poll() support added to the select module in Python 2.0
     if map is None:
         map = socket_map
+    timeout = timer_wheel.timeout(timeout)
     if timeout is not None:
         # timeout is in milliseconds
         timeout = int(timeout*1000)
@@ -193,11 +263,141 @@ def poll2(timeout=0.0, map=None):
                 continue
             readwrite(obj, flags)
 
+    if timer_wheel:
+        timer_wheel.run()
+
     if func_map:
         funcCheck()
 
 poll3 = poll2                           # Alias for backward compatibility
 
+class _epoll_pollster:
+    """Keeps a single epoll object registered with every dispatcher in a
+    socket map. Dispatchers are registered once when they're added to the
+    map and their event mask is only recomputed when they're marked dirty,
+    which happens after they handle an event, when they're added to the map
+    or when they call interest_changed() (ie. after queueing output). This
+    makes a poll cost O(ready + dirty fds) instead of O(all fds).
+
+    Fds can be marked dirty from any thread; the epoll object is only
+    changed from the loop.
+    """
+    def __init__(self, map):
+        self.map = map
+        self.epoll = select.epoll()
+        # fd => event mask currently registered with epoll
+        self.registered = {}
+        # fds whose readable()/writable() may have changed
+        self.dirty = set(map.keys())
+        # guards dirty
+        self.lock = threading.Lock()
+
+    def mark_dirty(self, fd):
+        """Have the interest of fd re-evaluated before the next poll"""
+        self.lock.acquire()
+        try:
+            self.dirty.add(fd)
+        finally:
+            self.lock.release()
+
+    def update(self):
+        """Re-evaluate the interest of all dirty fds and tell epoll about
+        the ones that changed.
+        """
+        self.lock.acquire()
+        try:
+            dirty = self.dirty
+            self.dirty = set()
+        finally:
+            self.lock.release()
+        for fd in dirty:
+            obj = self.map.get(fd)
+            if obj is None:
+                self.unregister(fd)
+                continue
+            flags = 0
+            if obj.readable():
+                flags |= select.EPOLLIN | select.EPOLLPRI
+            if obj.writable():
+                flags |= select.EPOLLOUT
+            old = self.registered.get(fd)
+            if flags == old:
+                continue
+            if not flags:
+                # like poll2(), don't watch fds that are neither readable
+                # nor writable, not even for errors
+                self.unregister(fd)
+            elif old is None:
+                self.epoll.register(fd, flags)
+                self.registered[fd] = flags
+            else:
+                try:
+                    self.epoll.modify(fd, flags)
+                except IOError, err:
+                    if err.errno != ENOENT:
+                        raise
+                    # the old fd was closed behind our back and reused
+                    self.epoll.register(fd, flags)
+                self.registered[fd] = flags
+
+    def unregister(self, fd):
+        if self.registered.pop(fd, None) is not None:
+            try:
+                self.epoll.unregister(fd)
+            except (IOError, OSError, ValueError):
+                # already closed, so the kernel dropped it for us
+                pass
+
+    def close(self):
+        self.epoll.close()
+        self.registered.clear()
+        self.lock.acquire()
+        try:
+            self.dirty.clear()
+        finally:
+            self.lock.release()
+
+def _get_epoll_pollster(map):
+    pollster = epoll_map.get(id(map))
+    if pollster is None:
+        pollster = epoll_map[id(map)] = _epoll_pollster(map)
+    return pollster
+
+def epoll_poll(timeout=0.0, map=None):
+    # Use epoll (Linux) with persistent registration. The EPOLL* constants
+    # have the same values as the POLL* ones, so readwrite() works as is.
+    if map is None:
+        map = socket_map
+    timeout = timer_wheel.timeout(timeout)
+    if timeout is None:
+        timeout = -1
+    if map:
+        pollster = _get_epoll_pollster(map)
+        pollster.update()
+        try:
+            r = pollster.epoll.poll(timeout)
+        except IOError, err:
+            if err.errno != EINTR:
+                raise
+            r = []
+
+        # pick up results from Messages and process queued
+        pjs.queues.pickupResults()
+
+        for fd, flags in r:
+            obj = map.get(fd)
+            if obj is None:
+                continue
+            readwrite(obj, flags)
+            # handling the event may have changed what we're interested in
+            pollster.mark_dirty(fd)
+
+    if timer_wheel:
+        timer_wheel.run()
+
+    if func_map:
+        funcCheck()
+
 def funcCheck():
     """Try running all functions in the map with params. Whenever one returns
     True, call its callback func.
@@ -215,11 +415,15 @@ def funcCheck():
             cb()
             del func_map[f]
 
-def loop(timeout=30.0, use_poll=False, map=None, count=None):
+def loop(timeout=30.0, use_poll=False, map=None, count=None, use_epoll=False):
+    global _loop_thread
     if map is None:
         map = socket_map
+    _loop_thread = thread.get_ident()
 
-    if use_poll and hasattr(select, 'poll'):
+    if use_epoll and hasattr(select, 'epoll'):
+        poll_fun = epoll_poll
+    elif use_poll and hasattr(select, 'poll'):
         poll_fun = poll2
     else:
         poll_fun = poll
@@ -246,6 +450,10 @@ def wf(self, checkFunc, cb, initFunc=None):
     If an exception is raised when calling initFunc.func or checkFunc.func,
     cb will be passed the exception as a parameter, so it should be of the
     form: def cb(exception=None)
+
+    This is kept for handlers that still poll for completion. Threaded
+    handlers should return a pjs.threadpool.WorkFuture instead, which
+    doesn't cost anything on every iteration of the loop.
     """
     assert(isinstance(checkFunc, pjs.utils.FunctionCall) and callable(cb))
 
@@ -266,6 +474,7 @@ class dispatcher:
     accepting = False
     closing = False
     addr = None
+    _timers = None
 
     watch_function = wf
 
@@ -308,6 +517,10 @@ class dispatcher:
         if map is None:
             map = self._map
         map[self._fileno] = self
+        pollster = epoll_map.get(id(map))
+        if pollster is not None:
+            pollster.mark_dirty(self._fileno)
+        wake_loop()
 
     def del_channel(self, map=None):
         fd = self._fileno
@@ -316,8 +529,25 @@ class dispatcher:
         if map.has_key(fd):
             #self.log_info('closing channel %d:%s' % (fd, self))
             del map[fd]
+        # unregister before the socket is closed and the fd gets reused
+        pollster = epoll_map.get(id(map))
+        if pollster is not None:
+            pollster.unregister(fd)
         self._fileno = None
 
+    def interest_changed(self):
+        """Tells the epoll loop that readable() or writable() may return
+        something else now. Event handlers don't need to call this, but
+        anything that changes these predicates from outside of an event
+        (ie. queueing output) does. Wakes up the loop when called from
+        another thread.
+        """
+        pollster = epoll_map.get(id(self._map))
+        fd = getattr(self, '_fileno', None)
+        if pollster is not None and fd is not None:
+            pollster.mark_dirty(fd)
+        wake_loop()
+
     def create_socket(self, family, type):
         self.family_and_type = family, type
         self.socket = socket.socket(family, type)
@@ -421,7 +651,35 @@ class dispatcher:
             else:
                 raise
 
+    def call_later(self, delay, func, *args, **kwargs):
+        """Call func(*args, **kwargs) from the loop in delay seconds, unless
+        this dispatcher is closed before then. Returns a timer that can be
+        passed to cancel_timer().
+        """
+        if self._timers is None:
+            self._timers = set()
+        timers = self._timers
+        def fire():
+            timers.discard(timer)
+            func(*args, **kwargs)
+        timer = timer_wheel.call_later(delay, fire)
+        timers.add(timer)
+        return timer
+
+    def cancel_timer(self, timer):
+        timer_wheel.cancel(timer)
+        if self._timers is not None:
+            self._timers.discard(timer)
+
+    def cancel_timers(self):
+        """Cancel all timers scheduled with call_later()"""
+        if self._timers:
+            for timer in self._timers:
+                timer_wheel.cancel(timer)
+            self._timers.clear()
+
     def close(self):
+        self.cancel_timers()
         self.del_channel()
         self.socket.close()
 
@@ -509,18 +767,94 @@ class dispatcher:
 # [for more sophisticated usage use asynchat.async_chat]
 # ---------------------------------------------------------------------------
 
+class output_queue:
+    """Output buffer for dispatcher_with_send. Data is kept as a deque of
+    the strings passed to append(), plus an offset into the first one, so
+    queueing and partially sending data never copies what's already queued.
+    len() is the number of bytes queued. Unicode is encoded to UTF-8.
+    """
+    def __init__(self):
+        self._chunks = deque()
+        self._offset = 0 # bytes of the first chunk that are already sent
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if data:
+            self._chunks.append(data)
+            self._size += len(data)
+
+    def peek(self, size):
+        """Returns up to size bytes from the front of the queue without
+        removing them. Small chunks are joined together so that they can go
+        out in one write; a large chunk is returned as a memoryview.
+        """
+        chunks = self._chunks
+        if not chunks:
+            return ''
+        first = chunks[0]
+        remaining = len(first) - self._offset
+        if remaining >= size or len(chunks) == 1:
+            if self._offset == 0 and remaining <= size:
+                return first
+            return memoryview(first)[self._offset:self._offset + size]
+
+        # gather the following chunks into a single write
+        parts = [first[self._offset:]]
+        total = remaining
+        for chunk in islice(chunks, 1, None):
+            if total >= size:
+                break
+            parts.append(chunk[:size - total])
+            total += len(parts[-1])
+        return ''.join(parts)
+
+    def consume(self, size):
+        """Removes size bytes from the front of the queue"""
+        chunks = self._chunks
+        self._size -= size
+        while size and chunks:
+            remaining = len(chunks[0]) - self._offset
+            if size < remaining:
+                self._offset += size
+                return
+            size -= remaining
+            chunks.popleft()
+            self._offset = 0
+
+    def clear(self):
+        self._chunks.clear()
+        self._offset = 0
+        self._size = 0
+
 class dispatcher_with_send(dispatcher):
 
     watch_function = wf
 
+    # most we try to write to the socket at once
+    send_size = 65536
+
     def __init__(self, sock=None, map=None):
+        # set up before dispatcher.__init__() puts us in the map, where the
+        # loop can get to us
+        self.out_buffer = output_queue()
+        # some threaded handlers send() from worker threads
+        self._send_lock = threading.Lock()
         dispatcher.__init__(self, sock, map)
-        self.out_buffer = ''
 
     def initiate_send(self):
-        num_sent = 0
-        num_sent = dispatcher.send(self, self.out_buffer[:512])
-        self.out_buffer = self.out_buffer[num_sent:]
+        self._send_lock.acquire()
+        try:
+            data = self.out_buffer.peek(self.send_size)
+            if data:
+                num_sent = dispatcher.send(self, data)
+                self.out_buffer.consume(num_sent)
+        finally:
+            self._send_lock.release()
 
     def handle_write(self):
         self.initiate_send()
@@ -528,11 +862,20 @@ class dispatcher_with_send(dispatcher):
     def writable(self):
         return (not self.connected) or len(self.out_buffer)
 
+    def bytes_queued(self):
+        """Number of bytes waiting to be written to the socket"""
+        return len(self.out_buffer)
+
     def send(self, data):
         if self.debug:
             self.log_info('sending %s' % repr(data))
-        self.out_buffer = self.out_buffer + data
+        self._send_lock.acquire()
+        try:
+            self.out_buffer.append(data)
+        finally:
+            self._send_lock.release()
         self.initiate_send()
+        self.interest_changed()
 
 # ---------------------------------------------------------------------------
 # used for debugging.
@@ -543,8 +886,12 @@ def close_all(map=None):
     if map is None:
         map = socket_map
     for x in map.values():
+        x.cancel_timers()
         x.socket.close()
     map.clear()
+    pollster = epoll_map.pop(id(map), None)
+    if pollster is not None:
+        pollster.close()
 
 # Asynchronous File I/O:
 #
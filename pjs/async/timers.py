@@ -0,0 +1,184 @@
+"""Timers for the asyncore loop.
+
+The loop only wakes up when there's activity on a socket or when its
+timeout runs out, so anything that needs to happen after a delay (timeouts,
+keepalives, delayed work) is scheduled on a TimerWheel. The loop shortens
+its poll timeout while there are timers pending and runs the expired ones
+after handling socket events.
+
+The wheel is hashed and has two levels. Timers due within the next
+size ticks are kept in the slot for their tick. Timers further out are
+kept in a dict keyed by the wheel revolution they're due in and are moved
+into the slots when the wheel gets to that revolution. Scheduling and
+cancelling are O(1) and every timer is moved at most once, so the wheel can
+hold hundreds of thousands of mostly-cancelled timers (idle timeouts and
+such) cheaply.
+"""
+
+import time
+import logging
+
+from math import ceil
+from pjs.utils import compact_traceback
+
+class Timer(object):
+    """A scheduled call. Returned by TimerWheel.call_later()."""
+    __slots__ = ('deadline', 'tick', 'func', 'args', 'kwargs', '_wheel',
+                 '_slot')
+
+    def __init__(self, wheel, deadline, tick, func, args, kwargs):
+        self.deadline = deadline
+        self.tick = tick
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self._wheel = wheel
+        # the dict this timer is stored in. None when it's fired or cancelled
+        self._slot = None
+
+    def active(self):
+        """True if the timer hasn't fired and hasn't been cancelled"""
+        return self._slot is not None
+
+    def cancel(self):
+        """Cancel the timer. Does nothing if it has already fired or been
+        cancelled.
+        """
+        self._wheel.cancel(self)
+
+class TimerWheel:
+    """Schedules calls at a resolution of tick seconds. Timers never fire
+    early, but they can fire up to a tick late (or later if the loop is
+    busy).
+    """
+    def __init__(self, tick=0.1, size=512, clock=time.time):
+        self.tickLength = float(tick)
+        self.size = size
+        self.clock = clock
+
+        # the last tick that's been run
+        self._current = int(clock() / self.tickLength)
+        # timers due in the next self.size ticks, by tick % self.size
+        self._slots = [{} for i in xrange(size)]
+        # timers due later on, by tick / self.size
+        self._overflow = {}
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def call_later(self, delay, func, *args, **kwargs):
+        """Call func(*args, **kwargs) from the loop in delay seconds. Returns
+        a Timer that can be cancelled.
+        """
+        deadline = self.clock() + delay
+        tick = int(ceil(deadline / self.tickLength))
+        if tick <= self._current:
+            tick = self._current + 1
+        timer = Timer(self, deadline, tick, func, args, kwargs)
+        self._insert(timer)
+        self._count += 1
+        return timer
+
+    def cancel(self, timer):
+        """Cancel timer. Does nothing if it has already fired or been
+        cancelled.
+        """
+        slot = timer._slot
+        if slot is not None:
+            del slot[timer]
+            timer._slot = None
+            self._count -= 1
+
+    def timeout(self, timeout=None):
+        """Returns how long the loop can sleep for, given that it would
+        otherwise sleep for timeout seconds (None meaning forever).
+        """
+        if not self._count:
+            return timeout
+        wait = (self._current + 1) * self.tickLength - self.clock()
+        if wait < 0:
+            wait = 0.0
+        if timeout is None or wait < timeout:
+            return wait
+        return timeout
+
+    def run(self):
+        """Fire all the timers that are due. Returns the number fired."""
+        now = int(self.clock() / self.tickLength)
+        if now <= self._current or not self._count:
+            self._current = max(now, self._current)
+            return 0
+
+        if now - self._current > self.size:
+            due = self._rehash(now)
+        else:
+            due = []
+            size = self.size
+            slots = self._slots
+            for tick in xrange(self._current + 1, now + 1):
+                if tick % size == 0:
+                    self._cascade(tick / size)
+                slot = slots[tick % size]
+                if slot:
+                    due.extend(slot)
+                    slot.clear()
+            self._current = now
+
+        if len(due) > 1:
+            due.sort(key=lambda t: t.deadline)
+        for timer in due:
+            timer._slot = None
+        self._count -= len(due)
+
+        # timers scheduled from the callbacks go in after now
+        for timer in due:
+            try:
+                timer.func(*timer.args, **timer.kwargs)
+            except:
+                nil, t, v, tbinfo = compact_traceback()
+                logging.warning("[%s] Exception in timer %s: %s: %s -- %s",
+                                self.__class__, timer.func, t, v, tbinfo)
+
+        return len(due)
+
+    def _insert(self, timer):
+        if timer.tick - self._current < self.size:
+            slot = self._slots[timer.tick % self.size]
+        else:
+            slot = self._overflow.setdefault(timer.tick / self.size, {})
+        slot[timer] = True
+        timer._slot = slot
+
+    def _cascade(self, revolution):
+        """Move the timers due in revolution into the slots"""
+        timers = self._overflow.pop(revolution, None)
+        if timers:
+            slots = self._slots
+            size = self.size
+            for timer in timers:
+                slot = slots[timer.tick % size]
+                slot[timer] = True
+                timer._slot = slot
+
+    def _rehash(self, now):
+        """Used when the wheel has fallen more than a revolution behind (ie.
+        the clock jumped). Returns the timers that are due and reinserts the
+        rest.
+        """
+        pending = []
+        for slot in self._slots:
+            pending.extend(slot)
+            slot.clear()
+        for revolution in self._overflow.keys():
+            if revolution <= now / self.size + 1:
+                pending.extend(self._overflow.pop(revolution))
+
+        self._current = now
+        due = []
+        for timer in pending:
+            if timer.tick <= now:
+                due.append(timer)
+            else:
+                self._insert(timer)
+        return due
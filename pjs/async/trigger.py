@@ -0,0 +1,110 @@
+"""Wakes up the asyncore loop from other threads.
+
+The loop can sleep for as long as its timeout when there is no data on the
+wire, which is a problem when threads finish work in the pools: their
+results have to be picked up from the main thread before message handling
+can continue. The Trigger is a pipe registered with the loop. Worker threads
+write a byte into it, which makes select()/epoll() return right away, and
+the main thread then runs the thunks that were handed to it.
+"""
+
+import os
+import fcntl
+import logging
+import threading
+import pjs.async.core as asyncore
+
+from pjs.utils import compact_traceback
+
+class Trigger(asyncore.file_dispatcher):
+    """A self-pipe for waking up the loop. Wakeups are coalesced: no matter
+    how many times pullTrigger() is called before the loop gets to it, only
+    one byte is ever pending in the pipe and it's drained with one read.
+    Thunks passed to pullTrigger() are run once per wakeup in the main
+    thread; the same thunk pulled several times is only run once.
+    """
+    def __init__(self, map=None):
+        r, w = os.pipe()
+        flags = fcntl.fcntl(w, fcntl.F_GETFL, 0)
+        fcntl.fcntl(w, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._wfd = w
+
+        self._lock = threading.Lock()
+        # thunks to run in the main thread on the next wakeup, in order
+        self._thunks = []
+        # the same thunks, for finding duplicates without scanning the list
+        self._queued = set()
+        # True when there's a byte in the pipe that hasn't been read yet
+        self._pending = False
+
+        asyncore.file_dispatcher.__init__(self, r, map)
+
+        logging.info("[%s] New trigger created", self.__class__)
+
+    def pullTrigger(self, thunk=None):
+        """Wakes up the loop. Can be called from any thread. If thunk is
+        given, it's called from the main thread after the wakeup.
+        """
+        self._lock.acquire()
+        try:
+            if thunk is not None and thunk not in self._queued:
+                self._queued.add(thunk)
+                self._thunks.append(thunk)
+            if self._pending or self._wfd is None:
+                return
+            self._pending = True
+            try:
+                os.write(self._wfd, 'x')
+            except OSError:
+                # the pipe can't be full with a single pending byte, so
+                # this only happens while closing
+                pass
+        finally:
+            self._lock.release()
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            os.read(self._fileno, 512)
+        except OSError:
+            pass
+
+        self._lock.acquire()
+        try:
+            thunks = self._thunks
+            self._thunks = []
+            self._queued = set()
+            self._pending = False
+        finally:
+            self._lock.release()
+
+        for thunk in thunks:
+            try:
+                thunk()
+            except:
+                nil, t, v, tbinfo = compact_traceback()
+                logging.warning("[%s] Exception in trigger thunk: %s: %s -- %s",
+                                self.__class__, t, v, tbinfo)
+
+    def handle_expt(self):
+        logging.warning("[%s] Exception occurred on the trigger pipe",
+                        self.__class__)
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            wfd = self._wfd
+            self._wfd = None
+        finally:
+            self._lock.release()
+        if wfd is not None:
+            os.close(wfd)
+        asyncore.file_dispatcher.close(self)
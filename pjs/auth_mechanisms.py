@@ -7,7 +7,7 @@ import binascii
 import base64
 import re
 
-from pjs.db import DBautocommit
+from pjs.storage import getStorage
 from pjs.utils import generateId
 from pjs.elementtree.ElementTree import Element
 from pjs.jid import JID
@@ -91,18 +91,10 @@ class SASLPlain:
             if len(auth) != 3:
                 raise SASLIncorrectEncodingError
 
-            con = DBautocommit()
-            c = con.cursor()
-            c.execute("SELECT * FROM jids WHERE \
-                jid = ? AND password = ?", (auth[1] + \
-                                            '@' + self.msg.conn.server.hostname, auth[2]))
-            res = c.fetchall()
-            if len(res) == 0:
-                c.close()
-                con.close()
+            password = getStorage().getPassword(auth[1] + '@' + \
+                                                self.msg.conn.server.hostname)
+            if password != auth[2]:
                 raise SASLAuthError
-            c.close()
-            con.close()
 
         self.msg.conn.data['sasl']['complete'] = True
         self.msg.conn.data['sasl']['in-progress'] = False
@@ -112,7 +104,7 @@ class SASLPlain:
         self.msg.conn.server.conns[self.msg.conn.id] = (JID(self.msg.conn.data['user']['jid']),
                                                         self.msg.conn)
 
-        self.msg.conn.parser.resetParser()
+        self.msg.conn.resetParser()
 
         return Element('success',
                        {'xmlns' : 'urn:ietf:params:xml:ns:xmpp-sasl'})
@@ -203,20 +195,11 @@ class SASLDigestMD5:
                 raise SASLAuthError
 
             # fetch the password now
-            con = DBautocommit()
-            c = con.cursor()
-            c.execute("SELECT password FROM jids WHERE \
-                jid = ?", (username + '@%s' % self.msg.conn.server.hostname,))
-            for row in c:
-                password = row['password']
-                break
-            else:
+            password = getStorage().getPassword(username + '@%s' % \
+                                                self.msg.conn.server.hostname)
+            if password is None:
                 self._handleFailure()
-                c.close()
-                con.close()
                 raise SASLAuthError
-            c.close()
-            con.close()
 
             # compute the digest as per RFC 2831
             a1 = "%s:%s:%s" % (H("%s:%s:%s" % (username, realm, password)),
@@ -261,7 +244,7 @@ class SASLDigestMD5:
                 self.msg.conn.server.conns[self.msg.conn.id] = (JID(d['user']['jid']),
                                                                 self.msg.conn)
 
-                self.msg.conn.parser.resetParser()
+                self.msg.conn.resetParser()
 
                 res = Element('success',
                               {'xmlns' : 'urn:ietf:params:xml:ns:xmpp-sasl'})
@@ -330,19 +313,10 @@ class IQAuthPlain:
         self.msg = msg
 
     def handle(self, username, password):
-        con = DBautocommit()
-        c = con.cursor()
-        c.execute("SELECT password FROM jids WHERE \
-            jid = ?", (username + '@%s' % self.msg.conn.server.hostname,))
-        res = c.fetchone()
-        if res:
-            password = res[0]
-        else:
-            c.close()
-            con.close()
+        password = getStorage().getPassword(username + '@%s' % \
+                                            self.msg.conn.server.hostname)
+        if password is None:
             raise IQAuthError
-        c.close()
-        con.close()
 
         d = self.msg.conn.data
         d['user']['jid'] = '%s@%s' % (username, self.msg.conn.server.hostname)
@@ -350,7 +324,7 @@ class IQAuthPlain:
         self.msg.conn.server.conns[self.msg.conn.id] = (JID(d['user']['jid']),
                                                         self.msg.conn)
 
-        self.msg.conn.parser.resetParser()
+        self.msg.conn.resetParser()
 
 class IQAuthDigest:
     """Handles the old-style jabber:iq:auth digest auth"""
@@ -358,19 +332,10 @@ class IQAuthDigest:
         self.msg = msg
         self.streamid = msg.conn.data['stream']['id']
     def handle(self, username, digest):
-        con = DBautocommit()
-        c = con.cursor()
-        c.execute("SELECT password FROM jids WHERE \
-            jid = ?", (username + '@%s' % self.msg.conn.server.hostname,))
-        res = c.fetchone()
-        if res:
-            password = res[0]
-        else:
-            c.close()
-            con.close()
+        password = getStorage().getPassword(username + '@%s' % \
+                                            self.msg.conn.server.hostname)
+        if password is None:
             raise IQAuthError
-        c.close()
-        con.close()
 
         s = sha1()
         s.update(self.streamid + password)
@@ -385,7 +350,7 @@ class IQAuthDigest:
             self.msg.conn.server.conns[self.msg.conn.id] = (JID(d['user']['jid']),
                                                             self.msg.conn)
 
-            self.msg.conn.parser.resetParser()
+            self.msg.conn.resetParser()
             return
         else:
             raise IQAuthError
@@ -148,5 +148,13 @@ handlers = {
             'route-client': {
                              'handler' : pjs.handlers.route.ClientRouteHandler,
                              'description' : 'routes data to a client on this server'
-                             }
+                             },
+            'route-server-batch' : {
+                                    'handler' : pjs.handlers.route.ServerBatchRouteHandler,
+                                    'description' : 'routes a list of data to servers'
+                                    },
+            'route-client-batch' : {
+                                    'handler' : pjs.handlers.route.ClientBatchRouteHandler,
+                                    'description' : 'routes a list of data to clients on this server'
+                                    }
             }
\ No newline at end of file
@@ -1,6 +1,5 @@
 """Various connections that the server uses. Most important are the
-Client and Server connections. There's also a local trigger connection
-(see its doc for more details).
+Client and Server connections.
 
 See the design doc for more information on asynchronous connections.
 """
@@ -13,11 +12,34 @@ import socket
 from pjs.elementtree.ElementTree import Element
 from pjs.events import Dispatcher
 
+# backpressure counters for all connections. see Connection.send()
+stats = {
+         'paused' : 0, # times reading was paused over the high watermark
+         'resumed' : 0, # times reading was resumed under the low watermark
+         'coalesced' : 0, # presence stanzas replaced by a newer one
+         'disconnected' : 0, # slow consumers disconnected
+         }
+
 # TODO: add TLS here through tlslite's asyncore integration.
 #from tlslite.integration.TLSAsyncDispatcherMixIn import TLSAsyncDispatcherMixIn
 
 class Connection(asyncore.dispatcher_with_send):
-    """Represents a connection between two endpoints"""
+    """Represents a connection between two endpoints.
+
+    When more than highWatermark bytes are queued for output, we stop
+    reading from the connection and hold back presence updates (see send())
+    until the queue drains below lowWatermark. If it stays over the high
+    watermark for slowConsumerTimeout seconds or grows over hardLimit, the
+    connection is closed with a <resource-constraint/> stream error.
+    """
+
+    highWatermark = 512 * 1024
+    lowWatermark = 128 * 1024
+    hardLimit = 4 * 1024 * 1024
+    slowConsumerTimeout = 60
+    # how long to try to write the stream error to a slow consumer, in seconds
+    errorFlushTimeout = 5
+
     def __init__(self, sock, addr, server):
         asyncore.dispatcher_with_send.__init__(self, sock)
         self.sock = sock
@@ -26,6 +48,18 @@ class Connection(asyncore.dispatcher_with_send):
         self.id = id(self) # this is referenced in msg processing queues
                            # and servers
 
+        # True while we're over the high watermark
+        self.readPaused = False
+        # True once we've given up on a slow consumer
+        self.disconnecting = False
+        # True once handle_close() has run. It can be called again, ie. by
+        # the errorFlushTimeout timer after the socket closed by itself.
+        self.closing = False
+        self._overloadTimer = None
+        # presence held back while paused. coalesceKey => data
+        self._coalesced = {}
+        self._coalescedOrder = []
+
         self.parser = pjs.parsers.borrow_parser(self)
 
         # per-connection data. can be accessed by handlers.
@@ -57,18 +91,145 @@ class Connection(asyncore.dispatcher_with_send):
         self.handle_close()
 
     def handle_close(self):
+        if self.closing:
+            return
+        self.closing = True
         del self.server.conns[self.id]
 
-        try:
-            self.parser.close()
-        except:
-            pass
-        self.parser.resetStream()
+        self.releaseParser()
         self.close()
 
+    def releaseParser(self):
+        """Gives the parser back to the pool for reuse by other connections"""
+        if self.parser is not None:
+            pjs.parsers.return_parser(self.parser)
+            self.parser = None
+
+    def resetParser(self):
+        """Resets the parser for a restarted stream (ie. after SASL). Does
+        nothing if the connection has closed and given back its parser,
+        since handlers queued before the close can still run after it.
+        """
+        if self.parser is not None:
+            self.parser.resetParser()
+
     def handle_read(self):
         data = self.recv(4096)
-        self.parser.feed(data)
+        # recv() closes the connection (and gives back the parser) on EOF
+        if data:
+            self.parser.feed(data)
+
+    def readable(self):
+        return not self.readPaused and not self.disconnecting
+
+    def handle_write(self):
+        asyncore.dispatcher_with_send.handle_write(self)
+        if self.disconnecting:
+            if not len(self.out_buffer):
+                # the stream error is out
+                self.handle_close()
+        elif self.readPaused and len(self.out_buffer) <= self.lowWatermark:
+            self._resumeReading()
+
+    def send(self, data, coalesceKey=None):
+        """Queue data for sending. coalesceKey marks data as low-priority
+        (ie. presence updates): while the connection is over the high
+        watermark such data is held back and only the latest data for each
+        key is sent once the connection drains.
+
+        Can be called from any thread. Data sent from a worker thread is
+        queued from the main thread, where the watermarks are checked.
+        """
+        if not asyncore.in_loop():
+            asyncore.call_in_loop(self.send, data, coalesceKey)
+            return
+        if self.disconnecting or self._fileno is None:
+            return
+        if self.readPaused and coalesceKey is not None:
+            if coalesceKey in self._coalesced:
+                stats['coalesced'] += 1
+            else:
+                self._coalescedOrder.append(coalesceKey)
+            self._coalesced[coalesceKey] = data
+            return
+
+        asyncore.dispatcher_with_send.send(self, data)
+        self._checkWatermarks()
+
+    def sendMany(self, chunks):
+        """Queue a list of (data, coalesceKey) for sending. They're written
+        out as one piece, unless the connection is over the high watermark
+        and some of them may have to be coalesced. See send().
+        """
+        if not asyncore.in_loop():
+            asyncore.call_in_loop(self.sendMany, chunks)
+            return
+        if self.readPaused:
+            for data, coalesceKey in chunks:
+                self.send(data, coalesceKey)
+        elif len(chunks) == 1:
+            self.send(chunks[0][0])
+        else:
+            self.send(u''.join([data for data, coalesceKey in chunks]))
+
+    def _checkWatermarks(self):
+        queued = len(self.out_buffer)
+        if queued <= self.highWatermark:
+            return
+        if queued > self.hardLimit:
+            self._disconnectSlowConsumer()
+        elif not self.readPaused:
+            logging.info("[%s] %s bytes queued for %s. Pausing reads",
+                         self.__class__, queued, self.addr)
+            stats['paused'] += 1
+            self.readPaused = True
+            self.interest_changed()
+            self._overloadTimer = self.call_later(self.slowConsumerTimeout,
+                                                  self._disconnectSlowConsumer)
+
+    def _resumeReading(self):
+        stats['resumed'] += 1
+        self.readPaused = False
+        if self._overloadTimer is not None:
+            self.cancel_timer(self._overloadTimer)
+            self._overloadTimer = None
+        self.interest_changed()
+
+        order = self._coalescedOrder
+        coalesced = self._coalesced
+        self._coalescedOrder = []
+        self._coalesced = {}
+        for key in order:
+            asyncore.dispatcher_with_send.send(self, coalesced[key])
+        self._checkWatermarks()
+
+    def _disconnectSlowConsumer(self):
+        """Drop everything queued and close the stream. The connection is
+        closed once the stream error is written out or after
+        errorFlushTimeout seconds.
+        """
+        if self.disconnecting:
+            return
+        logging.warning("[%s] Disconnecting slow consumer %s with %s bytes queued",
+                        self.__class__, self.addr, len(self.out_buffer))
+        stats['disconnected'] += 1
+        self.disconnecting = True
+        if self._overloadTimer is not None:
+            self.cancel_timer(self._overloadTimer)
+            self._overloadTimer = None
+        self._coalescedOrder = []
+        self._coalesced = {}
+        self.out_buffer.clear()
+        # tries to write it right away
+        asyncore.dispatcher_with_send.send(self,
+                "<stream:error><resource-constraint " +\
+                "xmlns='urn:ietf:params:xml:ns:xmpp-streams'/>" +\
+                "</stream:error></stream:stream>")
+        if len(self.out_buffer):
+            # handle_write() closes once it's out
+            self.call_later(self.errorFlushTimeout, self.handle_close)
+        else:
+            self.handle_close()
 
 class ClientConnection(Connection):
     """A connection between a client and a server (us) initiated by
@@ -89,6 +250,8 @@ class ClientConnection(Connection):
                              'requestedRoster' : False, # True when sent the roster iq get
                                                         # when False, we shouldn't send it presence
                                                         # updates
+                             'rosterVersioning' : False, # True when the roster get had a
+                                                         # ver attribute (XEP-0237)
                              'active' : False, # active resource is an available resource
                                                # that send an initial presence
                              'lastPresence' : None # last <presence> stanza sent by client
@@ -103,9 +266,10 @@ class ClientConnection(Connection):
 
         # we set the tree to a dummy element so that the handlers could modify
         # it.
-        if self.data['stream']['closing']:
+        if self.closing or self.data['stream']['closing']:
             # already closing
             return
+        self.closing = True
         wrapper = Element('wrapper')
         tree = Element('tag')
         wrapper.append(tree)
@@ -135,6 +299,8 @@ class ServerInConnection(ServerConnection):
         logging.info("New ServerInConnection created with %s", addr)
 
     def handle_close(self):
+        if self.closing:
+            return
         hostname = self.data['server']['hostname']
 
         logging.debug("[%s] Closing ServerInConnection with %s",
@@ -148,7 +314,9 @@ class ServerInConnection(ServerConnection):
     # FIXME: remove this
     def handle_read(self):
         data = self.recv(4096)
-        self.parser.feed(data)
+        # recv() closes the connection (and gives back the parser) on EOF
+        if data:
+            self.parser.feed(data)
 
 class ServerOutConnection(ServerConnection):
     """An s2s connection from us to a remote server"""
@@ -166,6 +334,8 @@ class ServerOutConnection(ServerConnection):
         logging.info("New ServerOutConnection created with %s", addr)
 
     def handle_close(self):
+        if self.closing:
+            return
         hostname = self.data['server']['hostname']
 
         logging.debug("[%s] Closing ServerOutConnection with %s",
@@ -204,20 +374,24 @@ class LocalServerInConnection(ServerConnection):
         logging.info("New LocalServerInConnection created with %s", addr)
 
     def handle_close(self):
+        if self.closing:
+            return
         hostname = self.data['server']['hostname']
 
         logging.debug("[%s] Closing LocalServerConnection with %s",
                       self.__class__, hostname)
 
         if hostname:
-            self.server.s2sConns[hostname] = (None, None)
+            self.server.s2sConns[hostname] = [None, None]
 
         ServerConnection.handle_close(self)
 
     # FIXME: remove this
     def handle_read(self):
         data = self.recv(4096)
-        self.parser.feed(data)
+        # recv() closes the connection (and gives back the parser) on EOF
+        if data:
+            self.parser.feed(data)
 
 class LocalServerOutConnection(asyncore.dispatcher_with_send):
     """Simple server out connection for local S2S. All it does is
@@ -237,35 +411,3 @@ class LocalServerOutConnection(asyncore.dispatcher_with_send):
     def handle_close(self):
         del self.server.conns[self.id]
         self.close()
-
-class LocalTriggerConnection(asyncore.dispatcher_with_send):
-    """This creates a local connection back to our server.
-
-    This should never be used to send any real data. This is used by the
-    threadpool code to trigger a wake-up to asyncore, which could go to sleep
-    for as long as 30 seconds when there is no data on the wire, which is a
-    problem when we have threads finishing work in the pools. The callbacks
-    need to be executed from the main thread with threadpool.poll() in order
-    to proceed with message handling, but this can't happen when asyncore is
-    asleep. So, each WorkThread sends a single space on this connection, which
-    causes asyncore to wake up and process the event, thereby triggering
-    function watching (which usually includes a threadpool.poll() call).
-    """
-    def __init__(self, ip, port):
-        asyncore.dispatcher_with_send.__init__(self)
-
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.connect((ip, port))
-
-        logging.info("[%s] New local trigger connection created",
-                     self.__class__)
-
-    def handle_expt(self):
-        logging.warning("[%s] Socket exception occured for %s on local " +\
-                        "trigger socket", self.__class__, self.addr)
-
-    def handle_close(self):
-        self.close()
-
-    def handle_read(self): pass
-    def handle_connect(self): pass
@@ -1,15 +1,61 @@
 """SQLite in-memory storage. Mostly for testing purposes now.
 This can be replaced by rewriting the relevant classes and using them
 in your own custom handlers.
+
+Connections are pooled per thread: each thread (the main thread and every
+threadpool worker) opens one connection per DB name and isolation level on
+first use and keeps reusing it, along with the statements sqlite3 has
+already prepared on it. Since a connection is shared by everything that
+runs in its thread, commit or roll back before returning.
 """
 
 import sqlite3 as sqlite
+import threading
 
 dbname = 'storage.db'
 
+# run once on every new connection
+pragmas = [
+           'PRAGMA journal_mode = WAL',
+           'PRAGMA synchronous = NORMAL',
+           'PRAGMA cache_size = 4000'
+           ]
+# number of prepared statements kept per connection
+statementCacheSize = 200
+
+# this thread's connections: {(name, isolationLevel) => PooledConnection}
+_local = threading.local()
+# all the pooled connections in all the threads, so that closeAll() can get
+# to them. Bumping the generation makes the threads drop their dicts.
+_lock = threading.Lock()
+_all = []
+_generation = 0
+
+class PooledConnection(sqlite.Connection):
+    """A connection that stays open in the pool. close() only rolls back
+    what wasn't committed, so that code written for one connection per call
+    keeps working. Use closeAll() to actually close the connections.
+    """
+    def close(self):
+        self.rollback()
+
+def _connect(name, isolationLevel):
+    # check_same_thread is off only so that closeAll() can close the
+    # connections of other threads. They're never used by more than one.
+    db = sqlite.connect(name, timeout=10.0, isolation_level=isolationLevel,
+                        detect_types=sqlite.PARSE_DECLTYPES,
+                        factory=PooledConnection,
+                        cached_statements=statementCacheSize,
+                        check_same_thread=False)
+    # allows us to select by column name instead of just by index
+    db.row_factory = sqlite.Row
+    for pragma in pragmas:
+        db.execute(pragma)
+    return db
+
 def DB(name=None, isolationLevel="DEFERRED"):
-    """Connects to the database and returns the connection. Uses the default
-    isolation level (DEFERRED).
+    """Returns this thread's connection to the database, connecting if it
+    hasn't yet. Uses the default isolation level (DEFERRED).
     name -- DB name. This is cached until it's changed, so if the same DB is
             being accessed, just call DB()
     isolationLevel -- None for autocommit. Otherwise, either "DEFERRED",
@@ -20,17 +66,49 @@ def DB(name=None, isolationLevel="DEFERRED"):
         n = dbname
     else:
         n = dbname = name
-    db = sqlite.connect(n, timeout=10.0, isolation_level=isolationLevel, detect_types=sqlite.PARSE_DECLTYPES)
-    # allows us to select by column name instead of just by index
-    db.row_factory = sqlite.Row
+
+    conns = getattr(_local, 'conns', None)
+    if conns is None or _local.generation != _generation:
+        conns = _local.conns = {}
+        _local.generation = _generation
+
+    key = (n, isolationLevel)
+    db = conns.get(key)
+    if db is None:
+        db = _connect(n, isolationLevel)
+        _lock.acquire()
+        try:
+            _all.append(db)
+        finally:
+            _lock.release()
+        conns[key] = db
     return db
 
 def DBautocommit():
-    """Connects to the database and returns the connection. Uses the autocommit
+    """Returns this thread's connection to the database with the autocommit
     isolation level.
     """
     return DB(isolationLevel=None)
 
+def closeAll():
+    """Closes the pooled connections of all threads. They reconnect on their
+    next call to DB(). Only call this when nothing is using the DB (ie.
+    before removing the DB file).
+    """
+    global _generation
+    _lock.acquire()
+    try:
+        conns = _all[:]
+        del _all[:]
+        _generation += 1
+    finally:
+        _lock.release()
+    for db in conns:
+        try:
+            sqlite.Connection.close(db)
+        except sqlite.Error:
+            pass
+
 def commitSQLiteTransaction(con, cursor):
     """Tries to commit the transaction opened in connection 'con' and close
     the 'cursor'. If commit fails, attempts to rollback. Does nothing if
@@ -47,4 +125,4 @@ def commitSQLiteTransaction(con, cursor):
         raise e
 
     cursor.close()
-    return True
\ No newline at end of file
+    return True
@@ -1,21 +1,25 @@
 """Chained handlers and Dispatchers"""
 
 import pjs.handlers.base
+import pjs.threadpool
 import pjs.conf.conf
 import logging
+import re
 
 from pjs.conf.phases import corePhases, c2sStanzaPhases, s2sStanzaPhases
 from pjs.conf.handlers import handlers as h
 from pjs.utils import compact_traceback
+from pjs.elementtree.ElementTree import Element
 
-from pjs.queues import _runningMessages, _processingQ, resultQ
+from pjs.queues import queueMessage, resultQ
 
 class Message:
     """Defines message processing. This represents a "processing job" and
     not an xmpp message. See the design doc for information on chained handlers
     and the general execution model.
     """
-    def __init__(self, tree, conn, handlers, errorHandlers, currentPhase=None):
+    def __init__(self, tree, conn, handlers, errorHandlers, currentPhase=None,
+                 raw=None):
         """Creates but doesn't run a new processing job.
 
         tree -- an Element object containing the message.
@@ -23,8 +27,11 @@ class Message:
         handlers -- list of initialized handler objects.
         errorHandlers -- list of initialized error handler objects.
         currentPhase -- the name of the currently executing phase
+        raw -- the bytes tree was parsed from, if the parser kept them. See
+               pjs.utils.RawStanza.
         """
         self.tree = tree
+        self.raw = raw
         self.conn = conn
         self.handlers = handlers or []
         self.errorHandlers = errorHandlers or []
@@ -140,9 +147,25 @@ class Message:
 
     def _execThreadedHandler(self, handler):
         """Run a handler out of process with a callback to resume"""
-        checkFunc, initFunc = handler.handle(self.tree, self, self._lastRetVal)
-        self._handlerResumeFunc = handler.resume
-        self.conn.watch_function(checkFunc, self.resume, initFunc)
+        ret = handler.handle(self.tree, self, self._lastRetVal)
+        if isinstance(ret, pjs.threadpool.WorkFuture):
+            # resumed exactly once, when the pool picks up the result. the
+            # result is kept here rather than on the (shared) handler.
+            self._handlerResumeFunc = None
+            ret.addCallback(self._resumeFromFuture)
+        else:
+            # old-style handler that returned (checkFunc, initFunc)
+            self._handlerResumeFunc = handler.resume
+            checkFunc, initFunc = ret
+            self.conn.watch_function(checkFunc, self.resume, initFunc)
+
+    def _resumeFromFuture(self, future):
+        """WorkFuture callback for threaded handlers. A result of None
+        keeps the last return value.
+        """
+        if future.result is not None:
+            self._lastRetVal = future.result
+        self.resume()
 
     def _execLink(self):
         """Execute a single link in the chain of handlers"""
@@ -189,25 +212,160 @@ class Message:
         """Schedules 'handlerName' as the next handler to execute. Optionally,
         also schedules 'errorHandlerName' as the next error handler.
         """
-        handler = Dispatcher().getHandlerFunc(handlerName)
+        handler = Dispatcher().getHandler(handlerName)
         if handler:
-            self.handlers.insert(0, handler())
+            self.handlers.insert(0, handler)
             if errorHandlerName:
-                eHandler = Dispatcher().getHandlerFunc(errorHandlerName)
+                eHandler = Dispatcher().getHandler(errorHandlerName)
                 if eHandler:
-                    self.errorHandlers.insert(0, eHandler())
+                    self.errorHandlers.insert(0, eHandler)
 
     def setLastHandler(self, handlerName, errorHandlerName=None):
         """Schedules 'handlerName' as the last handler to execute. Optionally,
         also schedules 'errorHandlerName' as the last error handler.
         """
-        handler = Dispatcher().getHandlerFunc(handlerName)
+        handler = Dispatcher().getHandler(handlerName)
         if handler:
-            self.handlers.append(handler())
+            self.handlers.append(handler)
             if errorHandlerName:
-                eHandler = Dispatcher().getHandlerFunc(errorHandlerName)
+                eHandler = Dispatcher().getHandler(errorHandlerName)
                 if eHandler:
-                    self.errorHandlers.append(eHandler())
+                    self.errorHandlers.append(eHandler)
+
+# handler class => shared instance of it
+_handlerInstances = {}
+
+def getHandlerInstance(handlerClass):
+    """Returns the instance of handlerClass shared by all Messages. Handlers
+    are instantiated once, so they must not keep any per-stanza state.
+    """
+    handler = _handlerInstances.get(handlerClass)
+    if handler is None:
+        handler = _handlerInstances[handlerClass] = handlerClass()
+    return handler
+
+def _isChainOf(handlers, items):
+    """True if handlers are instances of the handler classes in items"""
+    if len(handlers) != len(items):
+        return False
+    for i in xrange(len(items)):
+        if handlers[i].__class__ is not items[i]['handler']:
+            return False
+    return True
+
+class _PhaseClassifier:
+    """Finds the phase whose XPath matches a stanza without running every
+    XPath. Phases whose XPath is of the form
+        {ns}tag
+        {ns}tag[@type]
+        {ns}tag[@type='value']
+    optionally followed by /{ns}childtag are indexed by the stanza's tag and
+    type attribute. Any other XPath is evaluated with find(), in its place
+    in the priority order.
+    """
+    xpathRe = re.compile(r"^(\{[^}]*\}[^[/{}]+)" +\
+                         r"(\[@type(?:='([^']*)')?\])?" +\
+                         r"(?:/(\{[^}]*\}[^[/{}]+))?$")
+
+    # stands for any type value that no XPath mentions
+    OTHER = object()
+
+    def __init__(self, phases):
+        self.phases = phases
+        self.version = phases.version
+
+        # phases in priority order as (phaseName, tag, typeMatch, child, xpath)
+        # typeMatch is None (any), True (present) or the required value.
+        # tag is None for phases that have to use find().
+        entries = []
+        # every phase with an XPath, as candidates that always use find()
+        self.unindexed = []
+        for name in phases:
+            xpath = phases[name].get('xpath')
+            if not xpath:
+                continue
+            self.unindexed.append((name, None, xpath))
+            m = self.xpathRe.match(xpath)
+            if m:
+                tag, typePred, typeVal, child = m.groups()
+                if typeVal is not None:
+                    typeMatch = typeVal
+                elif typePred:
+                    typeMatch = True
+                else:
+                    typeMatch = None
+                entries.append((name, tag, typeMatch, child, None))
+            else:
+                entries.append((name, None, None, None, xpath))
+
+        # tag => {type value/None/OTHER => [(phaseName, child, xpath), ...]}
+        self.index = {}
+        # used for tags that aren't indexed
+        self.fallback = [(e[0], None, e[4]) for e in entries if e[1] is None]
+
+        for tag in set([e[1] for e in entries if e[1] is not None]):
+            types = set([e[2] for e in entries
+                         if e[1] == tag and e[2] not in (None, True)])
+            byType = {}
+            for typeKey in list(types) + [None, self.OTHER]:
+                byType[typeKey] = [(e[0], e[3], e[4]) for e in entries
+                                   if e[1] is None or \
+                                      (e[1] == tag and \
+                                       self._typeMatches(e[2], typeKey))]
+            self.index[tag] = byType
+
+    def _typeMatches(self, typeMatch, typeKey):
+        if typeMatch is None:
+            return True
+        if typeKey is None:
+            return False
+        if typeMatch is True:
+            return True
+        return typeMatch == typeKey
+
+    def classify(self, tree):
+        """Returns the name of the first phase in priority order that
+        matches the wrapper tree, or None.
+        """
+        if len(tree) != 1:
+            # only find() can deal with several stanzas in the wrapper
+            for name, child, xpath in self.unindexed:
+                if tree.find(xpath) is not None:
+                    return name
+            return None
+        return self._classify(tree[0], tree)
+
+    def classifyStanza(self, stanza):
+        """Like classify(), but for a stanza that isn't in a wrapper. A
+        wrapper is only built if one of the candidate phases has to be
+        matched with find().
+        """
+        return self._classify(stanza, None)
+
+    def _classify(self, stanza, wrapper):
+        byType = self.index.get(stanza.tag)
+        if byType is None:
+            candidates = self.fallback
+        else:
+            type = stanza.get('type')
+            candidates = byType.get(type)
+            if candidates is None:
+                candidates = byType[self.OTHER]
+
+        for name, child, xpath in candidates:
+            if xpath is not None:
+                if wrapper is None:
+                    wrapper = Element('wrapper')
+                    wrapper.append(stanza)
+                if wrapper.find(xpath) is not None:
+                    return name
+            elif child is None:
+                return name
+            else:
+                for el in stanza:
+                    if el.tag == child:
+                        return name
+        return None
 
 class _Dispatcher(object):
     """Dispatches events in a phase to Messages for handling. This class
@@ -216,6 +374,10 @@ class _Dispatcher(object):
     def __init__(self):
         # which phase list do we scan?
         self.phasesList = corePhases
+        # built when first needed by getClassifier()
+        self._classifier = None
+        # phase name => (handlers, error handlers), see getHandlerChain()
+        self._chains = {}
 
     def dispatch(self, tree, conn, knownPhase=None):
         """Dispatch a Message object to process the stanza.
@@ -226,31 +388,37 @@ class _Dispatcher(object):
         conn -- connection that called this dispatcher.
         knownPhase -- the phase that this packet is in, if known.
         """
-        phaseName = 'default'
-        phase = self.phasesList[phaseName]
-
         if knownPhase and knownPhase in self.phasesList:
-            phase = self.phasesList[knownPhase]
             phaseName = knownPhase
         else:
-            # loop through all phases to find the one who's XPath expr matches
-            # the stanza
-            # FIXME: this is likely to be a bottleneck
-            for p in self.phasesList:
-                if 'xpath' in self.phasesList[p] and tree.find(self.phasesList[p]['xpath']) is not None:
-                    phase = self.phasesList[p]
-                    phaseName = p
-                    break
+            # find the first phase (by priority) whose XPath expr matches the
+            # stanza
+            phaseName = self.getClassifier().classify(tree)
 
-        # handlers get instantiated and loaded up into lists
-        # TODO: watch for errors during instantiation
-        # TODO: instantiate once, cache the handler and reuse
+        # we pass in tree[0] because tree is a wrapper element for XPath matches
+        self._dispatchToPhase(tree[0], conn, phaseName)
+
+    def dispatchStanza(self, stanza, conn, raw=None):
+        """Dispatch a Message object to process a stanza that isn't in a
+        wrapper. The phase is matched the same way as in dispatch(), without
+        having to build a wrapper for every stanza.
+
+        raw -- the bytes the stanza was parsed from, if they were kept.
+        """
+        self._dispatchToPhase(stanza, conn,
+                              self.getClassifier().classifyStanza(stanza), raw)
+
+    def _dispatchToPhase(self, stanza, conn, phaseName, raw=None):
+        if phaseName is None:
+            phaseName = 'default'
+        phase = self.phasesList[phaseName]
+
+        # the Message gets its own copy of the phase's handler chain, since
+        # it modifies it as it runs
         if 'handlers' in phase:
-            handlers = [item['handler']() for item in phase['handlers']]
-            if 'errorHandlers' in phase:
-                errorHandlers = [item['handler']() for item in phase['errorHandlers']]
-            else:
-                errorHandlers = []
+            handlers, errorHandlers = self.getHandlerChain(phaseName, phase)
+            handlers = list(handlers)
+            errorHandlers = list(errorHandlers)
         else:
             return
 
@@ -259,17 +427,38 @@ class _Dispatcher(object):
                                 self.__class__,)
             return
 
-        # we pass in tree[0] because tree is a wrapper element for XPath matches
-        msg = Message(tree[0], conn, handlers, errorHandlers, phaseName)
+        msg = Message(stanza, conn, handlers, errorHandlers, phaseName, raw)
 
-        if conn.id in _runningMessages:
-            # already have a message being processed for this connection
-            # so queue this one
-            _processingQ.append((conn.id, msg))
-        else:
-            # record it and run it
-            _runningMessages[conn.id] = msg
-            msg.process()
+        # runs it now, or after the messages already queued for conn
+        queueMessage(conn.id, msg)
+
+    def getClassifier(self):
+        """Returns the _PhaseClassifier for self.phasesList. It's rebuilt
+        whenever the phases are changed.
+        """
+        classifier = self._classifier
+        if classifier is None or \
+           classifier.phases is not self.phasesList or \
+           classifier.version != self.phasesList.version:
+            classifier = self._classifier = _PhaseClassifier(self.phasesList)
+        return classifier
+
+    def getHandlerChain(self, phaseName, phase):
+        """Returns the tuples of shared handler and error handler instances
+        for phase. They're built once and rebuilt only if the phase's
+        handlers are changed.
+        """
+        chains = self._chains
+        chain = chains.get(phaseName)
+        handlerItems = phase['handlers']
+        errorItems = phase.get('errorHandlers', ())
+        if chain is None or \
+           not _isChainOf(chain[0], handlerItems) or \
+           not _isChainOf(chain[1], errorItems):
+            chain = chains[phaseName] = (
+                tuple([getHandlerInstance(i['handler']) for i in handlerItems]),
+                tuple([getHandlerInstance(i['handler']) for i in errorItems]))
+        return chain
 
     def getHandlerFunc(self, handlerName):
         """Gets a reference to the handler function"""
@@ -277,6 +466,12 @@ class _Dispatcher(object):
             return h[handlerName]['handler']
         else: return None
 
+    def getHandler(self, handlerName):
+        """Gets the shared instance of the handler"""
+        if handlerName in h:
+            return getHandlerInstance(h[handlerName]['handler'])
+        else: return None
+
 _dispatcher = _Dispatcher()
 def Dispatcher(): return _dispatcher
 
@@ -284,6 +479,7 @@ class _C2SStanzaDispatcher(_Dispatcher):
     """C2S Stanza-specific dispatcher"""
 
     def __init__(self):
+        _Dispatcher.__init__(self)
         self.phasesList = c2sStanzaPhases
 
 _c2sStanzaDispatcher = _C2SStanzaDispatcher()
@@ -293,6 +489,7 @@ class _S2SStanzaDispatcher(_Dispatcher):
     """S2S Stanza-specific dispatcher"""
 
     def __init__(self):
+        _Dispatcher.__init__(self)
         self.phasesList = s2sStanzaPhases
 
 _s2sStanzaDispatcher = _S2SStanzaDispatcher()
@@ -3,13 +3,11 @@
 # license.
 
 import pjs.auth_mechanisms as mechs
-import pjs.threadpool as threadpool
 import logging
 
-from pjs.handlers.base import Handler, ThreadedHandler, poll, chainOutput
+from pjs.handlers.base import Handler, ThreadedHandler, chainOutput
 from pjs.auth_mechanisms import SASLError, IQAuthError
 from pjs.handlers.iq import bindResource
-from pjs.utils import FunctionCall
 from pjs.elementtree.ElementTree import Element, SubElement
 
 iqAuthEl = Element('iq', {'type' : 'result'})
@@ -87,16 +85,8 @@ def makeSuccess(id):
 
 class SASLAuthHandler(ThreadedHandler):
     """Handles SASL's <auth> element sent from the other side"""
-    def __init__(self):
-        # this is true when the threaded handler returns
-        self.done = False
-        # used to pass the output to the next handler
-        self.retVal = None
-        
     def handle(self, tree, msg, lastRetVal=None):
         
-        self.done = False
-        
         tpool = msg.conn.server.threadpool
         
         # the actual function executing in the thread
@@ -120,41 +110,11 @@ class SASLAuthHandler(ThreadedHandler):
                 logging.warning("[%s] Mechanism %s not implemented",
                                 self.__class__, mech)
             
-        def cb(workReq, retVal):
-            self.done = True
-            # make sure we pass the lastRetVal along
-            if retVal is None:
-                self.retVal = lastRetVal
-            else:
-                self.retVal = retVal
-            
-        req = threadpool.makeRequests(act, None, cb)
-        
-        def checkFunc():
-            # need to poll manually or the callback's never called from the pool
-            poll(tpool)
-            return self.done
-        
-        def initFunc():
-            tpool.putRequest(req[0])
-        
-        return FunctionCall(checkFunc), FunctionCall(initFunc)
-        
-    def resume(self):
-        # this is passed to the next handler
-        return self.retVal
+        return tpool.submit(act)
         
 class SASLResponseHandler(ThreadedHandler):
     """Handles SASL's <response> element sent from the other side"""
-    def __init__(self):
-        # this is true when the threaded handler returns
-        self.done = False
-        # used to pass the output to the next handler
-        self.retVal = None
-        
     def handle(self, tree, msg, lastRetVal=None):
-        self.done = False
-        
         tpool = msg.conn.server.threadpool
         
         # the actual function executing in the thread
@@ -173,28 +133,7 @@ class SASLResponseHandler(ThreadedHandler):
             else:
                 return chainOutput(lastRetVal, mech.handle(tree))
                 
-        def cb(workReq, retVal):
-            self.done = True
-            # make sure we pass the lastRetVal along
-            if retVal is None:
-                self.retVal = lastRetVal
-            else:
-                self.retVal = retVal
-            
-        req = threadpool.makeRequests(act, None, cb)
-        
-        def checkFunc():
-            # need to poll manually or the callback's never called from the pool
-            poll(tpool)
-            return self.done
-        
-        def initFunc():
-            tpool.putRequest(req[0])
-        
-        return FunctionCall(checkFunc), FunctionCall(initFunc)
-    
-    def resume(self):
-        return self.retVal
+        return tpool.submit(act)
 
 class IQAuthGetHandler(Handler):
     """Handles the old-style iq auth get request sent from the client"""
@@ -217,15 +156,7 @@ class IQAuthGetHandler(Handler):
         
 class IQAuthSetHandler(ThreadedHandler):
     """Handles the old-style iq auth set sent from the client"""
-    def __init__(self):
-        # this is true when the threaded handler returns
-        self.done = False
-        # used to pass the output to the next handler
-        self.retVal = None
-        
     def handle(self, tree, msg, lastRetVal=None):
-        self.done = False
-        
         tpool = msg.conn.server.threadpool
         
         # the actual function executing in the thread
@@ -288,28 +219,7 @@ class IQAuthSetHandler(ThreadedHandler):
             
             return chainOutput(lastRetVal, makeSuccess(id))
                 
-        def cb(workReq, retVal):
-            self.done = True
-            # make sure we pass the lastRetVal along
-            if retVal is None:
-                self.retVal = lastRetVal
-            else:
-                self.retVal = retVal
-            
-        req = threadpool.makeRequests(act, None, cb)
-        
-        def checkFunc():
-            # need to poll manually or the callback's never called from the pool
-            poll(tpool)
-            return self.done
-        
-        def initFunc():
-            tpool.putRequest(req[0])
-        
-        return FunctionCall(checkFunc), FunctionCall(initFunc)
-    
-    def resume(self):
-        return self.retVal
+        return tpool.submit(act)
         
 class SASLErrorHandler(Handler):
     def handle(self, tree, msg, lastRetVal=None):
@@ -1,5 +1,9 @@
 """Contains the basic interfaces for handlers, documentation and
 helper functions.
+
+Handlers are instantiated once and the instances are shared by all Messages,
+so they must be stateless: anything that's specific to a stanza belongs in
+local variables, on the Message or in the return value, never on self.
 """
 
 import pjs.threadpool
@@ -7,7 +11,7 @@ import pjs.threadpool
 class Handler:
     """Generic in-process handler (cannot block)"""
     def __init__(self):
-        """Will be called at server start"""
+        """Will be called once, the first time the handler is needed"""
         pass
 
     def handle(self, tree, msg, lastRetVal=None):
@@ -28,7 +32,7 @@ class ThreadedHandler:
     continue running after the thread's done.
     """
     def __init__(self):
-        """Will be called at server start"""
+        """Will be called once, the first time the handler is needed"""
         pass
 
     def handle(self, tree, msg, lastRetVal=None):
@@ -40,7 +44,14 @@ class ThreadedHandler:
                       chain being run by msg. This could be an Exception
                       object or None.
 
-        This method MUST NOT block and MUST return a tuple of two
+        This method MUST NOT block and should return the
+        pjs.threadpool.WorkFuture obtained from ThreadPool.submit(). The
+        Message resumes exactly once, when the pool's result is picked up in
+        the main thread. The result of the function that ran in the thread
+        becomes the lastRetVal for the next handler, unless it's None, in
+        which case lastRetVal is passed along unchanged.
+
+        For compatibility, it can instead return a tuple of two
         pjs.utils.FunctionCall objects. The first of the two FunctionCall
         objects is for the checking function and the second is for the
         initiating function. Neither function can block. The initiating
@@ -50,12 +61,15 @@ class ThreadedHandler:
         """
         raise NotImplementedError, 'needs to be overridden in a subclass'
     def resume(self):
-        """Called when the thread has finished running. Cannot block."""
+        """Called when the thread has finished running if handle() returned
+        the (checkFunc, initFunc) tuple. Its return value is passed to the
+        next handler. Cannot block.
+        """
         raise NotImplementedError, 'needs to be overridden in a subclass'
 
 def poll(threadpool):
-    """Polls the threadpool. ThreadedHandler's checking functions should do
-    this to make the threadpool pick up results.
+    """Polls the threadpool. This makes the threadpool pick up results and
+    fire the callbacks of their WorkFutures.
     """
     try:
         threadpool.poll()
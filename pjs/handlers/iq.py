@@ -2,14 +2,13 @@
 
 import logging
 import re
-from contextlib import closing
-import pjs.threadpool as threadpool
-from pjs.db import DB, sqlite
+from pjs.jid import invalidate
+from pjs.storage import getStorage, ConflictError
 
-from pjs.handlers.base import ThreadedHandler, Handler, chainOutput, poll
+from pjs.handlers.base import ThreadedHandler, Handler, chainOutput
 from pjs.roster import Roster
 from pjs.elementtree.ElementTree import Element, SubElement
-from pjs.utils import tostring, generateId, FunctionCall
+from pjs.utils import tostring, generateId
 from copy import deepcopy
 
 def bindResource(msg, resource):
@@ -19,22 +18,19 @@ def bindResource(msg, resource):
     data = msg.conn.data
     server = msg.conn.server
     jid = data['user']['jid']
+    resources = server.data['resources']
 
     # check if we have this resource already
-    if server.data['resources'].has_key(jid) and \
-    server.data['resources'][jid].has_key(resource):
+    if resource in resources.get(jid, ()):
         # create our own
         resource = resource + generateId()[:6]
     data['user']['resource'] = resource
 
     # record the resource in the JID object of the (JID, Connection) pair
-    # this is for local delivery lookups
     server.conns[msg.conn.id][0].resource = resource
 
-    # save the jid/resource in the server's global storage
-    if not server.data['resources'].has_key(jid):
-        server.data['resources'][jid] = {}
-    server.data['resources'][jid][resource] = msg.conn
+    # save the jid/resource in the server's index for local delivery lookups
+    resources.bind(msg.conn, jid, resource)
 
 class IQBindHandler(Handler):
     """Handles resource binding"""
@@ -81,15 +77,7 @@ class IQSessionHandler(Handler):
 
 class IQRosterGetHandler(ThreadedHandler):
     """Responds to a roster iq get request"""
-    def __init__(self):
-        # this is true when the threaded handler returns
-        self.done = False
-        # used to pass the output to the next handler
-        self.retVal = None
-
     def handle(self, tree, msg, lastRetVal=None):
-        self.done = False
-
         tpool = msg.conn.server.threadpool
 
         msg.conn.data['user']['requestedRoster'] = True
@@ -116,45 +104,52 @@ class IQRosterGetHandler(ThreadedHandler):
                                  'id' : id
                                  })
 
-            res.append(roster.getAsTree())
-            return chainOutput(lastRetVal, res)
-
-        def cb(workReq, retVal):
-            self.done = True
-            # make sure we pass the lastRetVal along
-            if retVal is None:
-                self.retVal = lastRetVal
-            else:
-                self.retVal = retVal
-
-        req = threadpool.makeRequests(act, None, cb)
-
-        def checkFunc():
-            # need to poll manually or the callback's never called from the pool
-            poll(tpool)
-            return self.done
+            # roster versioning (XEP-0237)
+            query = tree.find('{jabber:iq:roster}query')
+            ver = None
+            if query is not None:
+                ver = query.get('ver')
+            if ver is None:
+                res.append(roster.getAsTree())
+                return chainOutput(lastRetVal, res)
 
-        def initFunc():
-            tpool.putRequest(req[0])
+            msg.conn.data['user']['rosterVersioning'] = True
 
-        return FunctionCall(checkFunc), FunctionCall(initFunc)
+            changes = roster.getChanges(ver)
+            if changes is None:
+                # we don't know that version. send the whole roster.
+                query = roster.getAsTree()
+                query.set('ver', str(roster.version))
+                res.append(query)
+                return chainOutput(lastRetVal, res)
 
+            # an empty result followed by pushes of what changed since
+            retVal = chainOutput(lastRetVal, res)
+            for version, cjid, item in changes:
+                push = Element('iq', {
+                                      'to' : '/'.join([jid, resource]),
+                                      'type' : 'set',
+                                      'id' : generateId()[:10]
+                                      })
+                query = SubElement(push, 'query', {
+                                                   'xmlns' : 'jabber:iq:roster',
+                                                   'ver' : str(version)
+                                                   })
+                if item is None:
+                    SubElement(query, 'item', {
+                                               'jid' : cjid,
+                                               'subscription' : 'remove'
+                                               })
+                else:
+                    query.append(item.getAsTree())
+                retVal = chainOutput(retVal, push)
+            return retVal
 
-    def resume(self):
-        # this is passed to the next handler
-        return self.retVal
+        return tpool.submit(act)
 
 class IQRosterUpdateHandler(ThreadedHandler):
     """Responds to a roster iq set request"""
-    def __init__(self):
-        # this is true when the threaded handler returns
-        self.done = False
-        # used to pass the output to the next handler
-        self.retVal = None
-
     def handle(self, tree, msg, lastRetVal=None):
-        self.done = False
-
         tpool = msg.conn.server.threadpool
 
         # the actual function executing in the thread
@@ -246,29 +241,7 @@ class IQRosterUpdateHandler(ThreadedHandler):
 
             return chainOutput(lastRetVal, query)
 
-        def cb(workReq, retVal):
-            self.done = True
-            # make sure we pass the lastRetVal along
-            if retVal is None:
-                self.retVal = lastRetVal
-            else:
-                self.retVal = retVal
-
-        req = threadpool.makeRequests(act, None, cb)
-
-        def checkFunc():
-            # need to poll manually or the callback's never called from the pool
-            poll(tpool)
-            return self.done
-
-        def initFunc():
-            tpool.putRequest(req[0])
-
-        return FunctionCall(checkFunc), FunctionCall(initFunc)
-
-    def resume(self):
-        # this is passed to the next handler
-        return self.retVal
+        return tpool.submit(act)
 
 class RosterPushHandler(ThreadedHandler):
     """Uses the last return value from the previous handler to push a roster
@@ -282,15 +255,7 @@ class RosterPushHandler(ThreadedHandler):
       routeData['resources'] -- ref to the resource=>Connection
                                 dictionary from the c2s server for the user
     """
-    def __init__(self):
-        # this is true when the threaded handler returns
-        self.done = False
-        # used to pass the output to the next handler
-        self.retVal = None
-
     def handle(self, tree, msg, lastRetVal=None):
-        self.done = False
-
         tpool = msg.conn.server.threadpool
 
         def act():
@@ -333,11 +298,20 @@ class RosterPushHandler(ThreadedHandler):
             else:
                 jid = msg.conn.data['user']['jid']
                 resource = msg.conn.data['user']['resource']
-                resources = msg.conn.server.data['resources'][jid]
+                resources = msg.conn.server.data['resources'].get(jid, {})
+
+            # the roster version for clients that use versioning (XEP-0237)
+            version = None
 
             for res, con in resources.items():
                 # don't send the roster to clients that didn't request it
                 if con.data['user']['requestedRoster']:
+                    if con.data['user']['rosterVersioning']:
+                        if version is None:
+                            version = str(Roster(jid).getVersion())
+                        query.set('ver', version)
+                    elif 'ver' in query.attrib:
+                        del query.attrib['ver']
                     iq = Element('iq', {
                                         'to' : '%s/%s' % (jid, res),
                                         'type' : 'set',
@@ -360,29 +334,7 @@ class RosterPushHandler(ThreadedHandler):
                 iq = Element('iq', d)
                 return chainOutput(lastRetVal, iq)
 
-        def cb(workReq, retVal):
-            self.done = True
-            # make sure we pass the lastRetVal along
-            if retVal is None:
-                self.retVal = lastRetVal
-            else:
-                self.retVal = retVal
-
-        req = threadpool.makeRequests(act, None, cb)
-
-        def checkFunc():
-            # need to poll manually or the callback's never called from the pool
-            poll(tpool)
-            return self.done
-
-        def initFunc():
-            tpool.putRequest(req[0])
-
-        return FunctionCall(checkFunc), FunctionCall(initFunc)
-
-    def resume(self):
-        # this is passed to the next handler
-        return self.retVal
+        return tpool.submit(act)
 
 class IQRegisterHandler(Handler):
     """Responds to a roster iq register request"""
@@ -418,13 +370,11 @@ class IQRegisterHandler(Handler):
                     if not re.match("^[a-zA-Z0-9_.-]+$", username):
                         raise Exception('Username not accepted')
 
-                    # write to database
+                    # write to storage
                     try:
-                        con = DB()
-                        with closing(con.cursor()) as cursor:
-                            cursor.execute("INSERT INTO jids (jid, password) VALUES ('%s@%s', '%s')" %
-                                           (username, msg.conn.server.hostname, password))
-                            con.commit()
+                        jid = '%s@%s' % (username, msg.conn.server.hostname)
+                        getStorage().addAccount(jid, password)
+                        invalidate(jid)
                         res = Element('iq', {'type': 'result', 'id': id})
                         query = deepcopy(origIQ[0])
                         query.insert(0, Element('registered'))
@@ -432,14 +382,11 @@ class IQRegisterHandler(Handler):
                         return chainOutput(lastRetVal, res)
 
                     # conflict response
-                    except sqlite.IntegrityError as e:
-                        if e.message.find('column jid is not unique') >= 0:
-                            logging.warning("[%s] Username conflict in <iq>:\n%s",
-                            self.__class__, str(e), tostring(origIQ))
-                            res = get_error_tree(origIQ, 'cancel', '409', 'conflict')
-                            return chainOutput(lastRetVal, res)
-                        else:
-                            raise e
+                    except ConflictError as e:
+                        logging.warning("[%s] Username conflict '%s' in <iq>:\n%s",
+                                        self.__class__, str(e), tostring(origIQ))
+                        res = get_error_tree(origIQ, 'cancel', '409', 'conflict')
+                        return chainOutput(lastRetVal, res)
 
                 else:
                     raise Exception('IQ missing registration fields')
@@ -1,14 +1,11 @@
 """<message>-related handlers"""
 
 import logging
-import pjs.threadpool as threadpool
-from pjs.db import DB, sqlite
-from contextlib import closing
 from datetime import datetime
 
-from pjs.handlers.base import ThreadedHandler, Handler, chainOutput, poll
+from pjs.handlers.base import ThreadedHandler, Handler, chainOutput
 from pjs.elementtree.ElementTree import Element, SubElement
-from pjs.utils import FunctionCall, tostring
+from pjs.utils import tostring, RawStanza
 from pjs.roster import Roster, Subscription
 from pjs.jid import JID
 from copy import copy
@@ -31,8 +28,13 @@ class C2SMessageHandler(Handler):
                           self.__class__)
             return
 
-        stampedTree = copy(tree)
-        stampedTree.set('from', '%s/%s' % (jid, resource))
+        fromJID = '%s/%s' % (jid, resource)
+        if msg.raw is not None:
+            # pass on the bytes we got instead of reserializing the tree
+            stampedTree = RawStanza(tree, msg.raw, {'from' : fromJID})
+        else:
+            stampedTree = copy(tree)
+            stampedTree.set('from', fromJID)
 
         routeData = {
                      'to' : toJID.__str__(),
@@ -44,15 +46,7 @@ class C2SMessageHandler(Handler):
 
 class S2SMessageHandler(ThreadedHandler):
     """Handles <message>s coming in from remote servers"""
-    def __init__(self):
-        # this is true when the threaded handler returns
-        self.done = False
-        # used to pass the output to the next handler
-        self.retVal = None
-
     def handle(self, tree, msg, lastRetVal=None):
-        self.done = False
-        self.retVal = lastRetVal
         tpool = msg.conn.server.threadpool
 
         def act():
@@ -133,25 +127,26 @@ class S2SMessageHandler(ThreadedHandler):
                     if tree.get('type') == 'error':
                         return
 
-                    # write offline messages to database
-                    try:
-                        con = DB()
-                        with closing(con.cursor()) as cursor:
-                            cursor.execute("INSERT INTO offline (fromid, toid, time, content) \
-                                            VALUES (?, ?, ?, ?)",
-                                           (cjid.getNumId(), to.getNumId(), datetime.now(), tree[0].text))
-                            con.commit()
+                    # queue the offline message for the DB.
+                    # see pjs.offline.__doc__
+                    writer = msg.conn.server.launcher.offlineWriter
+                    if writer.store(cjid.getNumId(), to.getNumId(), datetime.now(), tree[0].text):
                         logging.debug("[%s] Saving offline message from %s to %s: %s" % (
                             self.__class__, cjid.getBare(), to.getBare(), tree[0].text
                         ))
                         return lastRetVal
-                    except Exception as e:
-                        logging.warning("[%s] Failed to save offline messages: %s", self.__class__, str(e))
+                    else:
+                        logging.warning("[%s] Failed to save offline message from %s to %s",
+                                        self.__class__, cjid.getBare(), to.getBare())
                         return makeServiceUnavailableError()
 
+                if msg.raw is not None:
+                    data = RawStanza(tree, msg.raw)
+                else:
+                    data = tree
                 routeData = {
                              'to' : modifiedTo,
-                             'data' : tree
+                             'data' : data
                              }
                 msg.setNextHandler('route-client')
                 return chainOutput(lastRetVal, routeData)
@@ -166,25 +161,4 @@ class S2SMessageHandler(ThreadedHandler):
                 return makeServiceUnavailableError()
 
 
-        def cb(workReq, retVal):
-            self.done = True
-            # make sure we pass the lastRetVal along
-            if retVal is None:
-                self.retVal = lastRetVal
-            else:
-                self.retVal = retVal
-
-        req = threadpool.makeRequests(act, None, cb)
-
-        def checkFunc():
-            # need to poll manually or the callback's never called from the pool
-            poll(tpool)
-            return self.done
-
-        def initFunc():
-            tpool.putRequest(req[0])
-
-        return FunctionCall(checkFunc), FunctionCall(initFunc)
-
-    def resume(self):
-        return self.retVal
\ No newline at end of file
+        return tpool.submit(act)
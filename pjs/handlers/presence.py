@@ -1,34 +1,22 @@
 """<presence>-related handlers"""
 
 import logging
-import pjs.threadpool as threadpool
-from pjs.db import DB, sqlite
-from contextlib import closing
-from datetime import datetime
 
-from pjs.handlers.base import ThreadedHandler, Handler, chainOutput, poll
+from pjs.handlers.base import ThreadedHandler, Handler, chainOutput
 from pjs.elementtree.ElementTree import Element, SubElement
-from pjs.utils import FunctionCall, tostring
+from pjs.utils import tostring, StanzaTemplate
 from pjs.roster import Roster, Subscription
 from pjs.jid import JID
+from pjs.offline import OfflineDelivery
 from copy import deepcopy
 
-# TODO: this class can be made into a regular Handler by introducing a
-# subscribers/subscriptions cache and updating it in a separate
-# ThreadedHandler (maybe for privacy lists)
+# TODO: rosters are cached now (see pjs.roster), so this class can be made
+# into a regular Handler once the offline messages are read somewhere else
 class C2SPresenceHandler(ThreadedHandler):
     """Handles plain <presence> (without type) and
     <presence type="unavailable"> sent by the clients.
     """
-    def __init__(self):
-        # this is true when the threaded handler returns
-        self.done = False
-        # used to pass the output to the next handler
-        self.retVal = None
-
     def handle(self, tree, msg, lastRetVal=None):
-        self.done = False
-        self.retVal = lastRetVal
         tpool = msg.conn.server.threadpool
 
         def act():
@@ -46,7 +34,6 @@ class C2SPresenceHandler(ThreadedHandler):
 
             probes = []
             init_rosters = []
-            offline_msgs = []
             if tree.get('to') is None and not d['user']['active']:
                 # initial presence
                 # TODO: we don't need to do it every time. we can cache the
@@ -63,15 +50,13 @@ class C2SPresenceHandler(ThreadedHandler):
                                                     % (jid, resource)
                                                  })
 
-                # TODO: replace this with a more efficient router handler
+                probeTemplate = StanzaTemplate(probeTree, 'to')
                 for cjid in cjids:
-                    probeTree.set('to', cjid)
                     probeRouteData = {
                                       'to' : cjid,
-                                      'data' : deepcopy(probeTree)
+                                      'data' : probeTemplate.fill(cjid)
                                       }
                     probes.append(probeRouteData)
-                    # they're sent first. see below
 
                 # send initial roster list to this user
                 rosterTree = Element('presence', {
@@ -79,57 +64,19 @@ class C2SPresenceHandler(ThreadedHandler):
                                                  'to' : '%s/%s' \
                                                     % (jid, resource)
                                                  })
+                rosterTemplate = StanzaTemplate(rosterTree, 'from')
                 for cjid in cjids:
-                    rosterTree.set('from', cjid)
                     rosterRouterData = {
                                            'to' : '%s/%s' % (jid, resource),
-                                           'data' : deepcopy(rosterTree)
+                                           'data' : rosterTemplate.fill(cjid)
                                        }
                     init_rosters.append(rosterRouterData)
 
-                # send offline message to this user
-                try:
-                    con = DB()
-                    result = []
-                    to_jid = JID(jid)
-                    with closing(con.cursor()) as cursor:
-                        cursor.execute("SELECT fromid, time, content FROM offline WHERE toid = %d ORDER BY time DESC" %
-                                       (to_jid.getNumId()))
-                        con.commit()
-                        result = cursor.fetchall()
-                    with closing(con.cursor()) as cursor:
-                        cursor.execute("DELETE FROM offline WHERE toid = %d" %
-                                       (to_jid.getNumId()))
-                        con.commit()
-                    for fromid, time, content in result:
-                        fromJID = JID(fromid, True).getBare()
-                        toJID = '%s/%s' % (jid, resource)
-
-                        reply = Element('message', {
-                            'to': toJID,
-                            'from': fromJID,
-                            'type': 'chat'
-                        })
-
-                        body = Element('body')
-                        body.text = content
-                        reply.append(body)
-
-                        delay = Element('delay', {
-                            'xmlns': 'urn:xmpp:delay',
-                            'from': fromJID,
-                            'stamp': time.strftime("%Y-%m-%dT%H:%M:%SZ")
-                        })
-                        reply.append(delay)
-
-                        routeData = {
-                            'to' : toJID,
-                            'data': reply
-                        }
-                        offline_msgs.append(routeData)
-                    logging.debug("[%s] Sending %d offline messages to %s", self.__class__, len(offline_msgs), to_jid.getBare())
-                except Exception as e:
-                    logging.warning("[%s] Failed to read offline messages: %s", self.__class__, str(e))
+                # send offline messages to this user a page at a time. make
+                # sure the ones still queued for the DB are in there first.
+                # see pjs.offline.__doc__
+                msg.conn.server.launcher.offlineWriter.flush()
+                OfflineDelivery(msg.conn, jid, resource, roster.uid).start()
 
                 # broadcast to other resources of this user
                 retVal = self.broadcastToOtherResources(presTree, msg, retVal, jid, resource)
@@ -150,82 +97,55 @@ class C2SPresenceHandler(ThreadedHandler):
             # lookup contacts interested in presence
             cjids = roster.getPresenceSubscribers()
 
-            # TODO: replace this with another router handler that would send
-            # it out to all cjids in a batch instead of queuing a handler
-            # for each
+            presTemplate = StanzaTemplate(presTree, 'to')
+            presRoutes = []
             for cjid in cjids:
-                presTree.set('to', cjid)
-                presRouteData = {
+                presRoutes.append({
                      'to' : cjid,
-                     'data' : deepcopy(presTree)
-                     }
-                retVal = chainOutput(retVal, presRouteData)
-                msg.setNextHandler('route-server')
-
-            # send the probes first
-            for probe in probes:
-                msg.setNextHandler('route-server')
-                retVal = chainOutput(retVal, probe)
-
-            # send initial rosters
-            for init_roster in init_rosters:
-                msg.setNextHandler('route-client')
-                retVal = chainOutput(retVal, init_roster)
-
-            # send offline messages
-            for offline_msg in offline_msgs:
-                msg.setNextHandler('route-client')
-                retVal = chainOutput(retVal, offline_msg)
+                     'data' : presTemplate.fill(cjid)
+                     })
+
+            # each list is routed by a single batch router. the last one
+            # chained runs first, so the initial rosters are sent first,
+            # then the probes and the presence.
+            for routes, router in [(presRoutes, 'route-server-batch'),
+                                   (probes, 'route-server-batch'),
+                                   (init_rosters, 'route-client-batch')]:
+                if routes:
+                    retVal = chainOutput(retVal, routes)
+                    msg.setNextHandler(router)
 
             return retVal
 
-        def cb(workReq, retVal):
-            self.done = True
-            # make sure we pass the lastRetVal along
-            if retVal is None:
-                self.retVal = lastRetVal
-            else:
-                self.retVal = retVal
-
-        req = threadpool.makeRequests(act, None, cb)
-
-        def checkFunc():
-            # need to poll manually or the callback's never called from the pool
-            poll(tpool)
-            return self.done
-
-        def initFunc():
-            tpool.putRequest(req[0])
-
-        return FunctionCall(checkFunc), FunctionCall(initFunc)
-
-    def resume(self):
-        return self.retVal
+        return tpool.submit(act)
 
     def broadcastToOtherResources(self, tree, msg, lastRetVal,
                                   jid=None, resource=None):
         """Takes in the stanza to broadcast to other resources of this
-        user and sets the next handler to route-server. Returns the
-        lastRetVal with chained route-server handlers.
+        user and sets the next handler to route-server-batch. Returns the
+        lastRetVal with the chained routes.
 
-        tree -- tree to modify with the 'to' address and send out
+        tree -- tree to send out with each resource's 'to' address
         """
         jid = jid or msg.conn.data['user']['jid']
         resource = resource or msg.conn.data['user']['resource']
 
         retVal = lastRetVal
 
-        resources = msg.conn.server.data['resources'][jid]
+        resources = msg.conn.server.data['resources'].get(jid, {})
+        template = StanzaTemplate(tree, 'to')
+        routes = []
         for r in resources:
             if r != resource:
                 otherRes = jid + '/' + r
-                tree.set('to', otherRes)
-                presRouteData = {
+                routes.append({
                      'to' : otherRes,
-                     'data' : tree
-                     }
-                retVal = chainOutput(lastRetVal, presRouteData)
-                msg.setNextHandler('route-server')
+                     'data' : template.fill(otherRes)
+                     })
+
+        if routes:
+            retVal = chainOutput(retVal, routes)
+            msg.setNextHandler('route-server-batch')
 
         return retVal
 
@@ -285,15 +205,7 @@ class S2SSubscriptionHandler(ThreadedHandler):
     """Handles subscriptions sent from servers within <presence> stanzas.
     ie. <presence> elements with types.
     """
-    def __init__(self):
-        # this is true when the threaded handler returns
-        self.done = False
-        # used to pass the output to the next handler
-        self.retVal = None
-
     def handle(self, tree, msg, lastRetVal=None):
-        self.done = False
-        self.retVal = lastRetVal
 
         tpool = msg.conn.server.threadpool
 
@@ -551,42 +463,13 @@ class S2SSubscriptionHandler(ThreadedHandler):
 
                         return chainOutput(retVal, (routeData, query))
 
-        def cb(workReq, retVal):
-            self.done = True
-            # make sure we pass the lastRetVal along
-            if retVal is None:
-                self.retVal = lastRetVal
-            else:
-                self.retVal = retVal
-
-        req = threadpool.makeRequests(act, None, cb)
-
-        def checkFunc():
-            # need to poll manually or the callback's never called from the pool
-            poll(tpool)
-            return self.done
-
-        def initFunc():
-            tpool.putRequest(req[0])
-
-        return FunctionCall(checkFunc), FunctionCall(initFunc)
-
-    def resume(self):
-        return self.retVal
+        return tpool.submit(act)
 
 class C2SSubscriptionHandler(ThreadedHandler):
     """Handles subscriptions sent from clients within <presence> stanzas.
     ie. <presence> elements with types.
     """
-    def __init__(self):
-        # this is true when the threaded handler returns
-        self.done = False
-        # used to pass the output to the next handler
-        self.retVal = None
-
     def handle(self, tree, msg, lastRetVal=None):
-        self.done = False
-        self.retVal = lastRetVal
 
         tpool = msg.conn.server.threadpool
 
@@ -844,25 +727,4 @@ class C2SSubscriptionHandler(ThreadedHandler):
 
                         return chainOutput(retVal, query)
 
-        def cb(workReq, retVal):
-            self.done = True
-            # make sure we pass the lastRetVal along
-            if retVal is None:
-                self.retVal = lastRetVal
-            else:
-                self.retVal = retVal
-
-        req = threadpool.makeRequests(act, None, cb)
-
-        def checkFunc():
-            # need to poll manually or the callback's never called from the pool
-            poll(tpool)
-            return self.done
-
-        def initFunc():
-            tpool.putRequest(req[0])
-
-        return FunctionCall(checkFunc), FunctionCall(initFunc)
-
-    def resume(self):
-        return self.retVal
\ No newline at end of file
+        return tpool.submit(act)
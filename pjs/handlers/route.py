@@ -8,6 +8,7 @@ from pjs.handlers.base import Handler, chainOutput
 from pjs.handlers.write import prepareDataForSending
 from pjs.elementtree.ElementTree import Element
 from pjs.jid import JID
+from pjs.utils import SerializedStanza
 
 class ClientRouteHandler(Handler):
     """Handles routing of data to a client on this server.
@@ -38,7 +39,7 @@ class ClientRouteHandler(Handler):
             logging.warning("[%s] No data to send", self.__class__)
             return
 
-        conns = msg.conn.server.launcher.getC2SServer().conns
+        resources = msg.conn.server.launcher.getC2SServer().data['resources']
 
         try:
             to = getRoute(data, to)
@@ -49,27 +50,18 @@ class ClientRouteHandler(Handler):
         try:
             jid = getJID(to)
         except Exception, e:
-            logging.warning("[%s] %s" + e, self.__class__, e)
+            logging.warning("[%s] %s", self.__class__, e)
             return
 
-        if jid.resource:
-            # locate the resource of this JID
-            def f(i):
-                if not conns[i][0]: return False
-                return conns[i][0] == jid
-        else:
-            # locate all active resources of this JID
-            def f(i):
-                jidConn = conns[i]
-                if not jidConn[0]: return False
-                return jidConn[0].node == jid.node and jidConn[0].domain == jid.domain
-
-        activeJids = filter(f, conns)
-        for con in activeJids:
+        # presence updates can be coalesced on slow connections
+        key = getCoalesceKey(data)
+
+        # the resource of a full JID or all bound resources of a bare one
+        for conn in resources.getConnections(jid):
             if callable(preprocessFunc):
-                conns[con][1].send(prepareDataForSending(preprocessFunc(data, conns[con][1])))
+                conn.send(prepareDataForSending(preprocessFunc(data, conn)), key)
             else:
-                conns[con][1].send(prepareDataForSending(data))
+                conn.send(prepareDataForSending(data), key)
 
 class ServerRouteHandler(Handler):
     """Handles routing of data to a client on this server.
@@ -91,7 +83,7 @@ class ServerRouteHandler(Handler):
             logging.warning("[%s] No data to send", self.__class__)
             return
 
-        s2sConns = msg.conn.server.launcher.getS2SServer().s2sConns
+        s2sConns = getS2SConns(msg, self)
         if s2sConns is None:
             return False
 
@@ -108,12 +100,13 @@ class ServerRouteHandler(Handler):
             return
 
         # do we have an existing connection to the domain?
-        if jid.domain in s2sConns:
+        conn = getOutConn(s2sConns, jid.domain)
+        if conn is not None:
             # reuse that connection
             if callable(preprocessFunc):
-                s2sConns[jid.domain][1].send(prepareDataForSending(preprocessFunc(data, s2sConns[jid.domain][1])))
+                conn.send(prepareDataForSending(preprocessFunc(data, conn)))
             else:
-                s2sConns[jid.domain][1].send(prepareDataForSending(data))
+                conn.send(prepareDataForSending(data))
         else:
             # create a new S2S connection
             # populate the dictionary for the new s2s connection creator
@@ -132,12 +125,138 @@ class ServerRouteHandler(Handler):
 
             msg.setNextHandler('new-s2s-conn')
 
+class ClientBatchRouteHandler(Handler):
+    """Routes many stanzas to clients on this server in one go. This handler
+    requires lastRetVal[-1] to be a list of routing structures as described
+    in ClientRouteHandler.__doc__. Everything for one connection is written
+    to it with a single send.
+    """
+    def handle(self, tree, msg, lastRetVal=None):
+        routes = popBatch(lastRetVal, self)
+        if not routes:
+            return
+
+        resources = msg.conn.server.launcher.getC2SServer().data['resources']
+
+        batch = _Batch()
+        for d in routes:
+            data = d.get('data')
+            if data is None:
+                logging.warning("[%s] No data to send", self.__class__)
+                continue
+
+            try:
+                jid = getJID(getRoute(data, d.get('to')))
+            except Exception, e:
+                logging.warning("[%s] %s", self.__class__, e)
+                continue
+
+            key = getCoalesceKey(data)
+            for conn in resources.getConnections(jid):
+                batch.add(conn, data, key, d.get('preprocessFunc'))
+
+        batch.send()
+
+class ServerBatchRouteHandler(Handler):
+    """Routes many stanzas to servers in one go. This handler requires
+    lastRetVal[-1] to be a list of routing structures as described in
+    ClientRouteHandler.__doc__. Everything for one domain is written to its
+    connection with a single send. Stanzas for domains we're not connected
+    to yet are passed on to route-server, once per domain.
+    """
+    def handle(self, tree, msg, lastRetVal=None):
+        routes = popBatch(lastRetVal, self)
+        if not routes:
+            return
+
+        s2sConns = getS2SConns(msg, self)
+        if s2sConns is None:
+            return False
+
+        batch = _Batch()
+        # domain => routing structure for route-server
+        unconnected = {}
+        unconnectedOrder = []
+        for d in routes:
+            data = d.get('data')
+            if data is None:
+                logging.warning("[%s] No data to send", self.__class__)
+                continue
+
+            try:
+                jid = getJID(getRoute(data, d.get('to')))
+            except Exception, e:
+                logging.warning("[%s] %s", self.__class__, e)
+                continue
+
+            preprocessFunc = d.get('preprocessFunc')
+            conn = getOutConn(s2sConns, jid.domain)
+            if conn is not None:
+                batch.add(conn, data, None, preprocessFunc)
+            elif callable(preprocessFunc):
+                # needs the connection, so it's routed on its own
+                unconnectedOrder.append(d)
+            else:
+                route = unconnected.get(jid.domain)
+                if route is None:
+                    route = unconnected[jid.domain] = {
+                                                       'to' : jid.domain,
+                                                       'data' : []
+                                                       }
+                    unconnectedOrder.append(route)
+                route['data'].append(data)
+
+        batch.send()
+
+        retVal = lastRetVal
+        for route in unconnectedOrder:
+            retVal = chainOutput(retVal, route)
+            msg.setNextHandler('route-server')
+        return retVal
+
+class _Batch:
+    """Collects the data to be sent to each connection by the batch
+    routers and sends it.
+    """
+    def __init__(self):
+        # connections in the order they were first added
+        self.conns = []
+        # id(conn) => [(unicode data, coalesceKey), ...]
+        self.chunks = {}
+
+    def add(self, conn, data, key=None, preprocessFunc=None):
+        if callable(preprocessFunc):
+            data = preprocessFunc(data, conn)
+        chunks = self.chunks.get(id(conn))
+        if chunks is None:
+            chunks = self.chunks[id(conn)] = []
+            self.conns.append(conn)
+        chunks.append((prepareDataForSending(data), key))
+
+    def send(self):
+        for conn in self.conns:
+            chunks = self.chunks[id(conn)]
+            sendMany = getattr(conn, 'sendMany', None)
+            if sendMany is not None:
+                sendMany(chunks)
+            else:
+                conn.send(u''.join([data for data, key in chunks]))
+
+def popBatch(lastRetVal, handler):
+    """Pops the list of routing structures for a batch router off lastRetVal.
+    Returns None if it's not there.
+    """
+    if not lastRetVal or not isinstance(lastRetVal[-1], list):
+        logging.warning("[%s] Passed in incorrect routing structure",
+                        handler.__class__)
+        return None
+    return lastRetVal.pop()
 
 def getRoute(data, to):
     """Figure out the route from the data"""
     if to: return to
     else:
-        if isinstance(data, Element):
+        if isinstance(data, (Element, SerializedStanza)):
             to = data.get('to')
             if not to:
                 raise Exception, "Can't extract routing information from %s" \
@@ -156,4 +275,37 @@ def getJID(to):
             jid = JID(to)
         except Exception, e:
             raise Exception, "Can't convert %s to a JID object" % to
-    return jid
\ No newline at end of file
+    return jid
+
+def getS2SConns(msg, handler):
+    """Returns the S2S server's {domain => [in, out]} connections, or None if
+    there's no S2S server to route through.
+    """
+    serv = msg.conn.server.launcher.getS2SServer()
+    if serv is None or serv.s2sConns is None:
+        logging.warning("[%s] No S2S server to route through. Dropping data.",
+                        handler.__class__)
+        return None
+    return serv.s2sConns
+
+def getOutConn(s2sConns, domain):
+    """Returns the outgoing connection to domain that data can be sent on,
+    or None if a new one has to be created. The domain can have an entry
+    with only an incoming connection, or none at all once they've closed.
+    """
+    conns = s2sConns.get(domain)
+    if conns:
+        return conns[1]
+    return None
+
+def getCoalesceKey(data):
+    """Returns the key under which data can be coalesced with later data
+    by Connection.send(), or None if it must always be delivered. Only
+    availability <presence> can be coalesced: a client only cares about the
+    latest one from each sender. Subscription-related presence can't.
+    """
+    if isinstance(data, (Element, SerializedStanza)) and \
+       data.tag.split('}')[-1] == 'presence' and \
+       data.get('type') in (None, 'unavailable'):
+        return ('presence', data.get('from'))
+    return None
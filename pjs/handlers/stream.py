@@ -4,11 +4,11 @@ negotiation etc. Auth is handled separately in auth.py.
 
 import logging
 import socket
-import pjs.threadpool as threadpool
 
-from pjs.handlers.base import Handler, ThreadedHandler, chainOutput, poll
+from pjs.handlers.base import Handler, ThreadedHandler, chainOutput
 from pjs.handlers.write import prepareDataForSending
-from pjs.utils import generateId, FunctionCall
+from pjs.utils import generateId
+from pjs.roster import evict
 from pjs.elementtree.ElementTree import Element, SubElement
 
 class InStreamInitHandler(Handler):
@@ -18,7 +18,12 @@ class InStreamInitHandler(Handler):
     def handle(self, tree, msg, lastRetVal=None):
         # Expat removes the xmlns attributes, so we save them in the parser
         # class and check them here.
-        ns = msg.conn.parser.ns
+        parser = msg.conn.parser
+        if parser is None:
+            # the connection closed and gave back its parser
+            msg.stopChain = True
+            return
+        ns = parser.ns
 
         if ns == 'jabber:client':
             streamType = 'client'
@@ -62,7 +67,12 @@ class InStreamReInitHandler(Handler):
         # is the same as when it was first sent. This can be changed if it doesn't
         # play well with some clients.
 
-        ns = msg.conn.parser.ns
+        parser = msg.conn.parser
+        if parser is None:
+            # the connection closed and gave back its parser
+            msg.stopChain = True
+            return
+        ns = parser.ns
         id = generateId()
 
         msg.conn.data['stream']['id'] = id
@@ -120,6 +130,8 @@ class FeaturesPostAuthHandler(Handler):
                    {'xmlns' : 'urn:ietf:params:xml:ns:xmpp-bind'})
         SubElement(res, 'session',
                    {'xmlns' : 'urn:ietf:params:xml:ns:xmpp-session'})
+        SubElement(res, 'ver',
+                   {'xmlns' : 'urn:xmpp:features:rosterver'})
 
         return chainOutput(lastRetVal, res)
 
@@ -129,15 +141,7 @@ class NewS2SConnHandler(ThreadedHandler):
 
     This is threaded because socket.connect will block.
     """
-    def __init__(self):
-        # this is true when the threaded handler returns
-        self.done = False
-        # used to pass the output to the next handler
-        self.retVal = None
-
     def handle(self, tree, msg, lastRetVal=None):
-        self.done = False
-        self.retVal = lastRetVal
         tpool = msg.conn.server.threadpool
 
         def act():
@@ -163,51 +167,42 @@ class NewS2SConnHandler(ThreadedHandler):
                                 self.__class__)
                 return
 
-            if local:
-                conn = serv.createLocalOutConnection(sock)
-                # if we're connecting to ourselves, we don't need the <stream>.
-                # instead just send out the outQueue
-                data = d['new-s2s-conn'].get('queue')
-                if data is not None:
-                    conn.send(prepareDataForSending(data))
-            else:
-                sOutConn = serv.createRemoteOutConnection(sock)
-
-                # copy over any queued messages to send once fully connected
-                sOutConn.outQueue.extend(d['new-s2s-conn'].setdefault('queue', []))
-
-                # register the connection with the S2S server
-                serverConns = serv.s2sConns.setdefault(d['new-s2s-conn']['hostname'], [None, None])
-                serverConns[1] = sOutConn
-
-                # send the initial stream
-                # commenting this out for now as it causes expat problems
-                sOutConn.send("<?xml version='1.0' ?>")
-                sOutConn.send("<stream:stream xmlns='jabber:server' " +\
-                              "xmlns:stream='http://etherx.jabber.org/streams' " +\
-                              "to='%s' " % d['new-s2s-conn']['hostname'] + \
-                              "version='1.0'>")
-
-        def cb(workReq, retVal):
-            self.done = True
-            # we don't return anything, but make sure we pass the
-            # lastRetVal along
-            self.retVal = lastRetVal
-
-        req = threadpool.makeRequests(act, None, cb)
-
-        def checkFunc():
-            # need to poll manually or the callback's never called from the pool
-            poll(tpool)
-            return self.done
+            # only the blocking connect happens here. The connection is
+            # created and written to from the main thread, so that the loop
+            # never sees it half-built.
+            msg.conn.server.launcher.trigger.pullTrigger(
+                                    lambda: self.register(serv, sock, d, local))
+
+        return tpool.submit(act)
+
+    def register(self, serv, sock, d, local):
+        """Creates the connection for the connected sock and sends the queued
+        data. Runs in the main thread.
+        """
+        if local:
+            conn = serv.createLocalOutConnection(sock)
+            # if we're connecting to ourselves, we don't need the <stream>.
+            # instead just send out the outQueue
+            data = d['new-s2s-conn'].get('queue')
+            if data is not None:
+                conn.send(prepareDataForSending(data))
+        else:
+            sOutConn = serv.createRemoteOutConnection(sock)
 
-        def initFunc():
-            tpool.putRequest(req[0])
+            # copy over any queued messages to send once fully connected
+            sOutConn.outQueue.extend(d['new-s2s-conn'].setdefault('queue', []))
 
-        return FunctionCall(checkFunc), FunctionCall(initFunc)
+            # register the connection with the S2S server
+            serverConns = serv.s2sConns.setdefault(d['new-s2s-conn']['hostname'], [None, None])
+            serverConns[1] = sOutConn
 
-    def resume(self):
-        return self.retVal
+            # send the initial stream
+            # commenting this out for now as it causes expat problems
+            sOutConn.send("<?xml version='1.0' ?>")
+            sOutConn.send("<stream:stream xmlns='jabber:server' " +\
+                          "xmlns:stream='http://etherx.jabber.org/streams' " +\
+                          "to='%s' " % d['new-s2s-conn']['hostname'] + \
+                          "version='1.0'>")
 
 class StreamEndHandler(Handler):
     """Handles the other side closing the stream. For clients, this sends out
@@ -253,21 +248,20 @@ class CleanUpConnHandler(Handler):
         conn = msg.conn
         data = msg.conn.data
 
+        jid = None
         if data.has_key('user'):
             jid = data['user']['jid']
-            resource = data['user']['resource']
-
-            # the connection could've been closed before binding
-            if jid and resource:
-                del msg.conn.server.data['resources'][jid][resource]
+            # the connection could've been closed before binding, in which
+            # case this does nothing
+            resources = conn.server.data['resources']
+            resources.unbind(conn)
+            if jid not in resources:
+                # that was the user's last resource
+                evict(jid)
 
         del conn.server.conns[conn.id]
 
-        try:
-            conn.parser.close()
-        except:
-            pass
-        conn.parser.resetStream()
+        conn.releaseParser()
 
         logging.debug("[%s] Closing ClientConnection with %s",
                       self.__class__, jid)
@@ -4,7 +4,7 @@ import pjs.elementtree.ElementTree as et
 import logging
 
 from pjs.handlers.base import Handler
-from pjs.utils import tostring
+from pjs.utils import tostring, SerializedStanza
 
 #TODO: do we need a handler for arbitrary binary data?
 
@@ -28,8 +28,8 @@ class WriteHandler(Handler):
 
 def prepareDataForSending(lastRetVal):
     """Converts lastRetVal into unicode data that's ready to be sent over
-    the wire. lastRetVal can be either a single unit or a list of: text, Element
-    values.
+    the wire. lastRetVal can be either a single unit or a list of: text, Element,
+    SerializedStanza values.
     """
     out = u''
 
@@ -41,6 +41,8 @@ def prepareDataForSending(lastRetVal):
         for item in lastRetVal:
             if isinstance(item, et.Element):
                 out += tostring(item)
+            elif isinstance(item, SerializedStanza):
+                out += item.tostring()
             elif isinstance(item, str):
                 out += unicode(item)
             elif isinstance(item, unicode):
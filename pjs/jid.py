@@ -1,7 +1,73 @@
 import re
-from pjs.db import DBautocommit
+import threading
+from pjs.storage import getStorage
+from pjs.utils import LRUCache
 import logging
 
+# most entries kept in each of the caches below
+maxCacheSize = 10000
+
+# bare JID => numeric ID in the storage, or -1 if it's not there
+_ids = LRUCache(maxCacheSize)
+# numeric ID => bare JID
+_jids = LRUCache(maxCacheSize)
+# bare JID => True if it's a registered user
+_exists = LRUCache(maxCacheSize)
+
+# bumped by invalidate(). A negative result (-1 or False) is only cached if
+# nothing was invalidated while it was being looked up, since the lookup may
+# have raced with the JID being created.
+_generation = 0
+# held while bumping _generation and while caching negative results
+_lock = threading.Lock()
+
+def invalidate(jid):
+    """Forgets what's cached about the bare jid (a string). Call this after
+    creating it in the storage or changing its account.
+    """
+    global _generation
+    _lock.acquire()
+    try:
+        _generation += 1
+        numId = _ids.pop(jid)
+        if numId is not None and numId != -1:
+            _jids.pop(numId)
+        _exists.pop(jid)
+    finally:
+        _lock.release()
+
+def clearCaches():
+    """Forgets everything that's cached. Call this when switching to another
+    DB or storage backend.
+    """
+    global _generation
+    _lock.acquire()
+    try:
+        _generation += 1
+        _ids.clear()
+        _jids.clear()
+        _exists.clear()
+    finally:
+        _lock.release()
+
+def _cacheNegative(cache, key, value, generation):
+    """Caches a negative result looked up when _generation was generation,
+    unless something was invalidated since.
+    """
+    _lock.acquire()
+    try:
+        if generation == _generation:
+            cache[key] = value
+    finally:
+        _lock.release()
+
+def cacheStats():
+    """Returns {cache name => (hits, misses, hit rate)} for the JID caches"""
+    return dict([(name, (cache.hits, cache.misses, cache.hitRate()))
+                 for name, cache in [('ids', _ids),
+                                     ('jids', _jids),
+                                     ('exists', _exists)]])
+
 class JID:
     """Models a JID"""
 
@@ -15,18 +81,18 @@ class JID:
         """
         if use_id:
             jid_number = jid
-            res = None
-            try:
-                c = DBautocommit().cursor()
-                c.execute("SELECT jid FROM jids WHERE id = %d" %
-                          (jid_number))
-                res = c.fetchone()
-            except:
-                logging.debug('JID: init from number failed')
-            if res and len(res) > 0:
-                jid = res[0]
-            else:
-                jid = ''
+            jid = _jids.get(jid_number)
+            if jid is None:
+                try:
+                    jid = getStorage().getJID(jid_number)
+                except:
+                    jid = None
+                    logging.debug('JID: init from number failed')
+                if jid is not None:
+                    _jids[jid_number] = jid
+                    _ids[jid] = jid_number
+                else:
+                    jid = ''
         m = JID.jidre.match(jid)
         if not m:
             raise Exception, '[JID] %s is not a proper JID' % jid
@@ -39,34 +105,41 @@ class JID:
         return '%s@%s' % (self.node, self.domain)
 
     def getNumId(self):
-        """Returns this JID's database numeric ID"""
-        res = None
+        """Returns this JID's numeric ID in the storage"""
+        bare = self.getBare()
+        numId = _ids.get(bare)
+        if numId is not None:
+            return numId
+        generation = _generation
         try:
-            c = DBautocommit().cursor()
-            c.execute("SELECT id FROM jids WHERE jid = ?",
-                      (self.getBare(),))
-            res = c.fetchone()
+            numId = getStorage().getId(bare)
         except:
             logging.debug('JID: get numeric ID failed')
-        if res and len(res) > 0:
-            return res[0]
-        else:
             return -1
+        if numId is None:
+            _cacheNegative(_ids, bare, -1, generation)
+            return -1
+        _jids[numId] = bare
+        _ids[bare] = numId
+        return numId
     
     def exists(self):
-        """Returns True if this JID exists in the DB"""
-        res = None
+        """Returns True if this JID is a registered user"""
+        bare = self.getBare()
+        exists = _exists.get(bare)
+        if exists is not None:
+            return exists
+        generation = _generation
         try:
-            c = DBautocommit().cursor()
-            c.execute("SELECT jid FROM jids WHERE jid = ? AND password != ''",
-                      (self.getBare(),))
-            res = c.fetchone()
+            exists = getStorage().isRegistered(bare)
         except:
             logging.debug('JID: check existence failed')
-        if res:
-            return True
-        else:
             return False
+        if exists:
+            _exists[bare] = True
+        else:
+            _cacheNegative(_exists, bare, False, generation)
+        return exists
         
     def __cmp__(self, other):
         assert isinstance(other, JID)
@@ -0,0 +1,97 @@
+"""Versioned schema of the DB.
+
+The schema version is kept in SQLite's user_version pragma. Every entry in
+migrations upgrades the schema by one version and migrate() runs the ones
+that a DB doesn't have yet, so existing DBs are upgraded in place. The
+statements use IF NOT EXISTS, because DBs created before there were
+migrations are at version 0 but already have some of the tables.
+
+Add new migrations at the end and don't change the ones that are there.
+"""
+
+import logging
+
+from pjs.db import DB
+
+migrations = [
+    # 1: the original tables
+    [
+     "CREATE TABLE IF NOT EXISTS jids (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,\
+                                       jid TEXT NOT NULL,\
+                                       password TEXT NOT NULL,\
+                                       UNIQUE(jid))",
+     "CREATE TABLE IF NOT EXISTS roster (userid INTEGER REFERENCES jids NOT NULL,\
+                                         contactid INTEGER REFERENCES jids NOT NULL,\
+                                         name TEXT,\
+                                         subscription INTEGER DEFAULT 0,\
+                                         PRIMARY KEY (userid, contactid)\
+                                         )",
+     "CREATE TABLE IF NOT EXISTS offline (fromid INTEGER REFERENCES jids NOT NULL,\
+                                          toid INTEGER REFERENCES jids NOT NULL,\
+                                          time TIMESTAMP,\
+                                          content TEXT\
+                                          )",
+     "CREATE TABLE IF NOT EXISTS rostergroups (groupid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,\
+                                               userid INTEGER REFERENCES jids NOT NULL,\
+                                               name TEXT NOT NULL,\
+                                               UNIQUE(userid, name)\
+                                               )",
+     "CREATE TABLE IF NOT EXISTS rostergroupitems\
+                 (groupid INTEGER REFERENCES rostergroup NOT NULL,\
+                  contactid INTEGER REFERENCES jids NOT NULL,\
+                  PRIMARY KEY (groupid, contactid))",
+    ],
+    # 2: roster versioning (see pjs.roster)
+    [
+     "CREATE TABLE IF NOT EXISTS rosterversions\
+                 (userid INTEGER PRIMARY KEY REFERENCES jids NOT NULL,\
+                  version INTEGER NOT NULL DEFAULT 0)",
+     "CREATE TABLE IF NOT EXISTS rosterchanges\
+                 (userid INTEGER REFERENCES jids NOT NULL,\
+                  contactid INTEGER REFERENCES jids NOT NULL,\
+                  version INTEGER NOT NULL,\
+                  PRIMARY KEY (userid, contactid))",
+    ],
+    # 3: indexes for offline message replay, removing contacts from groups
+    # and roster versioning. rostergroups is already indexed by userid
+    # through UNIQUE(userid, name).
+    [
+     "CREATE INDEX IF NOT EXISTS offline_toid ON offline (toid, time)",
+     "CREATE INDEX IF NOT EXISTS rostergroupitems_contactid\
+                 ON rostergroupitems (contactid)",
+     "CREATE INDEX IF NOT EXISTS rosterchanges_version\
+                 ON rosterchanges (userid, version)",
+    ],
+]
+
+def getVersion(con):
+    """Returns the schema version of the DB of connection con"""
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(name=None, version=None):
+    """Upgrades the DB to version (the latest by default), all in one
+    transaction. Returns the version the DB was at.
+    name -- DB name, as for pjs.db.DB()
+    """
+    if version is None:
+        version = len(migrations)
+
+    # DDL has to run on an autocommit connection for the transaction to
+    # hold. sqlite3 commits before it otherwise.
+    con = DB(name, isolationLevel=None)
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        current = getVersion(con)
+        for i in xrange(current, version):
+            for statement in migrations[i]:
+                con.execute(statement)
+            con.execute("PRAGMA user_version = %d" % (i + 1))
+        con.execute("COMMIT")
+    except:
+        con.execute("ROLLBACK")
+        raise
+
+    if current < version:
+        logging.info("Upgraded the DB schema from version %d to %d",
+                     current, version)
+    return current
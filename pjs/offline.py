@@ -0,0 +1,287 @@
+"""Write-behind storage and streamed delivery of offline messages.
+
+Messages for users that aren't online used to be stored with one INSERT
+and one commit each, so a burst of messages to an offline user cost a sync
+of the DB per message. The launcher now owns an OfflineWriter: a thread
+that collects the messages handed to it and writes them in one transaction
+per batch, whenever batchSize messages are waiting or flushInterval seconds
+after the first one came in.
+
+By default store() returns right away and a failed batch is only logged.
+In durable mode store() waits for the batch to be committed and tells the
+caller whether it was. Either way, call flush() before reading the offline
+messages so that nothing is missed, and stop() on shutdown.
+
+When the user comes online, an OfflineDelivery pages through their offline
+messages. Each page is read and serialized in a worker thread, written
+out from the main thread and deleted from the storage once it's been
+handed to the connection and the connection has drained, so only a page is
+ever held in memory no matter how many messages are waiting.
+"""
+
+import logging
+import threading
+
+import pjs.async.core as asyncore
+
+from pjs.elementtree.ElementTree import Element, SubElement
+from pjs.storage import getStorage
+from pjs.utils import tostring
+
+class OfflineWriter(threading.Thread):
+    """The thread that stores offline messages. See the module docs."""
+
+    def __init__(self, flushInterval=0.1, batchSize=100, durable=False):
+        threading.Thread.__init__(self, name='OfflineWriter')
+        self.setDaemon(True)
+
+        self.flushInterval = flushInterval
+        self.batchSize = batchSize
+        self.durable = durable
+
+        self._cond = threading.Condition()
+        # [(row or None, Event or None)]. Entries with no row are flush()
+        # markers.
+        self._queue = []
+        # True while the thread is writing a batch it took off the queue
+        self._writing = False
+        # flush() was called; write without waiting for more messages
+        self._flushNow = False
+        self._stopping = False
+
+        self.batches = 0
+        self.written = 0
+
+    def store(self, fromid, toid, time, content):
+        """Queues a message for storage. Returns True, unless it's in
+        durable mode and the message couldn't be committed.
+        """
+        row = (fromid, toid, time, content)
+        if self.durable:
+            waiter = threading.Event()
+        else:
+            waiter = None
+
+        self._cond.acquire()
+        try:
+            if self._stopping:
+                # too late for the thread. write it out here.
+                stopped = True
+            else:
+                stopped = False
+                self._queue.append((row, waiter))
+                # wake up the thread to start the flush interval or to
+                # write a full batch
+                if len(self._queue) == 1 or len(self._queue) >= self.batchSize:
+                    self._cond.notify()
+        finally:
+            self._cond.release()
+
+        if stopped:
+            return self._write([(row, None)])
+        if waiter is not None:
+            waiter.wait()
+            return waiter.ok
+        return True
+
+    def flush(self):
+        """Blocks until the messages that were queued before the call are
+        written. Returns right away if there aren't any.
+        """
+        self._cond.acquire()
+        try:
+            if self._stopping or (not self._queue and not self._writing):
+                return
+            done = threading.Event()
+            self._queue.append((None, done))
+            self._flushNow = True
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        done.wait()
+
+    def stop(self):
+        """Writes out what's queued and ends the thread"""
+        self._cond.acquire()
+        try:
+            self._stopping = True
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        if self.isAlive():
+            self.join()
+
+    def run(self):
+        cond = self._cond
+        while True:
+            cond.acquire()
+            try:
+                while not self._queue and not self._stopping:
+                    cond.wait()
+                if not self._stopping and not self._flushNow \
+                   and len(self._queue) < self.batchSize:
+                    # give the batch some time to fill up
+                    cond.wait(self.flushInterval)
+                batch = self._queue
+                self._queue = []
+                self._flushNow = False
+                self._writing = bool(batch)
+                stopping = self._stopping
+            finally:
+                cond.release()
+
+            if batch:
+                self._write(batch)
+                cond.acquire()
+                self._writing = False
+                cond.release()
+            elif stopping:
+                break
+
+    def _write(self, batch):
+        """Inserts the rows of batch in one transaction and wakes up whoever
+        is waiting on them. Returns True if they were committed.
+        """
+        rows = [row for row, waiter in batch if row is not None]
+        ok = True
+        if rows:
+            try:
+                getStorage().storeOfflineMessages(rows)
+                self.batches += 1
+                self.written += len(rows)
+            except Exception, e:
+                ok = False
+                logging.warning("[%s] Failed to save %d offline messages: %s",
+                                self.__class__, len(rows), str(e))
+
+        for row, waiter in batch:
+            if waiter is not None:
+                waiter.ok = ok
+                waiter.set()
+        return ok
+
+# toid => OfflineDelivery, for the users whose messages are being delivered
+_deliveries = {}
+_deliveriesLock = threading.Lock()
+
+class OfflineDelivery:
+    """Sends the offline messages of user toid to the connection of one of
+    their resources, pageSize messages at a time. Only one delivery per user
+    runs at a time; the messages go to the resource that started it. If the
+    connection goes away, the messages that weren't sent stay stored for
+    the next time.
+    """
+    pageSize = 100
+    # how often to check if the connection has drained, in seconds
+    drainInterval = 0.05
+
+    def __init__(self, conn, jid, resource, toid):
+        self.conn = conn
+        self.to = '%s/%s' % (jid, resource)
+        self.toid = toid
+        self.sent = 0
+
+    def start(self):
+        """Starts delivering from the current (worker) thread. Returns False
+        if another resource is already getting the messages.
+        """
+        _deliveriesLock.acquire()
+        try:
+            if self.toid in _deliveries:
+                return False
+            _deliveries[self.toid] = self
+        finally:
+            _deliveriesLock.release()
+        self._nextPage()
+        return True
+
+    def _finish(self):
+        _deliveriesLock.acquire()
+        try:
+            if _deliveries.get(self.toid) is self:
+                del _deliveries[self.toid]
+        finally:
+            _deliveriesLock.release()
+        logging.debug("[%s] Sent %d offline messages to %s",
+                      self.__class__, self.sent, self.to)
+
+    def _closed(self):
+        conn = self.conn
+        return conn.disconnecting or conn.id not in conn.server.conns
+
+    def _nextPage(self):
+        """Reads and serializes the next page and hands it to the main
+        thread. Runs in a worker thread.
+        """
+        try:
+            rows = getStorage().getOfflineMessages(self.toid, self.pageSize)
+        except Exception, e:
+            logging.warning("[%s] Failed to read offline messages: %s",
+                            self.__class__, str(e))
+            self._finish()
+            return
+
+        if not rows:
+            self._finish()
+            return
+
+        out = []
+        for key, fromJID, time, content in rows:
+            if fromJID is None:
+                # the sender is gone. just drop the message.
+                continue
+            message = Element('message', {
+                                          'to' : self.to,
+                                          'from' : fromJID,
+                                          'type' : 'chat'
+                                          })
+            SubElement(message, 'body').text = content
+            delay = SubElement(message, 'delay', {
+                                                  'xmlns' : 'urn:xmpp:delay',
+                                                  'from' : fromJID
+                                                  })
+            if time is not None:
+                delay.set('stamp', time.strftime("%Y-%m-%dT%H:%M:%SZ"))
+            out.append(tostring(message))
+
+        keys = [row[0] for row in rows]
+        data = u''.join(out)
+        self.conn.server.launcher.trigger.pullTrigger(
+                                    lambda: self._send(data, keys, len(out)))
+
+    def _send(self, data, keys, count):
+        """Writes out a page. Runs in the main thread."""
+        if self._closed():
+            self._finish()
+            return
+        if data:
+            self.conn.send(data)
+        self.sent += count
+        self._whenDrained(keys)
+
+    def _whenDrained(self, keys):
+        """Goes on with the next page once the connection is under its low
+        watermark. Runs in the main thread.
+        """
+        if self._closed():
+            self._finish()
+            return
+        if len(self.conn.out_buffer) > self.conn.lowWatermark:
+            # not the connection's call_later(), since closing the connection
+            # would cancel it and the delivery would never finish
+            asyncore.call_later(self.drainInterval, self._whenDrained, keys)
+            return
+        self.conn.server.threadpool.submit(self._deletePage, [keys])
+
+    def _deletePage(self, keys):
+        """Deletes the messages of a page that's been sent and reads the
+        next one. Runs in a worker thread.
+        """
+        try:
+            getStorage().deleteOfflineMessages(keys)
+        except Exception, e:
+            logging.warning("[%s] Failed to delete offline messages: %s",
+                            self.__class__, str(e))
+            self._finish()
+            return
+        self._nextPage()
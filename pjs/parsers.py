@@ -6,16 +6,50 @@ import logging
 
 from xml.parsers import expat
 from pjs.events import Dispatcher, C2SStanzaDispatcher, S2SStanzaDispatcher
-from copy import deepcopy
+from pjs.utils import tagEndRe
 
 # some quirks mode constants
 QUIRK_MISSING_NEW_STREAM = 'missing-new-stream'
 
+# most parsers kept around for reuse
+maxPoolSize = 256
+
+# parsers that are ready to be reused
+_pool = []
+
+# parser pool counters
+poolStats = {
+             'hits' : 0, # borrowed a parser from the pool
+             'misses' : 0, # had to create a new parser
+             'returned' : 0, # parsers put back in the pool
+             'discarded' : 0, # parsers dropped because the pool was full
+             }
+
 def borrow_parser(conn):
-    """Borrow a parser from a pool of parsers"""
-    # TODO: implement the pool. For now just return a new parser
-    logging.debug("Creating a new parser for %s", conn.id)
-    return IncrStreamParser(conn)
+    """Borrow a parser from a pool of parsers. Give it back with
+    return_parser() when the connection is closed.
+    """
+    try:
+        parser = _pool.pop()
+    except IndexError:
+        poolStats['misses'] += 1
+        logging.debug("Creating a new parser for %s", conn.id)
+        return IncrStreamParser(conn)
+
+    poolStats['hits'] += 1
+    parser.conn = conn
+    return parser
+
+def return_parser(parser):
+    """Return a parser borrowed with borrow_parser() to the pool. The
+    parser must not be used by its connection after this.
+    """
+    parser.release()
+    if len(_pool) < maxPoolSize:
+        poolStats['returned'] += 1
+        _pool.append(parser)
+    else:
+        poolStats['discarded'] += 1
 
 class IncrStreamParser:
     """Pass it unicode strings via feed() and it will buffer the input until it
@@ -27,9 +61,20 @@ class IncrStreamParser:
     c2sStanzaRe = re.compile(r'{jabber:client}(iq|message|presence)\b', re.U | re.I)
     s2sStanzaRe = re.compile(r'{jabber:server}(iq|message|presence)\b', re.U | re.I)
 
+    # the _names memo is kept when the parser is reused, unless it gets this
+    # big (ie. from a client making up element names)
+    maxNames = 1024
+
+    # stanzas bigger than this don't have their raw bytes kept
+    maxRawSize = 65536
+
     def __init__(self, conn=None):
         self.conn = conn
         self._parser = None
+        # True once the expat parser has seen any data
+        self._fed = False
+        # name memo cache. from ElementTree
+        self._names = {}
 
         self._exception = None # set this on quirky input
 
@@ -41,34 +86,65 @@ class IncrStreamParser:
         self.depth = 0
         self.tree = None
         self.stream = None # this is the main <stream> et.Element
-        # name memo cache. from ElementTree
-        self._names = {} # clear because this parser may be reused for another
-                         # stream if it's picked up from a pool later
+        # patterns matching the use of ns prefixes declared on <stream>.
+        # Stanzas that use them can't be passed on as raw bytes, since the
+        # declarations would be missing.
+        self._streamPrefixes = []
+        # the names memo doesn't depend on the stream, so it's kept
+        if len(self._names) > self.maxNames:
+            self._names = {}
         # ns of the stream: jabber:client / jabber:server
         self.ns = None
         self._exception = None
 
     def resetParser(self):
-        """Reset the parser and the tree."""
-        # '}' is a ns-separator used in ET 1.3alpha. We want to duplicate its
-        # behaviour here because its TreeBuilder doesn't prefix node names
-        # with their namespace. Asking expat to do so will remove the xmlns
-        # attrs from elements it encounters.
-        if self._parser:
-            del self._parser # get rid of circular references
-        self._parser = expat.ParserCreate(None, '}')
-        self._parser.StartElementHandler = self.handle_start
-        self._parser.EndElementHandler = self.handle_end
-        self._parser.CharacterDataHandler = self.handle_text
-        self._parser.StartNamespaceDeclHandler = self.handle_ns
-        self._parser.buffer_text = 1 # single handle_text call per text node
-        self._parser.returns_unicode = 1 # handler funcs get unicode from expat
+        """Reset the parser and the tree. expat parsers can't be reset, so a
+        new one is created, unless the current one hasn't been fed yet.
+        """
+        if self._parser is not None and not self._fed:
+            self.enable()
+        else:
+            if self._parser is not None:
+                # stop events from the old parser if we're being reset from
+                # within one of its handlers
+                self.disable()
+                self._parser = None # get rid of circular references
+            # '}' is a ns-separator used in ET 1.3alpha. We want to duplicate
+            # its behaviour here because its TreeBuilder doesn't prefix node
+            # names with their namespace. Asking expat to do so will remove
+            # the xmlns attrs from elements it encounters.
+            self._parser = expat.ParserCreate(None, '}')
+            self._parser.StartElementHandler = self.handle_start
+            self._parser.EndElementHandler = self.handle_end
+            self._parser.CharacterDataHandler = self.handle_text
+            self._parser.StartNamespaceDeclHandler = self.handle_ns
+            self._parser.buffer_text = 1 # single handle_text call per text node
+            self._parser.returns_unicode = 1 # handler funcs get unicode from expat
+            self._fed = False
 
         # need to reset parts of the stream as well to ensure correct parsing
         self.depth = 0
         self.tree = None
         self._exception = None
 
+        # bytes fed to the expat parser that may still be needed for the raw
+        # copy of a stanza, and the offset in the stream where they start
+        self._raw = ''
+        self._rawOffset = 0
+        # stream offset of the current stanza's start tag, if its raw bytes
+        # are being kept. See handle_start().
+        self._stanzaStart = None
+        # True if the stanza being started declares its own default ns
+        self._stanzaNs = False
+
+    def release(self):
+        """Detach the parser from its connection and get it ready to parse a
+        new stream. Used when returning the parser to the pool.
+        """
+        self.conn = None
+        self.resetStream()
+        self.resetParser()
+
     def disable(self):
         """Turns off all handlers for this parser, so data will be parsed,
         but not processed in any way. This is useful for faking input into
@@ -102,12 +178,18 @@ class IncrStreamParser:
 #            logging.debug("[%s] For connection %s parser got: %s",
 #                          self.__class__, self.conn.id, data)
 
+        self._fed = True
+        if isinstance(data, unicode):
+            self._raw += data.encode('utf-8')
+        else:
+            self._raw += data
         try:
             self._parser.Parse(data, 0)
         except Exception, e:
             logging.warning("[%s] Parser died with %s: %s",
                             self.__class__, e, data)
             # TODO: complain about invalid XML and close connection
+        self._trimRaw()
 
         if self._exception:
             # the parser found quirky input
@@ -147,8 +229,10 @@ class IncrStreamParser:
 
     def close(self):
         """CLose the stream of XML data"""
-        self._parser.Parse("", 1) # end of data
-        del self._parser # get rid of circular references
+        self._fed = True
+        parser = self._parser
+        self._parser = None # get rid of circular references
+        parser.Parse("", 1) # end of data
 
         self.resetStream()
 
@@ -194,6 +278,16 @@ class IncrStreamParser:
             # handle stanzas, build tree
             self.tree = et.TreeBuilder()
             self.tree.start(self._fixname(tag), attrs)
+
+            # remember where the stanza starts in the stream, so that its
+            # bytes can be passed on without reserializing the tree. Not if
+            # it declares its own default ns, which may not be right for
+            # the stream it's passed on to.
+            start = self._parser.CurrentByteIndex
+            if self._stanzaNs:
+                self._stanzaNs = False
+            elif start >= self._rawOffset:
+                self._stanzaStart = start
         else:
             # depth > 2. continue to build tree
             assert(self.tree)
@@ -223,17 +317,16 @@ class IncrStreamParser:
             # TODO: handle errors
             self.tree = self.tree.close()
 
-            # pass the el to the dispatcher for processing having wrapped it
-            # in the <stream> element first
-            tree = deepcopy(self.stream)
-            tree.append(self.tree)
+            raw = self._stanzaRaw()
 
+            # pass the el to the dispatcher for processing. It matches the
+            # phases on the bare stanza, so there's no need to wrap it.
             if IncrStreamParser.c2sStanzaRe.search(self.tree.tag):
-                C2SStanzaDispatcher().dispatch(tree, self.conn)
+                C2SStanzaDispatcher().dispatchStanza(self.tree, self.conn, raw)
             elif IncrStreamParser.s2sStanzaRe.search(self.tree.tag):
-                S2SStanzaDispatcher().dispatch(tree, self.conn)
+                S2SStanzaDispatcher().dispatchStanza(self.tree, self.conn, raw)
             else:
-                Dispatcher().dispatch(tree, self.conn)
+                Dispatcher().dispatchStanza(self.tree, self.conn, raw)
         else:
             # depth > 1. continue to build tree
             assert(self.tree)
@@ -258,12 +351,63 @@ class IncrStreamParser:
             self.tree.data(text)
 
     def handle_ns(self, prefix, uri):
+        # declarations are reported before the start tag they're on
+        if self.depth == 0:
+            if prefix:
+                # the raw bytes are searched for it after '<' or any
+                # whitespace, which can come before an attribute
+                self._streamPrefixes.append(re.compile(r'[<\s]%s:' %
+                                                       re.escape(prefix.encode('utf-8'))))
+        elif self.depth == 1 and not prefix:
+            self._stanzaNs = True
+
         if not self.ns:
             if uri == 'jabber:client':
                 self.ns = 'jabber:client'
             elif uri == 'jabber:server':
                 self.ns = 'jabber:server'
 
+    def _stanzaRaw(self):
+        """Returns the bytes of the stanza that just ended, or None if they
+        weren't kept. Called from handle_end().
+        """
+        start = self._stanzaStart
+        if start is None:
+            return None
+        self._stanzaStart = None
+
+        raw = self._raw
+        start -= self._rawOffset
+        # the end tag starts at the current index. For an empty element it's
+        # the end of the start tag instead.
+        end = self._parser.CurrentByteIndex - self._rawOffset
+        tagEnd = tagEndRe.match(raw, start).end()
+        if raw[tagEnd - 2] != '/':
+            tagEnd = raw.index('>', end) + 1
+        raw = raw[start:tagEnd]
+
+        for prefixRe in self._streamPrefixes:
+            if prefixRe.search(raw):
+                return None
+        return raw
+
+    def _trimRaw(self):
+        """Drops the bytes that no stanza will need from the raw buffer"""
+        if self._stanzaStart is not None:
+            keep = self._stanzaStart - self._rawOffset
+            if len(self._raw) - keep > self.maxRawSize:
+                # too big. Let the tree be serialized instead.
+                self._stanzaStart = None
+        if self._stanzaStart is None:
+            # the only thing worth keeping is a tag that's been cut off,
+            # in case it starts a stanza. Tags don't contain '<'.
+            keep = self._raw.rfind('<')
+            if keep == -1:
+                keep = len(self._raw)
+        if keep:
+            self._raw = self._raw[keep:]
+            self._rawOffset += keep
+
     def _fixname(self, key):
         """Formats the node name according to ElementTree's convention of
         {ns}tag.
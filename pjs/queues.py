@@ -1,15 +1,13 @@
 """Contains various message processing queue stuff. events.py is the
 primary intended user. This guarantees that for any connection only one
 Message is being processed at a time.
-
-The launcher should already be initialized and set in pjs.conf.conf in order
-to import this.
 """
 
-import pjs.conf.conf
+import pjs.registry
 import socket
 import logging
 from Queue import Queue, Empty
+from collections import deque
 from pjs.handlers.write import prepareDataForSending
 
 # Variables that the dispatchers share
@@ -19,44 +17,49 @@ from pjs.handlers.write import prepareDataForSending
 # connID => Message
 _runningMessages = {}
 
-# The queue of messages waiting to be processed. A message is queued if
+# Messages waiting to be processed, per connection. A message is queued if
 # there is another message for the same connection currently being
 # processed.
-# We're not using a deque here because we occasionally need to traverse
-# the queue (worst case -- all but last connections already have messages
-# being processed for them, till the end)
-# [(connId, Message), ...]
-_processingQ = []
+# connId => deque([Message, ...])
+_waitingMessages = {}
+
+# Connections whose running Message has finished and that have Messages
+# waiting. Each connection is in here at most once.
+# deque([connId, ...])
+_readyConns = deque()
 
 # When messages finish running, they leave the result on this queue.
 # out should be a string.
 # [(connId, out), ...]
 resultQ = Queue()
 
-def _runMessages():
-    """Runs all queued Messages that don't have an existing Message
-    being processed for the same connection id.
+def queueMessage(connId, msg):
+    """Runs msg right away if there's no Message being processed for
+    connId. Otherwise, queues it to run after the ones already queued.
     """
-    # I don't care about the Pythonic Way, if it doesn't allow me to remove
-    # items from a list I'm iterating on. We could iterate on a copy of the
-    # list, but I'm afraid that the processingQ could get pretty large with
-    # lots of connections.
-    i = 0
-    l = len(_processingQ)
-    connId, msg = (None, None)
-    while i < l:
-        connId, msg = _processingQ[i]
-        if connId not in _runningMessages:
-            _runningMessages[connId] = msg
-            # moved to runningMessages, so delete from processingQ
-            del _processingQ[i]
-            i -= 1
-            l -= 1
+    if connId in _runningMessages:
+        waiting = _waitingMessages.get(connId)
+        if waiting is None:
+            waiting = _waitingMessages[connId] = deque()
+        waiting.append(msg)
+    else:
+        _runningMessages[connId] = msg
+        msg.process()
 
-            msg.process()
-        i += 1
-
-activeServers = pjs.conf.conf.launcher.servers
+def _runMessages():
+    """Runs the next queued Message for every connection whose previous
+    Message has finished.
+    """
+    while _readyConns:
+        connId = _readyConns.popleft()
+        waiting = _waitingMessages.get(connId)
+        if not waiting:
+            continue
+        msg = waiting.popleft()
+        if not waiting:
+            del _waitingMessages[connId]
+        _runningMessages[connId] = msg
+        msg.process()
 
 def pickupResults():
     """Picks up any available results on the result queue and calls
@@ -65,15 +68,13 @@ def pickupResults():
     while 1:
         try:
             connId, out = resultQ.get_nowait()
-            for server in activeServers:
-                if connId in server.conns:
-                    conn = server.conns[connId][1]
-                    # FIXME: this should be prevented. test socket for writability
-                    try:
-                        conn.send(prepareDataForSending(out))
-                    except socket.error, e:
-                        logging.warning("[pickupResults] Socket error: %s", e)
-                    break
+            conn = pjs.registry.getConnection(connId)
+            if conn is not None:
+                # FIXME: this should be prevented. test socket for writability
+                try:
+                    conn.send(prepareDataForSending(out))
+                except socket.error, e:
+                    logging.warning("[pickupResults] Socket error: %s", e)
             else:
                 # message left on the queue for a connection that's no longer
                 # there, so we log it and move on
@@ -81,6 +82,8 @@ def pickupResults():
                                 " Connection object. Dropping result from queue.", connId)
             resultQ.task_done()
             del _runningMessages[connId]
+            if connId in _waitingMessages:
+                _readyConns.append(connId)
         except Empty:
             break
 
@@ -0,0 +1,109 @@
+"""Process-wide registry of connections by connection id.
+
+Every server keeps its connections in a ConnectionMap, which mirrors its
+entries in here along with a reference back to the server. This lets
+anything that only has a connection id (ie. the results of finished
+Messages) find the connection with a single lookup, no matter how many
+servers there are.
+
+The C2S server also keeps a ResourceIndex of the bound resources, so that
+finding the connections to deliver to is a lookup by JID.
+"""
+
+# connId => (Server, Connection)
+_connections = {}
+
+def lookup(connId):
+    """Returns the (server, connection) pair for connId or None if there's
+    no such connection.
+    """
+    return _connections.get(connId)
+
+def getConnection(connId):
+    """Returns the connection for connId or None"""
+    entry = _connections.get(connId)
+    if entry is not None:
+        return entry[1]
+
+class ConnectionMap(dict):
+    """The conns dict of a Server: {connId => (JID, Connection)}. Adding
+    and removing connections also updates the process-wide registry.
+    """
+    def __init__(self, server):
+        dict.__init__(self)
+        self.server = server
+
+    def __setitem__(self, connId, value):
+        dict.__setitem__(self, connId, value)
+        _connections[connId] = (self.server, value[1])
+
+    def __delitem__(self, connId):
+        dict.__delitem__(self, connId)
+        self._unregister(connId)
+
+    def pop(self, connId, *default):
+        value = dict.pop(self, connId, *default)
+        self._unregister(connId)
+        return value
+
+    def setdefault(self, connId, value=None):
+        if connId not in self:
+            self[connId] = value
+        return self[connId]
+
+    def update(self, *args, **kwargs):
+        for connId, value in dict(*args, **kwargs).iteritems():
+            self[connId] = value
+
+    def clear(self):
+        for connId in self.keys():
+            self._unregister(connId)
+        dict.clear(self)
+
+    def _unregister(self, connId):
+        entry = _connections.get(connId)
+        if entry is not None and entry[0] is self.server:
+            del _connections[connId]
+
+class ResourceIndex(dict):
+    """The bound resources of a C2S server's users:
+    {bare JID => {resource => Connection}}. It's the C2S server's
+    data['resources']. Only change it with bind() and unbind().
+    """
+    def __init__(self):
+        dict.__init__(self)
+        # connId => (bare JID, resource)
+        self._bindings = {}
+
+    def bind(self, conn, jid, resource):
+        """Records that conn has bound resource of the bare jid"""
+        self.unbind(conn)
+        self.setdefault(jid, {})[resource] = conn
+        self._bindings[conn.id] = (jid, resource)
+
+    def unbind(self, conn):
+        """Forgets conn's resource, if it bound one"""
+        binding = self._bindings.pop(conn.id, None)
+        if binding is None:
+            return
+        jid, resource = binding
+        resources = self.get(jid)
+        if resources is not None:
+            if resources.get(resource) is conn:
+                del resources[resource]
+            if not resources:
+                del self[jid]
+
+    def getConnections(self, jid):
+        """Returns the connections to deliver to for a JID object: the one of
+        the resource for a full JID, or all of them for a bare JID.
+        """
+        resources = self.get(jid.getBare())
+        if not resources:
+            return []
+        if jid.resource:
+            conn = resources.get(jid.resource)
+            if conn is None:
+                return []
+            return [conn]
+        return resources.values()
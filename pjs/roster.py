@@ -1,35 +1,153 @@
-"""Models a roster"""
+"""Models a roster
+
+Rosters are cached in memory. A user's whole roster is read from the
+storage (see pjs.storage) the first time it's needed (usually at login) and
+after that the Roster methods answer from the cache, so presence can be
+handled without going to the storage. The methods that change the roster
+write to the storage and then update the cache. A cached roster is evicted
+when the user's last resource disconnects (see CleanUpConnHandler) or when
+there are more than maxCachedRosters.
+
+Rosters are versioned for XEP-0237. Every change increments the user's
+version, and the storage remembers the last version each contact was
+changed in. getChanges() uses it to tell a reconnecting client only about
+the contacts that changed since the version it has.
+"""
 
 import logging
+import threading
 
 from pjs.elementtree.ElementTree import Element, SubElement
-from pjs.db import DB, DBautocommit, commitSQLiteTransaction
+from pjs.jid import JID, invalidate
+from pjs.storage import getStorage
+from pjs.utils import LRUCache
+
+# most rosters kept in the cache
+maxCachedRosters = 10000
+
+# bare JID => _CachedRoster
+_cache = LRUCache(maxCachedRosters)
+# bare JID => the last version this process changed the roster to. Loads
+# that read an older version than this aren't cached.
+_written = LRUCache(maxCachedRosters)
+# held while reading or changing the cached rosters. Never held during
+# storage I/O, so users don't wait on each other's writes.
+_lock = threading.Lock()
+
+def evict(jid):
+    """Drops the cached roster of the bare jid (a string), if there is one"""
+    _lock.acquire()
+    try:
+        _cache.pop(jid)
+    finally:
+        _lock.release()
+
+def clearCache():
+    """Drops all the cached rosters. Call this when switching to another DB
+    or storage backend.
+    """
+    _lock.acquire()
+    try:
+        _cache.clear()
+        _written.clear()
+    finally:
+        _lock.release()
+
+class _CachedRoster:
+    """A user's whole roster as it is in the storage, including the contacts
+    that aren't sent in roster gets, and its version.
+    """
+    def __init__(self, uid):
+        self.uid = uid
+        self.version = 0
+        # contact id => RosterItem
+        self.items = {}
+        # contact's bare JID => contact id
+        self.ids = {}
+
+    def load(self):
+        """Reads the roster from the storage"""
+        self.version, items = getStorage().getRoster(self.uid)
+        for cid, cjid, name, sub, groups in items:
+            self.items[cid] = RosterItem(cjid, name, sub, groups, cid)
+            self.ids[cjid] = cid
+
+    def getContactJIDs(self, subscriptions):
+        """Returns the JIDs of the contacts with one of the subscriptions"""
+        return [item.jid for item in self.items.itervalues()
+                if item.subscription in subscriptions]
 
 class Roster:
     def __init__(self, jid):
         """Initializes the roster object, but does not fetch any
-        roster-specific data from the DB. It checks if the jid
-        exists in the roster and raises an exception if it doesn't.
+        roster-specific data from the storage. It checks if the jid
+        exists in the storage and raises an exception if it doesn't.
 
         jid -- textual representation of a bare JID.
         """
         self.items = {}
         self.jid = jid
+        self.version = None
 
-        con = DBautocommit()
-        c = con.cursor()
         # get our own id
-        c.execute("SELECT id FROM jids WHERE jid = ?", (self.jid,))
-        res = c.fetchone()
-        if res is None:
-            raise Exception, "No record of this JID in the DB"
+        self.uid = JID(jid).getNumId()
+        if self.uid == -1:
+            raise Exception, "No record of this JID in the storage"
+
+    def _getCached(self):
+        """Returns the _CachedRoster for this user, loading it if it's not
+        cached. Call without _lock held, and hold it while reading the
+        returned roster.
+        """
+        cached = _cache.get(self.jid)
+        if cached is not None:
+            return cached
+
+        loaded = _CachedRoster(self.uid)
+        loaded.load()
 
-        self.uid = res[0]
+        _lock.acquire()
+        try:
+            cached = _cache.get(self.jid)
+            if cached is not None and cached.version >= loaded.version:
+                # someone else got there first
+                return cached
+            written = _written.get(self.jid)
+            if written is None or loaded.version >= written:
+                _cache[self.jid] = loaded
+            # else a change was applied while we were loading, so what we
+            # have is already stale. Don't keep it.
+        finally:
+            _lock.release()
+        return loaded
+
+    def _changed(self, version, apply):
+        """Records that the storage changed the roster to version and calls
+        apply(cached roster) to make the same change in the cache, if the
+        roster's cached. If the cached roster isn't at the previous version,
+        a change was missed or is being applied out of order, so the roster
+        is evicted and read again the next time.
+        """
+        self.version = version
+        _lock.acquire()
+        try:
+            if version > _written.get(self.jid, 0):
+                _written[self.jid] = version
+            cached = _cache.get(self.jid)
+            if cached is None:
+                return
+            if cached.version != version - 1:
+                _cache.pop(self.jid)
+                return
+            apply(cached)
+            cached.version = version
+        finally:
+            _lock.release()
 
     def addItem(self, contactId, rosterItem):
         """Adds a RosterItem for the contactId in this roster.
 
-        contactId -- integer id of the contact in the DB.
+        contactId -- integer id of the contact in the storage.
         rosterItem -- RosterItem object.
         """
         self.items[contactId] = rosterItem
@@ -37,7 +155,7 @@ class Roster:
     def addGroup(self, contactId, group):
         """Adds a <group> entry for contactId in this roster.
 
-        contactId -- integer id of the contact in the DB.
+        contactId -- integer id of the contact in the storage.
         group -- group name.
         """
         try:
@@ -53,38 +171,24 @@ class Roster:
         False otherwise.
         If includeGroups is True, groups are added to the RosterItem as well.
         """
-        con = DBautocommit()
-        c = con.cursor()
-
-        c.execute("SELECT roster.contactid, roster.name, roster.subscription\
-                   FROM roster\
-                       JOIN jids ON jids.id = roster.contactid\
-                   WHERE userid = ? AND jids.jid = ?", (self.uid, cjid))
-        res = c.fetchone()
-        if res:
-            cid = res[0]
-            name = res[1]
-            sub = res[2]
-        else:
-            c.close()
-            return False
-
-        if includeGroups:
-            # get the groups
-            c.execute("SELECT rgs.name\
-                       FROM rostergroups AS rgs\
-                           JOIN rostergroupitems AS rgi ON rgi.groupid = rgs.groupid\
-                       WHERE rgs.userid = ? AND rgi.contactid = ?", (self.uid, cid))
-            groups = [group['name'] for group in c]
-
-            return RosterItem(cjid, name, sub, groups, cid)
-        else:
-
-            return RosterItem(cjid, name, sub, id=cid)
+        cached = self._getCached()
+        _lock.acquire()
+        try:
+            cid = cached.ids.get(cjid)
+            if cid is None:
+                return False
+            item = cached.items[cid]
+            if includeGroups:
+                return RosterItem(cjid, item.name, item.subscription,
+                                  list(item.groups), cid)
+            else:
+                return RosterItem(cjid, item.name, item.subscription, id=cid)
+        finally:
+            _lock.release()
 
     def updateContact(self, cjid, groups=None, name=None, subscriptionId=None):
         """Adds or updates a contact in this user's roster. Returns the
-        contact's id in the DB.
+        contact's id in the storage.
         groups can be None, which means that all groups are to be removed
         Otherwise, groups is a list of groups the contact belongs to.
         """
@@ -92,136 +196,54 @@ class Roster:
         name = name or ''
         groups = groups or []
 
-        con = DB()
-        c = con.cursor()
-
-        # check if this is an update to an existing roster entry
-        c.execute("SELECT cjids.id cid \
-                   FROM roster\
-                   JOIN jids AS cjids ON cjids.id = roster.contactid\
-                   JOIN jids AS ujids ON ujids.id = roster.userid\
-                   WHERE ujids.jid = ? AND cjids.jid = ?", (self.jid, cjid))
-        res = c.fetchone()
-        if res:
-            # this is an update
-            # we update the subscription if it's given to us; o/w
-            # just update the name
-            cid = res[0]
-            if subscriptionId:
-                c.execute("UPDATE roster SET name = ?, subscription = ?\
-                           WHERE contactid = ?",
-                          (name, cid, subscriptionId))
-            else:
-                c.execute("UPDATE roster SET name = ?\
-                           WHERE contactid = ?",
-                          (name, cid))
-        else:
-            # this is a new roster entry
+        cid, version, newJID = getStorage().updateContact(self.uid, cjid,
+                                                          name, groups,
+                                                          subscriptionId)
+        if newJID:
+            invalidate(cjid)
 
-            # check if the contact JID already exists in our DB
-            c.execute("SELECT id FROM jids WHERE jid = ?", (cjid,))
-            res = c.fetchone()
-            if res:
-                cid = res[0]
+        def apply(cached):
+            item = cached.items.get(cid)
+            if item is None:
+                sub = subscriptionId or Subscription.NONE
             else:
-                # create new JID entry
-                res = c.execute("INSERT INTO jids\
-                                 (jid, password)\
-                                 VALUES\
-                                 (?, '')", (cjid,))
-                cid = res.lastrowid
-
-            c.execute("INSERT INTO roster\
-                       (userid, contactid, name, subscription)\
-                       VALUES\
-                       (?, ?, ?, ?)",
-                       (self.uid, cid, name,
-                        subscriptionId or Subscription.NONE))
-
-
-        # UPDATE GROUPS
-        # remove all group mappings for this contact and recreate
-        # them, since it's easier than figuring out what changed
-        c.execute("DELETE FROM rostergroupitems\
-                   WHERE contactid = ? AND groupid IN\
-                   (SELECT groupid FROM rostergroups WHERE\
-                       userid = ?)", (cid, self.uid))
-        for groupName in groups:
-            # get the group id
-            c.execute("SELECT groupid\
-                       FROM rostergroups\
-                       WHERE userid = ? AND name = ?", (self.uid, groupName))
-            res = c.fetchone()
-            if res:
-                gid = res[0]
-            else:
-                # need to create the group
-                res = c.execute("INSERT INTO rostergroups\
-                                 (userid, name)\
-                                 VALUES\
-                                 (?, ?)", (self.uid, groupName))
-                gid = res.lastrowid
-
-            c.execute("INSERT INTO rostergroupitems\
-                       (groupid, contactid)\
-                       VALUES\
-                       (?, ?)", (gid, cid))
-
-        commitSQLiteTransaction(con, c)
+                sub = subscriptionId or item.subscription
+            cached.items[cid] = RosterItem(cjid, name, sub, list(groups), cid)
+            cached.ids[cjid] = cid
+        self._changed(version, apply)
 
         return cid
 
     def removeContact(self, cjid):
         """Removes the contact from this user's roster. Returns the contact's
-        id in the DB.
+        id in the storage.
 
         cjid -- bare JID or the contact as a string.
         """
-        con = DB()
-        c = con.cursor()
-
-        # get the contact's id
-        c.execute("SELECT jids.id\
-                   FROM roster\
-                   JOIN jids ON roster.contactid = jids.id\
-                   WHERE roster.userid = ? AND jids.jid = ?", (self.uid, cjid))
-        res = c.fetchone()
-        if res:
-            cid = res[0]
-        else:
+        res = getStorage().removeContact(self.uid, cjid)
+        if res is None:
             logging.info("[%s] Contact %s does not exist in roster of %s",
                          self.__class__, cjid, self.jid)
-            commitSQLiteTransaction(con, c)
-            con.close()
             return False
+        cid, version = res
 
-        # delete the contact from all groups it's in for this user
-        c.execute("DELETE FROM rostergroupitems\
-                   WHERE rostergroupitems.groupid IN (\
-                       SELECT rgs.groupid FROM rostergroups AS rgs\
-                       JOIN rostergroupitems AS rgi ON rgi.groupid = rgs.groupid\
-                       WHERE rgs.userid = ?\
-                    ) AND rostergroupitems.contactid = ?", (self.uid, cid))
-
-        # now delete the roster entry
-        c.execute("DELETE FROM roster\
-                   WHERE userid = ? AND contactid = ?", (self.uid, cid))
-
-        commitSQLiteTransaction(con, c)
+        def apply(cached):
+            cached.items.pop(cid, None)
+            cached.ids.pop(cjid, None)
+        self._changed(version, apply)
 
         return cid
 
     def getSubscription(self, cid):
         """Returns the subscription id of this user's contact with id cid"""
-        con = DBautocommit()
-        c = con.cursor()
-        c.execute("SELECT subscription FROM roster\
-                   WHERE userid = ? AND contactid = ?", (self.uid, cid))
-        res = c.fetchone()
-        if res:
-            sub = res[0]
-
-            return sub
+        cached = self._getCached()
+        _lock.acquire()
+        try:
+            item = cached.items.get(cid)
+        finally:
+            _lock.release()
+        if item is not None:
+            return item.subscription
         else:
             raise Exception, "No such contact in roster"
 
@@ -230,26 +252,32 @@ class Roster:
         contact with ID cid to sub, which is an id retrieved via the
         Subscription class.
         """
-        con = DB()
-        c = con.cursor()
-        c.execute("UPDATE roster SET subscription = ?\
-                   WHERE userid = ? AND contactid = ?", (sub, self.uid, cid))
-        commitSQLiteTransaction(con, c)
+        version = getStorage().setSubscription(self.uid, cid, sub)
+        if version is None:
+            # no such contact
+            return
+
+        def apply(cached):
+            item = cached.items.get(cid)
+            if item is not None:
+                item.subscription = sub
+        self._changed(version, apply)
 
     def getSubPrimaryName(self, cid):
         """Gets the primary name of a subscription for this user and this
         contact suitable for including in the subscription attribute of a
         roster's item element.
         """
-        con = DBautocommit()
-        c = con.cursor()
-        c.execute("SELECT subscription FROM roster\
-                       WHERE roster.userid = ? AND roster.contactid = ?", (self.uid, cid))
-        res = c.fetchone()
-        if res is None:
+        cached = self._getCached()
+        _lock.acquire()
+        try:
+            item = cached.items.get(cid)
+        finally:
+            _lock.release()
+        if item is None:
             sub = 'none'
         else:
-            sub = Subscription.getPrimaryNameFromState(res[0])
+            sub = Subscription.getPrimaryNameFromState(item.subscription)
 
         return sub
 
@@ -257,75 +285,89 @@ class Roster:
         """Returns a list of JIDs of contacts of this user who are interested
         in the user's presence info (from/both).
         """
-        con = DBautocommit()
-        c = con.cursor()
-        c.execute("SELECT jids.jid\
-                   FROM roster\
-                   JOIN jids ON jids.id = roster.contactid\
-                   WHERE roster.userid = ? AND\
-                       roster.subscription IN (?, ?, ?)",
-                       (self.uid, Subscription.FROM,
-                        Subscription.FROM_PENDING_OUT, Subscription.BOTH))
-        jids = []
-        res = c.fetchall()
-        for row in res:
-            jids.append(row[0])
-
-        return jids
+        cached = self._getCached()
+        _lock.acquire()
+        try:
+            return cached.getContactJIDs((Subscription.FROM,
+                                          Subscription.FROM_PENDING_OUT,
+                                          Subscription.BOTH))
+        finally:
+            _lock.release()
 
     def getPresenceSubscriptions(self):
         """Returns a list of JIDs of contacts of this user to whom the user
         is subscribed (to/both).
         """
-        con = DBautocommit()
-        c = con.cursor()
-        c.execute("SELECT jids.jid\
-                   FROM roster\
-                   JOIN jids ON jids.id = roster.contactid\
-                   WHERE roster.userid = ? AND\
-                       roster.subscription IN (?, ?, ?)",
-                       (self.uid, Subscription.TO,
-                        Subscription.TO_PENDING_IN, Subscription.BOTH))
-        jids = []
-        res = c.fetchall()
-        for row in res:
-            jids.append(row[0])
-
-        return jids
+        cached = self._getCached()
+        _lock.acquire()
+        try:
+            return cached.getContactJIDs((Subscription.TO,
+                                          Subscription.TO_PENDING_IN,
+                                          Subscription.BOTH))
+        finally:
+            _lock.release()
 
     def loadRoster(self):
         """Loads the roster for this JID. Must be used before calling
-        getAsTree().
+        getAsTree(). version is set to the version of the roster that was
+        loaded.
         """
-        con = DB()
-        c = con.cursor()
-        # get the contactid, name and subscriptions
-        c.execute("SELECT roster.contactid, roster.name,\
-                          roster.subscription,\
-                          contactjids.jid cjid\
-                   FROM roster\
-                       JOIN jids AS userjids ON roster.userid = userjids.id\
-                       JOIN jids AS contactjids ON roster.contactid = contactjids.id\
-                   WHERE userjids.jid = ? AND\
-                       roster.subscription != ?",
-                       (self.jid, Subscription.NONE_PENDING_IN))
-
-        self.items = {}
-        for row in c:
-            self.addItem(row['contactid'],
-                         RosterItem(row['cjid'], row['name'], row['subscription']))
+        cached = self._getCached()
+        _lock.acquire()
+        try:
+            self.items = {}
+            for cid, item in cached.items.iteritems():
+                if item.subscription != Subscription.NONE_PENDING_IN:
+                    self.addItem(cid, RosterItem(item.jid, item.name,
+                                                 item.subscription,
+                                                 list(item.groups), cid))
+            self.version = cached.version
+        finally:
+            _lock.release()
+
+    def getVersion(self):
+        """Returns the current version of the roster"""
+        return self._getCached().version
+
+    def getChanges(self, version):
+        """Returns the changes to the roster after version (the string a
+        client sent in the ver attribute) as a list of
+        (version, cjid, RosterItem) in the order they were made. The
+        RosterItem is None for contacts that were removed or that aren't
+        sent in roster gets. Returns None if version isn't one of ours, in
+        which case the client needs the whole roster.
+        """
+        try:
+            version = int(version)
+        except (TypeError, ValueError):
+            return None
 
-        # get the groups now for each cid
-        c.execute("SELECT rgi.contactid, rgs.name\
-                   FROM rostergroups AS rgs\
-                       JOIN rostergroupitems AS rgi ON rgi.groupid = rgs.groupid\
-                       JOIN jids ON rgs.userid = jids.id\
-                   WHERE jids.jid = ?", (self.jid,))
+        cached = self._getCached()
+        current = cached.version
+        if version < 0 or version > current:
+            return None
+        if version == current:
+            return []
 
-        for row in c:
-            self.addGroup(row['contactid'], row['name'])
+        rows = getStorage().getRosterChanges(self.uid, version)
 
-        commitSQLiteTransaction(con, c)
+        _lock.acquire()
+        try:
+            changes = []
+            for ver, cjid in rows:
+                item = None
+                cid = cached.ids.get(cjid)
+                if cid is not None:
+                    item = cached.items[cid]
+                    if item.subscription == Subscription.NONE_PENDING_IN:
+                        item = None
+                    else:
+                        item = RosterItem(cjid, item.name, item.subscription,
+                                          list(item.groups), cid)
+                changes.append((ver, cjid, item))
+            return changes
+        finally:
+            _lock.release()
 
     def getAsTree(self):
         """Returns the roster Element tree starting from <query>. Call
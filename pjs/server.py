@@ -9,6 +9,7 @@ from pjs.connection import Connection, ClientConnection, \
                            ServerInConnection, ServerOutConnection, \
                            LocalServerInConnection, LocalServerOutConnection
 from pjs.async.core import dispatcher
+from pjs.registry import ConnectionMap, ResourceIndex
 from pjs.utils import SynchronizedDict
 
 class Server(dispatcher):
@@ -30,10 +31,11 @@ class Server(dispatcher):
         self.launcher = launcher
         # maintains a mapping of connection ids to connections
         # this includes both c2s and s2s connections
-        # used by dispatchers to look up connections
+        # used by dispatchers to look up connections. the entries are also
+        # recorded in pjs.registry
         # {connId => (JID, Connection)}
         #self.conns = SynchronizedDict()
-        self.conns = {}
+        self.conns = ConnectionMap(self)
 
         self.ip = ip
         self.hostname = ip
@@ -92,7 +94,7 @@ class C2SServer(Server):
         """Creates a C2S server. See Server.__doc__"""
         Server.__init__(self, ip, port, launcher)
 
-        self.data['resources'] = {}
+        self.data['resources'] = ResourceIndex()
 #        example:
 #        self.data['resources']['tro@localhost'] = {
 #                                                   'resource' : <Connection obj>
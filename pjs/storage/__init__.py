@@ -0,0 +1,37 @@
+"""Storage of accounts, rosters and offline messages.
+
+Everything that reads or writes them goes through the backend returned by
+getStorage(), which is a pjs.storage.base.Storage. SQLiteStorage, on top of
+pjs.db, is the default. MemoryStorage keeps everything in dicts, for tests
+and for benchmarking the handlers without disk I/O.
+"""
+
+from pjs.storage.base import Storage, StorageError, ConflictError
+
+_storage = None
+
+def getStorage():
+    """Returns the backend in use, creating the default one if there isn't
+    one yet.
+    """
+    global _storage
+    if _storage is None:
+        from pjs.storage.sqlitestorage import SQLiteStorage
+        _storage = SQLiteStorage()
+    return _storage
+
+def setStorage(storage):
+    """Makes storage the backend in use and clears the JID and roster caches
+    that sit in front of it. Returns the one that was. Only call this when
+    nothing is using the storage (ie. before the server starts).
+    """
+    # these import us
+    from pjs.jid import clearCaches
+    from pjs.roster import clearCache
+
+    global _storage
+    old = _storage
+    _storage = storage
+    clearCaches()
+    clearCache()
+    return old
@@ -0,0 +1,107 @@
+"""The interface of storage backends"""
+
+class StorageError(Exception):
+    """A backend couldn't do what it was asked"""
+    pass
+
+class ConflictError(StorageError):
+    """The account being created already exists"""
+    pass
+
+class Storage:
+    """Stores accounts, rosters and offline messages.
+
+    Every JID the server knows about has a numeric id, whether it's a user
+    with an account or only someone's contact. Users are the JIDs with a
+    non-empty password. JIDs are bare JIDs as strings.
+
+    Every method is one transaction: it either does all of what it's asked
+    or raises and does nothing. The methods are called from the main thread
+    and from the worker threads, so they must be thread-safe. Nothing
+    returned may be shared with the backend's own data.
+    """
+
+    # accounts
+
+    def getId(self, jid):
+        """Returns the numeric id of jid or None if it's not known"""
+        raise NotImplementedError, 'needs to be overridden in a subclass'
+
+    def getJID(self, id):
+        """Returns the JID with the numeric id or None"""
+        raise NotImplementedError, 'needs to be overridden in a subclass'
+
+    def getPassword(self, jid):
+        """Returns the password of jid or None if it's not known. The
+        password is empty for JIDs that don't have an account.
+        """
+        raise NotImplementedError, 'needs to be overridden in a subclass'
+
+    def isRegistered(self, jid):
+        """Returns True if jid has an account"""
+        raise NotImplementedError, 'needs to be overridden in a subclass'
+
+    def addAccount(self, jid, password):
+        """Creates an account. Returns its numeric id. Raises ConflictError
+        if jid is already known.
+        """
+        raise NotImplementedError, 'needs to be overridden in a subclass'
+
+    # rosters
+
+    def getRoster(self, uid):
+        """Returns the whole roster of user uid as (version, items), where
+        items is a list of (contact id, contact JID, name, subscription id,
+        list of group names).
+        """
+        raise NotImplementedError, 'needs to be overridden in a subclass'
+
+    def updateContact(self, uid, cjid, name, groups, subscription=None):
+        """Adds cjid to user uid's roster or updates it if it's there. The
+        contact's groups are replaced with groups. subscription is left as
+        it is when it's None (or Subscription.NONE for new contacts).
+        Increments the roster's version.
+        Returns (contact id, new version, whether cjid wasn't known before).
+        """
+        raise NotImplementedError, 'needs to be overridden in a subclass'
+
+    def removeContact(self, uid, cjid):
+        """Removes cjid from user uid's roster and increments its version.
+        Returns (contact id, new version) or None if cjid isn't in the
+        roster.
+        """
+        raise NotImplementedError, 'needs to be overridden in a subclass'
+
+    def setSubscription(self, uid, cid, subscription):
+        """Sets the subscription of user uid to contact cid and increments
+        the roster's version. Returns the new version or None if cid isn't
+        in the roster.
+        """
+        raise NotImplementedError, 'needs to be overridden in a subclass'
+
+    def getRosterChanges(self, uid, version):
+        """Returns the contacts of user uid's roster that changed after
+        version as a list of (version, contact JID), oldest first. Only the
+        last change of each contact is kept.
+        """
+        raise NotImplementedError, 'needs to be overridden in a subclass'
+
+    # offline messages
+
+    def storeOfflineMessages(self, messages):
+        """Stores a list of offline messages, given as
+        (sender id, recipient id, time, content).
+        """
+        raise NotImplementedError, 'needs to be overridden in a subclass'
+
+    def getOfflineMessages(self, toid, limit):
+        """Returns up to limit of the oldest offline messages of user toid as
+        a list of (key, sender JID, time, content). The sender JID is None if
+        the sender isn't known anymore. The keys are for
+        deleteOfflineMessages().
+        """
+        raise NotImplementedError, 'needs to be overridden in a subclass'
+
+    def deleteOfflineMessages(self, keys):
+        """Deletes the offline messages with the keys"""
+        raise NotImplementedError, 'needs to be overridden in a subclass'
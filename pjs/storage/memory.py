@@ -0,0 +1,204 @@
+"""A storage backend that keeps everything in memory. It's gone when the
+process exits. Meant for tests and for benchmarking the handlers without
+disk I/O.
+"""
+
+import threading
+
+from pjs.roster import Subscription
+from pjs.storage.base import Storage, StorageError, ConflictError
+
+class MemoryStorage(Storage):
+    """Keeps everything in dicts, guarded by one lock"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+
+        # JID => [id, password]
+        self._accounts = {}
+        # id => JID
+        self._jids = {}
+        self._lastId = 0
+
+        # uid => {contact id => [name, subscription, groups]}
+        self._rosters = {}
+        # uid => version
+        self._versions = {}
+        # uid => {contact id => version it last changed in}
+        self._changes = {}
+
+        # toid => [(time, key, fromid, content)]
+        self._offline = {}
+        # key => toid
+        self._offlineKeys = {}
+        self._lastKey = 0
+
+    # accounts
+
+    def getId(self, jid):
+        self._lock.acquire()
+        try:
+            account = self._accounts.get(jid)
+            if account is not None:
+                return account[0]
+        finally:
+            self._lock.release()
+
+    def getJID(self, id):
+        self._lock.acquire()
+        try:
+            return self._jids.get(id)
+        finally:
+            self._lock.release()
+
+    def getPassword(self, jid):
+        self._lock.acquire()
+        try:
+            account = self._accounts.get(jid)
+            if account is not None:
+                return account[1]
+        finally:
+            self._lock.release()
+
+    def isRegistered(self, jid):
+        return bool(self.getPassword(jid))
+
+    def addAccount(self, jid, password):
+        if password is None:
+            raise StorageError, 'No password for %s' % jid
+        self._lock.acquire()
+        try:
+            if jid in self._accounts:
+                raise ConflictError, '%s already exists' % jid
+            return self._addJID(jid, password)
+        finally:
+            self._lock.release()
+
+    def _addJID(self, jid, password):
+        """Call with _lock held"""
+        self._lastId += 1
+        self._accounts[jid] = [self._lastId, password]
+        self._jids[self._lastId] = jid
+        return self._lastId
+
+    # rosters
+
+    def getRoster(self, uid):
+        self._lock.acquire()
+        try:
+            items = [(cid, self._jids[cid], name, sub, list(groups))
+                     for cid, (name, sub, groups)
+                     in self._rosters.get(uid, {}).iteritems()]
+            return self._versions.get(uid, 0), items
+        finally:
+            self._lock.release()
+
+    def _logChange(self, uid, cid):
+        """Call with _lock held"""
+        version = self._versions.get(uid, 0) + 1
+        self._versions[uid] = version
+        self._changes.setdefault(uid, {})[cid] = version
+        return version
+
+    def updateContact(self, uid, cjid, name, groups, subscription=None):
+        self._lock.acquire()
+        try:
+            newJID = False
+            account = self._accounts.get(cjid)
+            if account is None:
+                cid = self._addJID(cjid, '')
+                newJID = True
+            else:
+                cid = account[0]
+
+            roster = self._rosters.setdefault(uid, {})
+            item = roster.get(cid)
+            if item is None:
+                roster[cid] = [name, subscription or Subscription.NONE,
+                               list(groups)]
+            else:
+                item[0] = name
+                if subscription:
+                    item[1] = subscription
+                item[2] = list(groups)
+
+            return cid, self._logChange(uid, cid), newJID
+        finally:
+            self._lock.release()
+
+    def removeContact(self, uid, cjid):
+        self._lock.acquire()
+        try:
+            account = self._accounts.get(cjid)
+            roster = self._rosters.get(uid, {})
+            if account is None or account[0] not in roster:
+                return None
+            cid = account[0]
+            del roster[cid]
+            return cid, self._logChange(uid, cid)
+        finally:
+            self._lock.release()
+
+    def setSubscription(self, uid, cid, subscription):
+        self._lock.acquire()
+        try:
+            item = self._rosters.get(uid, {}).get(cid)
+            if item is None:
+                return None
+            item[1] = subscription
+            return self._logChange(uid, cid)
+        finally:
+            self._lock.release()
+
+    def getRosterChanges(self, uid, version):
+        self._lock.acquire()
+        try:
+            changes = [(ver, self._jids[cid])
+                       for cid, ver in self._changes.get(uid, {}).iteritems()
+                       if ver > version]
+        finally:
+            self._lock.release()
+        changes.sort()
+        return changes
+
+    # offline messages
+
+    def storeOfflineMessages(self, messages):
+        self._lock.acquire()
+        try:
+            for fromid, toid, time, content in messages:
+                self._lastKey += 1
+                self._offline.setdefault(toid, []).append((time, self._lastKey,
+                                                           fromid, content))
+                self._offlineKeys[self._lastKey] = toid
+        finally:
+            self._lock.release()
+
+    def getOfflineMessages(self, toid, limit):
+        self._lock.acquire()
+        try:
+            messages = self._offline.get(toid, [])
+            # they're usually stored in order already
+            messages.sort()
+            return [(key, self._jids.get(fromid), time, content)
+                    for time, key, fromid, content in messages[:limit]]
+        finally:
+            self._lock.release()
+
+    def deleteOfflineMessages(self, keys):
+        self._lock.acquire()
+        try:
+            byUser = {}
+            for key in keys:
+                toid = self._offlineKeys.pop(key, None)
+                if toid is not None:
+                    byUser.setdefault(toid, set()).add(key)
+            for toid, userKeys in byUser.iteritems():
+                messages = [m for m in self._offline[toid]
+                            if m[1] not in userKeys]
+                if messages:
+                    self._offline[toid] = messages
+                else:
+                    del self._offline[toid]
+        finally:
+            self._lock.release()
@@ -0,0 +1,299 @@
+"""The default storage backend, on top of pjs.db. See pjs.migrations for
+the schema.
+"""
+
+from pjs.db import DB, DBautocommit, commitSQLiteTransaction, sqlite
+from pjs.roster import Subscription
+from pjs.storage.base import Storage, ConflictError
+
+class SQLiteStorage(Storage):
+    """Keeps everything in the SQLite DB of pjs.db. Uses the DB name that
+    pjs.db has at the time of each call.
+    """
+
+    def _read(self, sql, args):
+        """Returns the first row of a query or None"""
+        c = DBautocommit().cursor()
+        try:
+            c.execute(sql, args)
+            return c.fetchone()
+        finally:
+            c.close()
+
+    def _transaction(self, func, *args):
+        """Runs func(cursor, *args) in a transaction and commits it. Rolls
+        back if func raises. Returns what func returned.
+        """
+        con = DB()
+        c = con.cursor()
+        try:
+            ret = func(c, *args)
+        except:
+            try:
+                con.rollback()
+            except: pass
+            c.close()
+            raise
+        commitSQLiteTransaction(con, c)
+        return ret
+
+    # accounts
+
+    def getId(self, jid):
+        res = self._read("SELECT id FROM jids WHERE jid = ?", (jid,))
+        if res:
+            return res[0]
+
+    def getJID(self, id):
+        res = self._read("SELECT jid FROM jids WHERE id = ?", (id,))
+        if res:
+            return res[0]
+
+    def getPassword(self, jid):
+        res = self._read("SELECT password FROM jids WHERE jid = ?", (jid,))
+        if res:
+            return res[0]
+
+    def isRegistered(self, jid):
+        res = self._read("SELECT id FROM jids WHERE jid = ? AND password != ''",
+                         (jid,))
+        return bool(res)
+
+    def addAccount(self, jid, password):
+        return self._transaction(self._addAccount, jid, password)
+
+    def _addAccount(self, c, jid, password):
+        c.execute("SELECT id FROM jids WHERE jid = ?", (jid,))
+        if c.fetchone():
+            raise ConflictError, '%s already exists' % jid
+        try:
+            c.execute("INSERT INTO jids (jid, password) VALUES (?, ?)",
+                      (jid, password))
+        except sqlite.IntegrityError, e:
+            if e.message.find('NOT NULL') >= 0:
+                raise
+            # someone else created it since the SELECT
+            raise ConflictError, '%s already exists' % jid
+        return c.lastrowid
+
+    # rosters
+
+    def getRoster(self, uid):
+        c = DBautocommit().cursor()
+        try:
+            # in one read transaction, so that the items and the version come
+            # from the same snapshot. Otherwise a change made between the
+            # SELECTs could be missing from a roster with its version.
+            c.execute("BEGIN")
+            try:
+                c.execute("SELECT roster.contactid, roster.name,\
+                                  roster.subscription,\
+                                  jids.jid cjid\
+                           FROM roster\
+                               JOIN jids ON roster.contactid = jids.id\
+                           WHERE roster.userid = ?", (uid,))
+                items = {}
+                for row in c:
+                    items[row['contactid']] = (row['contactid'], row['cjid'],
+                                               row['name'], row['subscription'],
+                                               [])
+
+                c.execute("SELECT rgi.contactid, rgs.name\
+                           FROM rostergroups AS rgs\
+                               JOIN rostergroupitems AS rgi ON rgi.groupid = rgs.groupid\
+                           WHERE rgs.userid = ?", (uid,))
+                for row in c:
+                    item = items.get(row['contactid'])
+                    if item is not None:
+                        item[4].append(row['name'])
+
+                c.execute("SELECT version FROM rosterversions WHERE userid = ?",
+                          (uid,))
+                res = c.fetchone()
+            finally:
+                c.execute("COMMIT")
+        finally:
+            c.close()
+
+        if res:
+            version = res[0]
+        else:
+            version = 0
+        return version, items.values()
+
+    def _logChange(self, c, uid, cid):
+        """Increments the roster's version and records that contact cid
+        changed in it. Returns the new version.
+        """
+        c.execute("UPDATE rosterversions SET version = version + 1\
+                   WHERE userid = ?", (uid,))
+        if c.rowcount == 0:
+            c.execute("INSERT INTO rosterversions (userid, version)\
+                       VALUES (?, 1)", (uid,))
+        c.execute("SELECT version FROM rosterversions WHERE userid = ?",
+                  (uid,))
+        version = c.fetchone()[0]
+        c.execute("INSERT OR REPLACE INTO rosterchanges\
+                   (userid, contactid, version)\
+                   VALUES\
+                   (?, ?, ?)", (uid, cid, version))
+        return version
+
+    def updateContact(self, uid, cjid, name, groups, subscription=None):
+        return self._transaction(self._updateContact, uid, cjid, name,
+                                 groups, subscription)
+
+    def _updateContact(self, c, uid, cjid, name, groups, subscription):
+        newJID = False
+
+        # check if this is an update to an existing roster entry
+        c.execute("SELECT cjids.id cid \
+                   FROM roster\
+                   JOIN jids AS cjids ON cjids.id = roster.contactid\
+                   WHERE roster.userid = ? AND cjids.jid = ?", (uid, cjid))
+        res = c.fetchone()
+        if res:
+            # this is an update
+            # we update the subscription if it's given to us; o/w
+            # just update the name
+            cid = res[0]
+            if subscription:
+                c.execute("UPDATE roster SET name = ?, subscription = ?\
+                           WHERE userid = ? AND contactid = ?",
+                          (name, subscription, uid, cid))
+            else:
+                c.execute("UPDATE roster SET name = ?\
+                           WHERE userid = ? AND contactid = ?",
+                          (name, uid, cid))
+        else:
+            # this is a new roster entry
+
+            # check if the contact JID already exists in our DB
+            c.execute("SELECT id FROM jids WHERE jid = ?", (cjid,))
+            res = c.fetchone()
+            if res:
+                cid = res[0]
+            else:
+                # create new JID entry
+                res = c.execute("INSERT INTO jids\
+                                 (jid, password)\
+                                 VALUES\
+                                 (?, '')", (cjid,))
+                cid = res.lastrowid
+                newJID = True
+
+            c.execute("INSERT INTO roster\
+                       (userid, contactid, name, subscription)\
+                       VALUES\
+                       (?, ?, ?, ?)",
+                       (uid, cid, name, subscription or Subscription.NONE))
+
+        # UPDATE GROUPS
+        # remove all group mappings for this contact and recreate
+        # them, since it's easier than figuring out what changed
+        c.execute("DELETE FROM rostergroupitems\
+                   WHERE contactid = ? AND groupid IN\
+                   (SELECT groupid FROM rostergroups WHERE\
+                       userid = ?)", (cid, uid))
+        for groupName in groups:
+            # get the group id
+            c.execute("SELECT groupid\
+                       FROM rostergroups\
+                       WHERE userid = ? AND name = ?", (uid, groupName))
+            res = c.fetchone()
+            if res:
+                gid = res[0]
+            else:
+                # need to create the group
+                res = c.execute("INSERT INTO rostergroups\
+                                 (userid, name)\
+                                 VALUES\
+                                 (?, ?)", (uid, groupName))
+                gid = res.lastrowid
+
+            c.execute("INSERT INTO rostergroupitems\
+                       (groupid, contactid)\
+                       VALUES\
+                       (?, ?)", (gid, cid))
+
+        version = self._logChange(c, uid, cid)
+        return cid, version, newJID
+
+    def removeContact(self, uid, cjid):
+        return self._transaction(self._removeContact, uid, cjid)
+
+    def _removeContact(self, c, uid, cjid):
+        # get the contact's id
+        c.execute("SELECT jids.id\
+                   FROM roster\
+                   JOIN jids ON roster.contactid = jids.id\
+                   WHERE roster.userid = ? AND jids.jid = ?", (uid, cjid))
+        res = c.fetchone()
+        if not res:
+            return None
+        cid = res[0]
+
+        # delete the contact from all groups it's in for this user
+        c.execute("DELETE FROM rostergroupitems\
+                   WHERE rostergroupitems.groupid IN (\
+                       SELECT rgs.groupid FROM rostergroups AS rgs\
+                       JOIN rostergroupitems AS rgi ON rgi.groupid = rgs.groupid\
+                       WHERE rgs.userid = ?\
+                    ) AND rostergroupitems.contactid = ?", (uid, cid))
+
+        # now delete the roster entry
+        c.execute("DELETE FROM roster\
+                   WHERE userid = ? AND contactid = ?", (uid, cid))
+
+        return cid, self._logChange(c, uid, cid)
+
+    def setSubscription(self, uid, cid, subscription):
+        return self._transaction(self._setSubscription, uid, cid, subscription)
+
+    def _setSubscription(self, c, uid, cid, subscription):
+        c.execute("UPDATE roster SET subscription = ?\
+                   WHERE userid = ? AND contactid = ?", (subscription, uid, cid))
+        if c.rowcount == 0:
+            # no such contact
+            return None
+        return self._logChange(c, uid, cid)
+
+    def getRosterChanges(self, uid, version):
+        c = DBautocommit().cursor()
+        try:
+            c.execute("SELECT rc.version, jids.jid\
+                       FROM rosterchanges AS rc\
+                           JOIN jids ON jids.id = rc.contactid\
+                       WHERE rc.userid = ? AND rc.version > ?\
+                       ORDER BY rc.version", (uid, version))
+            return [(row[0], row[1]) for row in c]
+        finally:
+            c.close()
+
+    # offline messages
+
+    def storeOfflineMessages(self, messages):
+        self._transaction(lambda c:
+                          c.executemany("INSERT INTO offline (fromid, toid, time, content)\
+                                         VALUES (?, ?, ?, ?)", messages))
+
+    def getOfflineMessages(self, toid, limit):
+        c = DBautocommit().cursor()
+        try:
+            c.execute("SELECT offline.rowid, jids.jid, offline.time, offline.content\
+                       FROM offline\
+                           LEFT JOIN jids ON jids.id = offline.fromid\
+                       WHERE offline.toid = ?\
+                       ORDER BY offline.time ASC, offline.rowid ASC\
+                       LIMIT ?", (toid, limit))
+            return [tuple(row) for row in c]
+        finally:
+            c.close()
+
+    def deleteOfflineMessages(self, keys):
+        keys = list(keys)
+        if not keys:
+            return
+        self._transaction(lambda c:
+                          c.execute("DELETE FROM offline WHERE rowid IN (%s)" %
+                                    ','.join(['?'] * len(keys)), keys))
@@ -5,6 +5,9 @@ import pjs.test.test_parsers
 import pjs.test.test_utils
 import pjs.test.test_async
 import pjs.test.test_events
+import pjs.test.test_registry
+import pjs.test.test_db
+import pjs.test.test_storage
 import pjs.test.test_xmpp
 
 fromModule = unittest.TestLoader().loadTestsFromModule
@@ -13,6 +16,9 @@ suite = fromModule(pjs.test.test_parsers)
 suite.addTests(fromModule(pjs.test.test_utils))
 suite.addTests(fromModule(pjs.test.test_async))
 suite.addTests(fromModule(pjs.test.test_events))
+suite.addTests(fromModule(pjs.test.test_registry))
+suite.addTests(fromModule(pjs.test.test_db))
+suite.addTests(fromModule(pjs.test.test_storage))
 
 # this doesn't work, because unittest does not import the helper classes
 # run test_xmpp directly instead
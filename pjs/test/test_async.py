@@ -1,10 +1,16 @@
 import pjs.test.init # init the launcher
 import pjs.async.core as asyncore
 from pjs.utils import FunctionCall
+import pjs.connection
 from pjs.connection import Connection
+from pjs.async.trigger import Trigger
+from pjs.async.timers import TimerWheel
 
 import unittest
 import socket
+import thread
+import threading
+import time
 
 class ServerHelper(asyncore.dispatcher):
     """Starts a dummy server that listens on port 44444"""
@@ -121,5 +127,429 @@ class TestWatchFunction(unittest.TestCase):
         
         self.assert_(self.passed)
         
+class TestEpoll(unittest.TestCase):
+    """Testing the epoll loop with persistent registration"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.server = ServerHelper()
+        self.sock = socket.socket()
+        self.sock.connect(('localhost', 44444))
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        for jid, conn in self.server.conns.values():
+            conn.handle_close()
+        self.sock.close()
+        self.server.handle_close()
+
+    def _pollUntil(self, func):
+        for i in range(10):
+            asyncore.epoll_poll(0.1)
+            if func():
+                return True
+        return False
+
+    def testAccept(self):
+        """Listening socket should get registered and accept connections"""
+        self.assert_(self._pollUntil(lambda: len(self.server.conns) == 1))
+
+        pollster = asyncore.epoll_map[id(asyncore.socket_map)]
+        self.assert_(self.server._fileno in pollster.registered)
+
+    def testSendAndClose(self):
+        """Queued output should be written and closed fds unregistered"""
+        self.assert_(self._pollUntil(lambda: len(self.server.conns) == 1))
+        conn = self.server.conns.values()[0][1]
+        fd = conn._fileno
+
+        conn.send('hello')
+        asyncore.epoll_poll(0.1)
+        self.assert_(self.sock.recv(5) == 'hello')
+
+        pollster = asyncore.epoll_map[id(asyncore.socket_map)]
+        self.assert_(fd in pollster.registered)
+        conn.handle_close()
+        self.assert_(fd not in pollster.registered)
+
+    def testWakeFromThread(self):
+        """Interest changed from another thread should wake up the loop"""
+        self.assert_(self._pollUntil(lambda: len(self.server.conns) == 1))
+        conn = self.server.conns.values()[0][1]
+        pollster = asyncore.epoll_map[id(asyncore.socket_map)]
+        wakeups = []
+
+        oldThread = asyncore._loop_thread
+        asyncore.set_wakeup(lambda: wakeups.append(1))
+        try:
+            # pretend we're the loop
+            asyncore._loop_thread = thread.get_ident()
+            conn.interest_changed()
+            self.assert_(wakeups == [])
+
+            t = threading.Thread(target=conn.interest_changed)
+            t.start()
+            t.join()
+            self.assert_(wakeups == [1])
+            self.assert_(conn._fileno in pollster.dirty)
+        finally:
+            asyncore.set_wakeup(None)
+            asyncore._loop_thread = oldThread
+
+    def testMarkDirtyFromThreads(self):
+        """Marking fds dirty while the loop updates shouldn't lose any"""
+        self.assert_(self._pollUntil(lambda: len(self.server.conns) == 1))
+        pollster = asyncore.epoll_map[id(asyncore.socket_map)]
+        fd = self.server._fileno
+        done = []
+        def mark():
+            for i in xrange(20000):
+                pollster.mark_dirty(fd)
+            done.append(1)
+        threads = [threading.Thread(target=mark) for i in range(4)]
+        [t.start() for t in threads]
+        while len(done) < len(threads):
+            pollster.update()
+        [t.join() for t in threads]
+        pollster.mark_dirty(fd)
+        pollster.update()
+        self.assert_(not pollster.dirty)
+
+class TestTrigger(unittest.TestCase):
+    """Testing the loop wakeup from other threads"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.trigger = Trigger()
+        self.called = 0
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        self.trigger.close()
+
+    def thunk(self):
+        self.called += 1
+
+    def testCoalesce(self):
+        """Many pulls should result in a single wakeup and thunk call"""
+        def pull():
+            for i in range(100):
+                self.trigger.pullTrigger(self.thunk)
+        threads = [threading.Thread(target=pull) for i in range(4)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+
+        asyncore.poll(1.0)
+
+        self.assert_(self.called == 1)
+        self.assert_(not self.trigger._pending)
+
+    def testDistinctThunks(self):
+        """Different thunks are all run, in the order they were pulled"""
+        calls = []
+        for i in range(1000):
+            self.trigger.pullTrigger(lambda i=i: calls.append(i))
+        self.trigger.pullTrigger(self.thunk)
+        self.trigger.pullTrigger(self.thunk)
+        asyncore.poll(1.0)
+
+        self.assert_(calls == range(1000))
+        self.assert_(self.called == 1)
+        self.assert_(not self.trigger._queued)
+
+    def testWakeupAfterDrain(self):
+        """Pulling after a drain should wake up the loop again"""
+        self.trigger.pullTrigger(self.thunk)
+        asyncore.poll(1.0)
+        self.trigger.pullTrigger(self.thunk)
+        asyncore.poll(1.0)
+
+        self.assert_(self.called == 2)
+
+class TestOutputQueue(unittest.TestCase):
+    """Testing the chunked output buffer of dispatcher_with_send"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.q = asyncore.output_queue()
+
+    def testGather(self):
+        """Small chunks are joined into one write up to the size"""
+        for s in ['abc', 'def', u'gh\xe9']:
+            self.q.append(s)
+        self.assert_(len(self.q) == 10)
+        self.assert_(self.q.peek(5) == 'abcde')
+        self.assert_(self.q.peek(100) == 'abcdefgh\xc3\xa9')
+
+    def testConsume(self):
+        self.q.append('abc')
+        self.q.append('defgh')
+        self.q.consume(2)
+        self.assert_(len(self.q) == 6)
+        self.assert_(self.q.peek(1).tobytes() == 'c')
+        self.q.consume(3)
+        self.assert_(self.q.peek(100) == 'fgh')
+        self.q.consume(3)
+        self.assert_(len(self.q) == 0 and self.q.peek(100) == '')
+
+    def testLargeChunk(self):
+        """A chunk bigger than the write size isn't copied"""
+        data = 'x' * 1000
+        self.q.append(data)
+        self.q.consume(100)
+        out = self.q.peek(300)
+        self.assert_(isinstance(out, memoryview))
+        self.assert_(out.tobytes() == 'x' * 300)
+
+    def testSend(self):
+        """Everything queued on a connection arrives in order"""
+        server = ServerHelper()
+        sock = socket.socket()
+        try:
+            sock.connect(('localhost', 44444))
+            while not server.conns:
+                asyncore.poll(0.1)
+            conn = server.conns.values()[0][1]
+            conn.send_size = 7
+            expected = ''.join([str(i) * i for i in range(20)])
+            for i in range(20):
+                conn.send(str(i) * i)
+            got = ''
+            while len(got) < len(expected):
+                asyncore.poll(0.1)
+                got += sock.recv(4096)
+            self.assert_(got == expected)
+            self.assert_(conn.bytes_queued() == 0)
+        finally:
+            sock.close()
+            for jid, conn in server.conns.values():
+                conn.handle_close()
+            server.handle_close()
+
+class TestBackpressure(unittest.TestCase):
+    """Testing the output watermarks of Connection"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.server = ServerHelper()
+        self.sock = socket.socket()
+        self.sock.connect(('localhost', 44444))
+        while not self.server.conns:
+            asyncore.poll(0.1)
+        self.conn = self.server.conns.values()[0][1]
+        self.conn.highWatermark = 100
+        self.conn.lowWatermark = 10
+        self.conn.hardLimit = 1000
+        # simulate a client that doesn't read
+        self.conn.initiate_send = lambda: None
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        for jid, conn in self.server.conns.values():
+            conn.handle_close()
+        self.sock.close()
+        self.server.handle_close()
+
+    def testPauseAndCoalesce(self):
+        stats = dict(pjs.connection.stats)
+        self.conn.send('x' * 101)
+        self.assert_(self.conn.readPaused and not self.conn.readable())
+
+        self.conn.send('a1', 'a')
+        self.conn.send('b1', 'b')
+        self.conn.send('a2', 'a')
+        self.conn.send('msg')
+        self.assert_(pjs.connection.stats['coalesced'] == stats['coalesced'] + 1)
+
+        # drain and check what got sent after the backlog
+        del self.conn.initiate_send
+        got = ''
+        while len(got) < 108:
+            asyncore.poll(0.1)
+            got += self.sock.recv(4096)
+        self.assert_(got == 'x' * 101 + 'msga2b1')
+        self.assert_(not self.conn.readPaused and self.conn.readable())
+        self.assert_(pjs.connection.stats['paused'] == stats['paused'] + 1)
+        self.assert_(pjs.connection.stats['resumed'] == stats['resumed'] + 1)
+
+    def testHardLimit(self):
+        disconnected = pjs.connection.stats['disconnected']
+        self.conn.send('x' * 1001)
+        self.assert_(self.conn.disconnecting and not self.conn.readable())
+        self.assert_(pjs.connection.stats['disconnected'] == disconnected + 1)
+
+        # the stream error goes out before the connection is closed
+        del self.conn.initiate_send
+        got = ''
+        start = time.time()
+        while self.conn.id in self.server.conns and time.time() - start < 5:
+            asyncore.poll(0.1)
+        self.assert_(self.conn.id not in self.server.conns)
+        while True:
+            data = self.sock.recv(4096)
+            if not data:
+                break
+            got += data
+        self.assert_(got.startswith('<stream:error><resource-constraint '))
+
+    def testErrorFlushTimeout(self):
+        """A client that doesn't read the stream error is closed anyway"""
+        self.conn.errorFlushTimeout = 0.05
+        self.conn.send('x' * 1001)
+        start = time.time()
+        while self.conn.id in self.server.conns and time.time() - start < 5:
+            asyncore.poll(0.1)
+        self.assert_(self.conn.id not in self.server.conns)
+
+    def testCloseOnce(self):
+        """A socket closed before the stream error's flush timeout is only
+        closed once
+        """
+        dispatched = []
+        class FakeDispatcher:
+            def dispatch(self, tree, conn, phase):
+                dispatched.append(phase)
+        self.server.data = {'info' : {'type' : 'c2s'}}
+        sock, other = socket.socketpair()
+        conn = pjs.connection.ClientConnection(sock, 'pair', self.server)
+        oldDispatcher = pjs.connection.Dispatcher
+        pjs.connection.Dispatcher = FakeDispatcher
+        try:
+            conn.highWatermark = 100
+            conn.hardLimit = 1000
+            conn.errorFlushTimeout = 0.05
+            conn.initiate_send = lambda: None
+            conn.send('x' * 1001)
+            self.assert_(conn.disconnecting)
+            # the socket closes by itself
+            conn.handle_close()
+            start = time.time()
+            while time.time() - start < 0.3:
+                asyncore.poll(0.1)
+            self.assert_(dispatched == ['stream-end'])
+        finally:
+            pjs.connection.Dispatcher = oldDispatcher
+            conn.close()
+            other.close()
+
+    def testSendFromThread(self):
+        """Data sent from another thread is queued from the loop"""
+        thunks = []
+        oldThread = asyncore._loop_thread
+        asyncore.set_wakeup(thunks.append)
+        try:
+            # pretend we're the loop
+            asyncore._loop_thread = thread.get_ident()
+            t = threading.Thread(target=self.conn.send, args=('x' * 101,))
+            t.start()
+            t.join()
+            self.assert_(len(self.conn.out_buffer) == 0)
+            self.assert_(len(thunks) == 1)
+            thunks[0]()
+            self.assert_(self.conn.readPaused)
+        finally:
+            asyncore.set_wakeup(None)
+            asyncore._loop_thread = oldThread
+
+    def testTimeout(self):
+        self.conn.slowConsumerTimeout = 0.05
+        self.conn.errorFlushTimeout = 0.05
+        self.conn.send('x' * 101)
+        start = time.time()
+        while self.conn.id in self.server.conns and time.time() - start < 5:
+            asyncore.poll(0.1)
+        self.assert_(self.conn.id not in self.server.conns)
+
+class TestTimerWheel(unittest.TestCase):
+    """Testing the timer wheel with a fake clock"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.now = 1000.0
+        self.wheel = TimerWheel(tick=1.0, size=8, clock=lambda: self.now)
+        self.fired = []
+
+    def fire(self, name):
+        self.fired.append(name)
+
+    def testOrder(self):
+        """Timers fire when due and in deadline order"""
+        self.wheel.call_later(3, self.fire, 'b')
+        self.wheel.call_later(2.5, self.fire, 'a')
+        self.wheel.call_later(5, self.fire, 'c')
+
+        self.now += 2
+        self.wheel.run()
+        self.assert_(self.fired == [])
+
+        self.now += 1
+        self.wheel.run()
+        self.assert_(self.fired == ['a', 'b'])
+        self.assert_(len(self.wheel) == 1)
+
+    def testCancel(self):
+        t = self.wheel.call_later(1, self.fire, 'a')
+        self.assert_(t.active())
+        t.cancel()
+        t.cancel()
+        self.assert_(not t.active() and len(self.wheel) == 0)
+
+        self.now += 2
+        self.wheel.run()
+        self.assert_(self.fired == [])
+
+    def testOverflow(self):
+        """Timers beyond one revolution get cascaded into the slots"""
+        t = self.wheel.call_later(30, self.fire, 'late')
+        self.wheel.call_later(20, self.fire, 'early')
+        for i in range(29):
+            self.now += 1
+            self.wheel.run()
+        self.assert_(self.fired == ['early'])
+
+        self.now += 1
+        self.wheel.run()
+        self.assert_(self.fired == ['early', 'late'])
+        self.assert_(not t.active())
+
+    def testClockJump(self):
+        self.wheel.call_later(5, self.fire, 'a')
+        self.wheel.call_later(500, self.fire, 'b')
+        self.now += 100
+        self.wheel.run()
+        self.assert_(self.fired == ['a'] and len(self.wheel) == 1)
+
+        self.now += 400
+        self.wheel.run()
+        self.assert_(self.fired == ['a', 'b'])
+
+    def testTimeout(self):
+        """Pending timers shorten the poll timeout"""
+        self.assert_(self.wheel.timeout(30.0) == 30.0)
+        self.wheel.call_later(10, self.fire, 'a')
+        self.assert_(self.wheel.timeout(30.0) <= 1.0)
+        self.assert_(self.wheel.timeout(None) <= 1.0)
+
+    def testDispatcherClose(self):
+        """Closing a dispatcher cancels its timers"""
+        server = ServerHelper()
+        t = server.call_later(0, self.fire, 'a')
+        self.assert_(t.active())
+        server.handle_close()
+        self.assert_(not t.active())
+
+    def testLoop(self):
+        """The loop wakes up for timers before its timeout"""
+        server = ServerHelper()
+        try:
+            server.call_later(0.05, self.fire, 'a')
+            start = time.time()
+            while not self.fired and time.time() - start < 5.0:
+                asyncore.poll(5.0)
+            self.assert_(self.fired == ['a'])
+            self.assert_(time.time() - start < 1.0)
+        finally:
+            server.handle_close()
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,500 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from datetime import datetime
+
+import pjs.async.core as asyncore
+import pjs.db
+import pjs.jid
+import pjs.roster
+
+from pjs.db import DB, DBautocommit, closeAll
+from pjs.jid import JID, invalidate, clearCaches
+from pjs.offline import OfflineWriter, OfflineDelivery
+from pjs.roster import Roster, Subscription, evict
+from pjs.storage import getStorage
+from pjs.migrations import migrate, migrations, getVersion
+
+class TestPool(unittest.TestCase):
+    """Testing the per-thread connection pool"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.oldName = pjs.db.dbname
+        fd, self.name = tempfile.mkstemp('.db')
+        os.close(fd)
+        con = DB(self.name)
+        con.execute("CREATE TABLE t (a INTEGER)")
+        con.commit()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        closeAll()
+        pjs.db.dbname = self.oldName
+        os.remove(self.name)
+
+    def testReuse(self):
+        """Same connection for the same thread and isolation level"""
+        self.assert_(DB() is DB())
+        self.assert_(DBautocommit() is DBautocommit())
+        self.assert_(DB() is not DBautocommit())
+
+    def testThreads(self):
+        """Each thread gets its own connection"""
+        conns = []
+        t = threading.Thread(target=lambda: conns.append(DB()))
+        t.start()
+        t.join()
+        self.assert_(conns[0] is not DB())
+
+    def testClose(self):
+        """close() only rolls back"""
+        con = DB()
+        con.execute("INSERT INTO t VALUES (1)")
+        con.close()
+        self.assert_(DB() is con)
+        self.assert_(con.execute("SELECT COUNT(*) FROM t").fetchone()[0] == 0)
+
+    def testPragmas(self):
+        """Connections are set up with the pragmas"""
+        mode = DB().execute("PRAGMA journal_mode").fetchone()[0]
+        self.assert_(mode.lower() == 'wal')
+
+    def testCloseAll(self):
+        """closeAll() makes threads reconnect"""
+        con = DB()
+        closeAll()
+        self.assert_(DB() is not con)
+        self.assert_(DB().execute("SELECT COUNT(*) FROM t").fetchone()[0] == 0)
+
+
+class TestJIDCache(unittest.TestCase):
+    """Testing the caching of JID lookups"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.oldName = pjs.db.dbname
+        fd, self.name = tempfile.mkstemp('.db')
+        os.close(fd)
+        con = DB(self.name)
+        con.execute("CREATE TABLE jids (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,\
+                                        jid TEXT NOT NULL,\
+                                        password TEXT NOT NULL,\
+                                        UNIQUE(jid))")
+        con.execute("INSERT INTO jids (jid, password) VALUES ('bob@localhost', 'test')")
+        con.commit()
+        clearCaches()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        closeAll()
+        clearCaches()
+        pjs.db.dbname = self.oldName
+        os.remove(self.name)
+
+    def testLookups(self):
+        """Lookups are answered from the cache"""
+        hits = pjs.jid._ids.hits
+        self.assert_(JID('bob@localhost').getNumId() == 1)
+        self.assert_(JID('bob@localhost/home').getNumId() == 1)
+        self.assert_(pjs.jid._ids.hits == hits + 1)
+        # filled in by getNumId()
+        self.assert_(JID(1, True).getBare() == 'bob@localhost')
+        self.assert_(pjs.jid._jids.hits == 1)
+
+    def testInvalidate(self):
+        """Inserted JIDs are seen after invalidate()"""
+        alice = JID('alice@localhost')
+        self.assert_(alice.getNumId() == -1)
+        self.assert_(not alice.exists())
+        con = DB()
+        con.execute("INSERT INTO jids (jid, password) VALUES ('alice@localhost', 'test')")
+        con.commit()
+        self.assert_(alice.getNumId() == -1)
+        invalidate('alice@localhost')
+        self.assert_(alice.getNumId() == 2)
+        self.assert_(alice.exists())
+
+    def testInvalidateDuringLookup(self):
+        """A miss that raced with invalidate() isn't cached"""
+        con = DB()
+        storage = getStorage()
+        def getId(jid):
+            # the JID is created while the lookup runs
+            con.execute("INSERT INTO jids (jid, password) VALUES ('alice@localhost', 'test')")
+            con.commit()
+            invalidate('alice@localhost')
+        storage.getId = getId
+        try:
+            alice = JID('alice@localhost')
+            self.assert_(alice.getNumId() == -1)
+        finally:
+            del storage.getId
+        self.assert_(pjs.jid._ids.get('alice@localhost') is None)
+        self.assert_(alice.getNumId() == 2)
+
+
+class TestOfflineWriter(unittest.TestCase):
+    """Testing the write-behind storage of offline messages"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.oldName = pjs.db.dbname
+        fd, self.name = tempfile.mkstemp('.db')
+        os.close(fd)
+        con = DB(self.name)
+        con.execute("CREATE TABLE offline (fromid INTEGER NOT NULL,\
+                                           toid INTEGER NOT NULL,\
+                                           time TIMESTAMP,\
+                                           content TEXT)")
+        con.commit()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        closeAll()
+        pjs.db.dbname = self.oldName
+        os.remove(self.name)
+
+    def count(self):
+        return DB().execute("SELECT COUNT(*) FROM offline").fetchone()[0]
+
+    def testBatch(self):
+        """Queued messages are written in one batch by flush()"""
+        writer = OfflineWriter(flushInterval=10)
+        writer.start()
+        for i in xrange(5):
+            self.assert_(writer.store(1, 2, None, u'hi %d' % i))
+        writer.flush()
+        self.assert_(self.count() == 5)
+        self.assert_(writer.batches == 1)
+        writer.stop()
+
+    def testBatchSize(self):
+        """A full batch is written without waiting"""
+        writer = OfflineWriter(flushInterval=10, batchSize=3)
+        writer.start()
+        for i in xrange(3):
+            writer.store(1, 2, None, u'hi')
+        writer.stop()
+        self.assert_(self.count() == 3)
+        self.assert_(writer.batches == 1)
+
+    def testStop(self):
+        """stop() writes out what's queued"""
+        writer = OfflineWriter(flushInterval=10)
+        writer.start()
+        writer.store(1, 2, None, u'hi')
+        writer.stop()
+        self.assert_(self.count() == 1)
+        # after stopping, messages are written right away
+        self.assert_(writer.store(1, 2, None, u'hi'))
+        self.assert_(self.count() == 2)
+
+    def testDurable(self):
+        """Durable stores return after the commit, or False if it failed"""
+        writer = OfflineWriter(durable=True)
+        writer.start()
+        self.assert_(writer.store(1, 2, None, u'hi'))
+        self.assert_(self.count() == 1)
+        self.assert_(not writer.store(None, 2, None, u'hi'))
+        self.assert_(self.count() == 1)
+        writer.stop()
+
+
+class TestRosterCache(unittest.TestCase):
+    """Testing the roster cache"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.oldName = pjs.db.dbname
+        fd, self.name = tempfile.mkstemp('.db')
+        os.close(fd)
+        con = DB(self.name)
+        con.execute("CREATE TABLE jids (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,\
+                                        jid TEXT NOT NULL,\
+                                        password TEXT NOT NULL,\
+                                        UNIQUE(jid))")
+        con.execute("CREATE TABLE roster (userid INTEGER REFERENCES jids NOT NULL,\
+                                          contactid INTEGER REFERENCES jids NOT NULL,\
+                                          name TEXT,\
+                                          subscription INTEGER DEFAULT 0,\
+                                          PRIMARY KEY (userid, contactid))")
+        con.execute("CREATE TABLE rostergroups (groupid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,\
+                                                userid INTEGER REFERENCES jids NOT NULL,\
+                                                name TEXT NOT NULL,\
+                                                UNIQUE(userid, name))")
+        con.execute("CREATE TABLE rostergroupitems\
+                      (groupid INTEGER REFERENCES rostergroup NOT NULL,\
+                       contactid INTEGER REFERENCES jids NOT NULL,\
+                       PRIMARY KEY (groupid, contactid))")
+        con.execute("CREATE TABLE rosterversions\
+                      (userid INTEGER PRIMARY KEY REFERENCES jids NOT NULL,\
+                       version INTEGER NOT NULL DEFAULT 0)")
+        con.execute("CREATE TABLE rosterchanges\
+                      (userid INTEGER REFERENCES jids NOT NULL,\
+                       contactid INTEGER REFERENCES jids NOT NULL,\
+                       version INTEGER NOT NULL,\
+                       PRIMARY KEY (userid, contactid))")
+        con.execute("INSERT INTO jids (jid, password) VALUES ('bob@localhost', 'test')")
+        con.execute("INSERT INTO jids (jid, password) VALUES ('alice@localhost', 'test')")
+        con.execute("INSERT INTO roster (userid, contactid, subscription) VALUES (1, 2, 8)")
+        con.execute("INSERT INTO roster (userid, contactid, subscription) VALUES (2, 1, 8)")
+        con.commit()
+        clearCaches()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        pjs.roster.clearCache()
+        closeAll()
+        clearCaches()
+        pjs.db.dbname = self.oldName
+        os.remove(self.name)
+
+    def testCached(self):
+        """Rosters are read from the DB once"""
+        roster = Roster('bob@localhost')
+        self.assert_(roster.getPresenceSubscribers() == ['alice@localhost'])
+        con = DB()
+        con.execute("DELETE FROM roster")
+        con.commit()
+        self.assert_(Roster('bob@localhost').getPresenceSubscriptions() == ['alice@localhost'])
+        evict('bob@localhost')
+        self.assert_(Roster('bob@localhost').getPresenceSubscriptions() == [])
+
+    def testWriteThrough(self):
+        """Changes are written to the DB and to the cache"""
+        roster = Roster('bob@localhost')
+        roster.loadRoster()
+        version = roster.version
+
+        cid = roster.updateContact('carol@localhost', ['Friends'], 'Carol')
+        roster.setSubscription(cid, Subscription.TO)
+        roster.updateContact('alice@localhost', name='Alice',
+                             subscriptionId=Subscription.FROM)
+        roster.loadRoster()
+        self.assert_(roster.version == version + 3)
+        self.assert_(roster.items[cid].groups == ['Friends'])
+        self.assert_(roster.getSubscription(cid) == Subscription.TO)
+        self.assert_(roster.getContactInfo('alice@localhost').name == 'Alice')
+
+        roster.removeContact('alice@localhost')
+        self.assert_(not roster.getContactInfo('alice@localhost'))
+
+        # the cache matches the DB
+        cached = Roster('bob@localhost')
+        cached.loadRoster()
+        evict('bob@localhost')
+        fresh = Roster('bob@localhost')
+        fresh.loadRoster()
+        self.assert_([(i.jid, i.name, i.subscription, i.groups)
+                      for i in cached.items.values()] ==
+                     [(i.jid, i.name, i.subscription, i.groups)
+                      for i in fresh.items.values()])
+
+    def testVersions(self):
+        """Changes since a version"""
+        roster = Roster('bob@localhost')
+        self.assert_(roster.getVersion() == 0)
+        self.assert_(roster.getChanges('0') == [])
+        self.assert_(roster.getChanges('1') is None)
+        self.assert_(roster.getChanges('junk') is None)
+
+        cid = roster.updateContact('carol@localhost', name='Carol')
+        roster.updateContact('dave@localhost')
+        roster.setSubscription(cid, Subscription.BOTH)
+        roster.removeContact('dave@localhost')
+        self.assert_(roster.version == 4)
+
+        # persisted
+        evict('bob@localhost')
+        roster = Roster('bob@localhost')
+        self.assert_(roster.getVersion() == 4)
+        changes = roster.getChanges('1')
+        self.assert_([(v, jid) for v, jid, item in changes] ==
+                     [(3, 'carol@localhost'), (4, 'dave@localhost')])
+        self.assert_(changes[0][2].subscription == Subscription.BOTH)
+        self.assert_(changes[1][2] is None)
+        self.assert_(roster.getChanges('4') == [])
+
+    def testUpdateOtherUser(self):
+        """Updating a contact doesn't change other users' rosters"""
+        Roster('bob@localhost').updateContact('alice@localhost',
+                                              subscriptionId=Subscription.TO)
+        evict('bob@localhost')
+        self.assert_(Roster('bob@localhost').getSubscription(2) == Subscription.TO)
+        self.assert_(Roster('alice@localhost').getSubscription(1) == Subscription.BOTH)
+
+
+class TestMigrations(unittest.TestCase):
+    """Testing the schema migrations"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.oldName = pjs.db.dbname
+        fd, self.name = tempfile.mkstemp('.db')
+        os.close(fd)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        closeAll()
+        pjs.db.dbname = self.oldName
+        os.remove(self.name)
+
+    def indexes(self):
+        return [row[0] for row in DB().execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'index'\
+                     AND sql IS NOT NULL ORDER BY name")]
+
+    def testNew(self):
+        """New DBs get the latest schema"""
+        self.assert_(migrate(self.name) == 0)
+        self.assert_(getVersion(DB()) == len(migrations))
+        self.assert_(self.indexes() == ['offline_toid',
+                                        'rosterchanges_version',
+                                        'rostergroupitems_contactid'])
+        # nothing left to do
+        self.assert_(migrate() == len(migrations))
+
+    def testUpgrade(self):
+        """Old DBs are upgraded in place"""
+        migrate(self.name, 1)
+        con = DB()
+        con.execute("INSERT INTO jids (jid, password) VALUES ('bob@localhost', 'test')")
+        con.commit()
+        self.assert_(self.indexes() == [])
+
+        self.assert_(migrate() == 1)
+        self.assert_(self.indexes() != [])
+        self.assert_(DB().execute("SELECT jid FROM jids").fetchall()[0][0] == 'bob@localhost')
+
+    def testUnversioned(self):
+        """DBs from before migrations are upgraded too"""
+        con = DB(self.name)
+        con.execute("CREATE TABLE offline (fromid INTEGER NOT NULL,\
+                                           toid INTEGER NOT NULL,\
+                                           time TIMESTAMP,\
+                                           content TEXT)")
+        con.commit()
+        self.assert_(migrate() == 0)
+        self.assert_(getVersion(DB()) == len(migrations))
+
+
+class TestOfflineDelivery(unittest.TestCase):
+    """Testing the paged delivery of offline messages"""
+
+    class Fake:
+        pass
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.oldName = pjs.db.dbname
+        fd, self.name = tempfile.mkstemp('.db')
+        os.close(fd)
+        migrate(self.name)
+        con = DB()
+        con.execute("INSERT INTO jids (jid, password) VALUES ('bob@localhost', 'test')")
+        con.execute("INSERT INTO jids (jid, password) VALUES ('alice@localhost', 'test')")
+        con.executemany("INSERT INTO offline (fromid, toid, time, content)\
+                         VALUES (1, 2, ?, ?)",
+                        [(datetime(2010, 1, 1, 0, 0, i % 60), u'msg %d' % i)
+                         for i in xrange(250)])
+        con.commit()
+
+        Fake = TestOfflineDelivery.Fake
+        self.sent = []
+        self.jobs = []
+        conn = Fake()
+        conn.id = 'c1'
+        conn.disconnecting = False
+        conn.out_buffer = ''
+        conn.lowWatermark = 1024
+        conn.send = self.sent.append
+        conn.server = Fake()
+        conn.server.conns = {'c1' : None}
+        conn.server.threadpool = Fake()
+        conn.server.threadpool.submit = lambda func, args: self.jobs.append((func, args))
+        conn.server.launcher = Fake()
+        conn.server.launcher.trigger = Fake()
+        conn.server.launcher.trigger.pullTrigger = lambda thunk: thunk()
+        self.conn = conn
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        closeAll()
+        pjs.db.dbname = self.oldName
+        os.remove(self.name)
+
+    def count(self):
+        return DB().execute("SELECT COUNT(*) FROM offline").fetchone()[0]
+
+    def runJobs(self):
+        while self.jobs:
+            func, args = self.jobs.pop(0)
+            func(*args)
+
+    def testPages(self):
+        """Messages are sent a page at a time and deleted after"""
+        delivery = OfflineDelivery(self.conn, 'alice@localhost', 'home', 2)
+        self.assert_(delivery.start())
+        # the first page is sent, but not deleted until the next job
+        self.assert_(len(self.sent) == 1)
+        self.assert_(self.sent[0].count(u'<message ') == 100)
+        self.assert_(self.count() == 250)
+        # another resource doesn't get them
+        self.assert_(not OfflineDelivery(self.conn, 'alice@localhost', 'work', 2).start())
+
+        self.runJobs()
+        self.assert_(len(self.sent) == 3)
+        self.assert_(self.count() == 0)
+        self.assert_(delivery.sent == 250)
+        text = u''.join(self.sent)
+        self.assert_(text.index(u'>msg 0<') < text.index(u'>msg 1<') < text.index(u'>msg 249<'))
+        self.assert_(u"from='bob@localhost'" in text)
+
+        # done, so it can start again
+        self.assert_(OfflineDelivery(self.conn, 'alice@localhost', 'work', 2).start())
+
+    def testClosed(self):
+        """Messages that weren't sent are kept"""
+        delivery = OfflineDelivery(self.conn, 'alice@localhost', 'home', 2)
+        delivery.start()
+        self.runJobs()
+        self.assert_(self.count() == 0)
+
+        con = DB()
+        con.execute("INSERT INTO offline (fromid, toid, time, content)\
+                     VALUES (1, 2, ?, 'late')", (datetime.now(),))
+        con.commit()
+        self.sent[:] = []
+        del self.conn.server.conns['c1']
+        OfflineDelivery(self.conn, 'alice@localhost', 'home', 2).start()
+        self.assert_(self.sent == [])
+        self.assert_(self.count() == 1)
+
+    def testClosedWhileDraining(self):
+        """A delivery waiting for the connection to drain finishes if the
+        connection is closed meanwhile
+        """
+        self.conn.out_buffer = 'x' * 2048
+        delivery = OfflineDelivery(self.conn, 'alice@localhost', 'home', 2)
+        delivery.drainInterval = 0.01
+        self.assert_(delivery.start())
+        self.assert_(len(self.sent) == 1)
+        self.assert_(self.jobs == [])
+
+        del self.conn.server.conns['c1']
+        time.sleep(0.25)
+        asyncore.timer_wheel.run()
+        # the page that wasn't drained is kept, and the user can get it later
+        self.assert_(self.count() == 250)
+        self.conn.server.conns['c1'] = None
+        self.conn.out_buffer = ''
+        self.assert_(OfflineDelivery(self.conn, 'alice@localhost', 'work', 2).start())
+        self.runJobs()
+        self.assert_(self.count() == 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,16 @@
 import pjs.test.init # init the launcher
 import pjs.handlers.base
 import pjs.events
+import pjs.queues
+import pjs.conf.phases
 import pjs.connection
 import pjs.threadpool
-from pjs.utils import FunctionCall
+import pjs.async.core
+from pjs.utils import FunctionCall, PrioritizedDict
+from pjs.elementtree.ElementTree import Element, SubElement
 from pjs.test.test_async import ServerHelper
+import pjs.handlers.route
+import pjs.registry
 
 import unittest
 import socket
@@ -133,6 +139,134 @@ class TestMessagesInProcess(unittest.TestCase):
 
 
 
+class TestPhaseClassifier(unittest.TestCase):
+    """The compiled phase lookup should agree with a linear XPath scan"""
+
+    def linearScan(self, phases, tree):
+        for p in phases:
+            if 'xpath' in phases[p] and tree.find(phases[p]['xpath']) is not None:
+                return p
+        return None
+
+    def makeStanzas(self, ns):
+        stanzas = []
+        for tag in ['iq', 'message', 'presence', 'foo']:
+            for type in [None, 'get', 'set', 'unavailable', 'probe', 'chat',
+                         'subscribe']:
+                for child in [None, '{jabber:iq:roster}query',
+                              '{jabber:iq:auth}query',
+                              '{urn:ietf:params:xml:ns:xmpp-bind}bind',
+                              '{urn:ietf:params:xml:ns:xmpp-session}session']:
+                    el = Element('{%s}%s' % (ns, tag))
+                    if type:
+                        el.set('type', type)
+                    if child:
+                        SubElement(el, '{jabber:x:data}x')
+                        SubElement(el, child)
+                    wrapper = Element('wrapper')
+                    wrapper.append(el)
+                    stanzas.append(wrapper)
+        for tag in ['{urn:ietf:params:xml:ns:xmpp-sasl}auth',
+                    '{http://etherx.jabber.org/streams}features',
+                    '{jabber:server:dialback}verify']:
+            wrapper = Element('wrapper')
+            SubElement(wrapper, tag)
+            stanzas.append(wrapper)
+        return stanzas
+
+    def testAgreesWithXPath(self):
+        for phases, ns in [(pjs.conf.phases.c2sStanzaPhases, 'jabber:client'),
+                           (pjs.conf.phases.s2sStanzaPhases, 'jabber:server'),
+                           (pjs.conf.phases.corePhases, 'jabber:client')]:
+            classifier = pjs.events._PhaseClassifier(phases)
+            for tree in self.makeStanzas(ns):
+                self.assert_(classifier.classify(tree) == \
+                             self.linearScan(phases, tree))
+
+    def testRebuild(self):
+        """Changing the phases at runtime should be picked up"""
+        phases = PrioritizedDict({
+            'default' : {},
+            'a' : {'xpath' : '{jabber:client}message'},
+            })
+        d = pjs.events._Dispatcher()
+        d.phasesList = phases
+        tree = Element('wrapper')
+        SubElement(tree, '{jabber:client}message', {'type' : 'chat'})
+
+        self.assert_(d.getClassifier().classify(tree) == 'a')
+        phases['b'] = {'xpath' : "{jabber:client}message[@type='chat']",
+                       'priority' : 1}
+        self.assert_(d.getClassifier().classify(tree) == 'b')
+        phases['c'] = {'xpath' : "{jabber:client}message[@type='chat']/body",
+                       'priority' : 2}
+        self.assert_(d.getClassifier().classify(tree) == 'b')
+        del phases['b']
+        self.assert_(d.getClassifier().classify(tree) == 'a')
+
+    def testBareStanza(self):
+        """Classifying a bare stanza should give the same phase as
+        classifying it in a wrapper, including for XPaths that need find()
+        """
+        for phases, ns in [(pjs.conf.phases.c2sStanzaPhases, 'jabber:client'),
+                           (pjs.conf.phases.s2sStanzaPhases, 'jabber:server')]:
+            classifier = pjs.events._PhaseClassifier(phases)
+            for tree in self.makeStanzas(ns):
+                self.assert_(classifier.classifyStanza(tree[0]) == \
+                             classifier.classify(tree))
+
+        phases = PrioritizedDict({
+            'default' : {},
+            'a' : {'xpath' : '{jabber:client}message/body[@lang]'},
+            })
+        classifier = pjs.events._PhaseClassifier(phases)
+        msg = Element('{jabber:client}message')
+        self.assert_(classifier.classifyStanza(msg) is None)
+        SubElement(msg, 'body', {'lang' : 'en'})
+        self.assert_(classifier.classifyStanza(msg) == 'a')
+
+class TestQueues(unittest.TestCase):
+    """Per-connection ordering of queued Messages"""
+    class FakeMessage:
+        def __init__(self, name, log):
+            self.name = name
+            self.log = log
+        def process(self):
+            self.log.append(self.name)
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        # other tests leave results for their fake connections behind
+        while not pjs.queues.resultQ.empty():
+            pjs.queues.resultQ.get_nowait()
+            pjs.queues.resultQ.task_done()
+
+    def testOrdering(self):
+        log = []
+        M = lambda name: TestQueues.FakeMessage(name, log)
+
+        pjs.queues.queueMessage('qc1', M('a1'))
+        pjs.queues.queueMessage('qc1', M('a2'))
+        pjs.queues.queueMessage('qc1', M('a3'))
+        pjs.queues.queueMessage('qc2', M('b1'))
+        self.assert_(log == ['a1', 'b1'])
+
+        # the next message for a connection runs when the previous finishes
+        pjs.queues.resultQ.put(('qc1', None))
+        pjs.queues.pickupResults()
+        self.assert_(log == ['a1', 'b1', 'a2'])
+
+        pjs.queues.resultQ.put(('qc2', None))
+        pjs.queues.resultQ.put(('qc1', None))
+        pjs.queues.pickupResults()
+        self.assert_(log == ['a1', 'b1', 'a2', 'a3'])
+
+        pjs.queues.resultQ.put(('qc1', None))
+        pjs.queues.pickupResults()
+        self.assert_('qc1' not in pjs.queues._runningMessages)
+        self.assert_('qc2' not in pjs.queues._runningMessages)
+        self.assert_(not pjs.queues._waitingMessages)
+
 class SimpleThreadedHandler(pjs.handlers.base.ThreadedHandler):
     def __init__(self, threadpool):
         self.passed = False
@@ -160,6 +294,20 @@ class SimpleThreadedHandler(pjs.handlers.base.ThreadedHandler):
     def resume(self):
         pass
 
+class FutureThreadedHandler(pjs.handlers.base.ThreadedHandler):
+    def __init__(self, threadpool):
+        self.threadpool = threadpool
+    def handle(self, tree, msg, lastRetVal=None):
+        def act():
+            return 'success'
+        return self.threadpool.submit(act)
+
+class RecordingHandler(pjs.handlers.base.Handler):
+    def __init__(self):
+        self.calls = []
+    def handle(self, tree, msg, lastRetVal=None):
+        self.calls.append(lastRetVal)
+
 class TestMessageInThread(unittest.TestCase):
     """Simple threaded-handler test"""
     def setUp(self):
@@ -189,5 +337,152 @@ class TestMessageInThread(unittest.TestCase):
 
         self.assert_(h.passed)
 
+    def testFutureHandler(self):
+        h = FutureThreadedHandler(self.threadpool)
+        after = RecordingHandler()
+
+        watched = len(pjs.async.core.func_map)
+        msg = pjs.events.Message(None, self.conn, [h, after], None, None)
+        msg.process()
+
+        # nothing is left for the loop to poll
+        self.assert_(len(pjs.async.core.func_map) == watched)
+
+        # picking up the result resumes the message once, with the result
+        # as the next handler's lastRetVal
+        self.threadpool.wait()
+
+        self.assert_(after.calls == ['success'])
+
+class TestHandlerCache(unittest.TestCase):
+    """Handlers are shared between Messages"""
+
+    def testSharedInstances(self):
+        d = pjs.events.Dispatcher()
+        phase = d.phasesList['stream-end']
+        handlers1, errorHandlers1 = d.getHandlerChain('stream-end', phase)
+        handlers2, errorHandlers2 = d.getHandlerChain('stream-end', phase)
+        self.assert_(handlers1 is handlers2)
+        self.assert_(d.getHandler('write') is d.getHandler('write'))
+
+    def testReplacedHandler(self):
+        """Replacing a handler class at runtime rebuilds the chain"""
+        d = pjs.events.Dispatcher()
+        phase = {'handlers' : [{'handler' : SimpleHandler}]}
+        handlers, errorHandlers = d.getHandlerChain('test-replace', phase)
+        self.assert_(isinstance(handlers[0], SimpleHandler))
+
+        phase['handlers'][0]['handler'] = ReturnTrueHandler
+        handlers, errorHandlers = d.getHandlerChain('test-replace', phase)
+        self.assert_(isinstance(handlers[0], ReturnTrueHandler))
+
+class TestBatchRouting(unittest.TestCase):
+    """The batch routers should group everything for a connection into one
+    send
+    """
+    class FakeConn:
+        def __init__(self, id=None):
+            self.id = id
+            self.sent = []
+        def sendMany(self, chunks):
+            self.sent.append(chunks)
+
+    class Fake:
+        pass
+
+    def makeMsg(self, resources, s2sConns):
+        c2s = TestBatchRouting.Fake()
+        c2s.data = {'resources' : resources}
+        s2s = TestBatchRouting.Fake()
+        s2s.s2sConns = s2sConns
+        launcher = TestBatchRouting.Fake()
+        launcher.getC2SServer = lambda: c2s
+        launcher.getS2SServer = lambda: s2s
+        msg = TestBatchRouting.Fake()
+        msg.conn = TestBatchRouting.Fake()
+        msg.conn.server = TestBatchRouting.Fake()
+        msg.conn.server.launcher = launcher
+        msg.handlers = []
+        msg.setNextHandler = lambda name: msg.handlers.insert(0, name)
+        return msg
+
+    def testClients(self):
+        c1, c2, c3, c4 = [TestBatchRouting.FakeConn(i) for i in range(4)]
+        resources = pjs.registry.ResourceIndex()
+        resources.bind(c1, 'a@localhost', 'r1')
+        resources.bind(c2, 'a@localhost', 'r2')
+        resources.bind(c3, 'b@localhost', 'x')
+        msg = self.makeMsg(resources, {})
+        routes = [
+                  {'to' : 'a@localhost', 'data' : 'x'},
+                  {'to' : 'b@localhost/x', 'data' : 'y'},
+                  {'to' : 'a@localhost/r2', 'data' : 'z'},
+                  {'to' : 'c@localhost', 'data' : 'lost'},
+                  ]
+        h = pjs.handlers.route.ClientBatchRouteHandler()
+        lastRetVal = ['other', routes]
+        h.handle(None, msg, lastRetVal)
+
+        self.assert_(lastRetVal == ['other'])
+        self.assert_(c1.sent == [[(u'x', None)]])
+        self.assert_(c2.sent == [[(u'x', None), (u'z', None)]])
+        self.assert_(c3.sent == [[(u'y', None)]])
+        self.assert_(c4.sent == [])
+
+    def testServers(self):
+        """Domains that aren't connected get one route-server each"""
+        remote = TestBatchRouting.FakeConn()
+        msg = self.makeMsg(pjs.registry.ResourceIndex(),
+                           {'remote.com' : [None, remote]})
+        routes = [
+                  {'to' : 'a@remote.com', 'data' : 'x'},
+                  {'to' : 'a@new.com', 'data' : 'y'},
+                  {'to' : 'b@remote.com/r', 'data' : 'z'},
+                  {'to' : 'b@new.com', 'data' : 'w'},
+                  ]
+        h = pjs.handlers.route.ServerBatchRouteHandler()
+        retVal = h.handle(None, msg, [routes])
+
+        self.assert_(remote.sent == [[(u'x', None), (u'z', None)]])
+        self.assert_(msg.handlers == ['route-server'])
+        self.assert_(retVal == [{'to' : 'new.com', 'data' : ['y', 'w']}])
+
+    def testServersWithoutOutConn(self):
+        """Domains with only an incoming connection get a new one"""
+        incoming = TestBatchRouting.FakeConn()
+        msg = self.makeMsg(pjs.registry.ResourceIndex(),
+                           {'remote.com' : [incoming, None],
+                            'other.com' : [None, None]})
+        msg.conn.data = {}
+        msg.conn.server.hostname = 'localhost'
+        msg.conn.server.launcher.hostname = 'localhost'
+        routes = [
+                  {'to' : 'a@remote.com', 'data' : 'x'},
+                  {'to' : 'a@other.com', 'data' : 'y'},
+                  ]
+        h = pjs.handlers.route.ServerBatchRouteHandler()
+        retVal = h.handle(None, msg, [routes])
+        self.assert_(incoming.sent == [])
+        self.assert_(msg.handlers == ['route-server', 'route-server'])
+        self.assert_(retVal == [{'to' : 'remote.com', 'data' : ['x']},
+                                {'to' : 'other.com', 'data' : ['y']}])
+
+        # route-server creates the connection instead of using the missing one
+        msg.handlers = []
+        h = pjs.handlers.route.ServerRouteHandler()
+        h.handle(None, msg, [{'to' : 'remote.com', 'data' : 'x'}])
+        self.assert_(msg.handlers == ['new-s2s-conn'])
+        self.assert_(msg.conn.data['new-s2s-conn']['hostname'] == 'remote.com')
+
+    def testNoS2SServer(self):
+        """Both server routers give up the same way without an S2S server"""
+        msg = self.makeMsg(pjs.registry.ResourceIndex(), {})
+        msg.conn.server.launcher.getS2SServer = lambda: None
+        h = pjs.handlers.route.ServerBatchRouteHandler()
+        self.assert_(h.handle(None, msg, [[{'to' : 'a@b.com', 'data' : 'x'}]]) is False)
+        h = pjs.handlers.route.ServerRouteHandler()
+        self.assert_(h.handle(None, msg, [{'to' : 'a@b.com', 'data' : 'x'}]) is False)
+        self.assert_(msg.handlers == [])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
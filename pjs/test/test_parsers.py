@@ -1,10 +1,14 @@
 import unittest
 import copy
+import socket
 import xml.parsers.expat
 import pjs.conf.handlers as handlers
 import pjs.test.init # it initializes the launcher
 import pjs.conf.conf
+import pjs.parsers
 from pjs.parsers import IncrStreamParser
+from pjs.connection import Connection
+from pjs.handlers.stream import InStreamInitHandler, InStreamReInitHandler
 from pjs.handlers.base import Handler
 from pjs.elementtree.ElementTree import Element
 
@@ -150,5 +154,125 @@ class TestParser(unittest.TestCase):
         
         self.assert_(stream.find('{http://etherx.jabber.org/streams}features') is not None)
         
+class TestParserPool(unittest.TestCase):
+    """Parsers should be reused across connections"""
+
+    class FakeConn:
+        id = 'fake'
+
+    def testReuse(self):
+        conn = TestParserPool.FakeConn()
+        p = pjs.parsers.borrow_parser(conn)
+        p.feed('<stream')
+        pjs.parsers.return_parser(p)
+        self.assert_(p.conn is None and p.depth == 0)
+
+        hits = pjs.parsers.poolStats['hits']
+        p2 = pjs.parsers.borrow_parser(conn)
+        self.assert_(p2 is p and p2.conn is conn)
+        self.assert_(pjs.parsers.poolStats['hits'] == hits + 1)
+
+        # the reused parser starts from scratch
+        p2.feed('<stream:stream xmlns:stream="http://etherx.jabber.org/streams">')
+        self.assert_(p2.depth == 1)
+        pjs.parsers.return_parser(p2)
+
+    def testUnfedParserKept(self):
+        """Resetting a parser that hasn't seen data keeps its expat parser"""
+        p = DumbParser()
+        expatParser = p._parser
+        p.resetParser()
+        self.assert_(p._parser is expatParser)
+        p.feed(streamStart)
+        p.resetParser()
+        self.assert_(p._parser is not expatParser)
+
+    def testHandlersAfterRelease(self):
+        """Handlers that run after the connection gave back its parser
+        don't use it
+        """
+        sock, other = socket.socketpair()
+        conn = Connection(sock, 'pair', None)
+        try:
+            conn.releaseParser()
+            self.assert_(conn.parser is None)
+            conn.resetParser()
+
+            class FakeMessage:
+                pass
+            msg = FakeMessage()
+            msg.conn = conn
+            for handler in [InStreamInitHandler(), InStreamReInitHandler()]:
+                msg.stopChain = False
+                self.assert_(handler.handle(None, msg, ['x']) is None)
+                self.assert_(msg.stopChain)
+        finally:
+            conn.close()
+            other.close()
+
+class RawParser(IncrStreamParser):
+    """Records the raw bytes kept for every stanza"""
+    def __init__(self):
+        IncrStreamParser.__init__(self)
+        self.raws = []
+    def _stanzaRaw(self):
+        raw = IncrStreamParser._stanzaRaw(self)
+        self.raws.append(raw)
+        return raw
+
+class TestRawStanzas(unittest.TestCase):
+    """The parser should keep the exact bytes of each stanza"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.p = RawParser()
+
+    def feedInPieces(self, data, size):
+        for i in xrange(0, len(data), size):
+            self.p.feed(data[i:i+size])
+
+    def testSpans(self):
+        stanzas = ["<message to='a@localhost' type='chat'><body>h\xc3\xa9 &amp; " +\
+                   "<b x='>'/></body></message>",
+                   "<presence/>",
+                   "<iq type=\"get\" id='1'><query xmlns='jabber:iq:roster'/></iq>",
+                   "<presence from='b@localhost' ></presence >"]
+        data = streamStart + ' '.join(stanzas) + '\n '
+        for size in [1, 3, 7, len(data)]:
+            self.p = RawParser()
+            self.feedInPieces(data, size)
+            self.assert_(self.p.raws == stanzas)
+            # only the last tag is left over
+            self.assert_(self.p._raw == '</presence >\n ')
+
+    def testOwnDefaultNs(self):
+        """Stanzas that declare the default ns aren't kept"""
+        self.p.feed(streamStart)
+        self.p.feed("<message xmlns='jabber:client'><body>a</body></message>")
+        self.p.feed("<message><body xmlns='x'>a</body></message>")
+        self.assert_(self.p.raws == [None,
+                                     "<message><body xmlns='x'>a</body></message>"])
+
+    def testStreamPrefixes(self):
+        """Stanzas using prefixes declared on the stream aren't kept"""
+        self.p.feed("<stream:stream xmlns='jabber:server' xmlns:db='jabber:server:dialback' " +\
+                    "xmlns:stream='http://etherx.jabber.org/streams'>")
+        self.p.feed("<message><db:x/></message><message><body>a</body></message>")
+        self.assert_(self.p.raws == [None, "<message><body>a</body></message>"])
+
+    def testStreamPrefixAfterNewline(self):
+        """Prefixed attributes after a newline or tab are found too"""
+        self.p.feed("<stream:stream xmlns='jabber:server' xmlns:db='jabber:server:dialback' " +\
+                    "xmlns:stream='http://etherx.jabber.org/streams'>")
+        self.p.feed("<message\ndb:type='x'><body>a</body></message>")
+        self.p.feed("<message\tdb:type='x'><body>a</body></message>")
+        self.assert_(self.p.raws == [None, None])
+
+    def testTooBig(self):
+        self.p.feed(streamStart)
+        self.p.maxRawSize = 100
+        self.feedInPieces("<message><body>%s</body></message>" % ('a' * 200), 50)
+        self.assert_(self.p.raws == [None])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,88 @@
+import pjs.registry
+import unittest
+
+from pjs.registry import ConnectionMap, ResourceIndex
+from pjs.jid import JID
+
+class TestConnectionMap(unittest.TestCase):
+    """Testing the mirroring of server conns into the registry"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.server1 = object()
+        self.server2 = object()
+        self.conns1 = ConnectionMap(self.server1)
+        self.conns2 = ConnectionMap(self.server2)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        self.conns1.clear()
+        self.conns2.clear()
+
+    def testLookup(self):
+        """Connections should be found by id along with their server"""
+        self.conns1['r1'] = (None, 'conn1')
+        self.conns2['r2'] = ('jid', 'conn2')
+
+        self.assert_(pjs.registry.lookup('r1') == (self.server1, 'conn1'))
+        self.assert_(pjs.registry.getConnection('r2') == 'conn2')
+        self.assert_(pjs.registry.lookup('nosuchconn') is None)
+
+    def testReplace(self):
+        """Updating the JID shouldn't affect the registry entry"""
+        self.conns1['r1'] = (None, 'conn1')
+        self.conns1['r1'] = ('jid', 'conn1')
+        self.assert_(pjs.registry.getConnection('r1') == 'conn1')
+
+    def testRemove(self):
+        self.conns1['r1'] = (None, 'conn1')
+        self.conns1['r2'] = (None, 'conn2')
+        self.conns1['r3'] = (None, 'conn3')
+        del self.conns1['r1']
+        self.conns1.pop('r2')
+        self.assert_(pjs.registry.lookup('r1') is None)
+        self.assert_(pjs.registry.lookup('r2') is None)
+
+        self.conns1.clear()
+        self.assert_(pjs.registry.lookup('r3') is None)
+
+class TestResourceIndex(unittest.TestCase):
+    """Finding the connections of bound resources by JID"""
+
+    class FakeConn:
+        def __init__(self, id):
+            self.id = id
+
+    def testLookup(self):
+        index = ResourceIndex()
+        c1, c2, c3 = [TestResourceIndex.FakeConn(i) for i in range(3)]
+        index.bind(c1, 'a@localhost', 'r1')
+        index.bind(c2, 'a@localhost', 'r2')
+        index.bind(c3, 'b@localhost', 'r1')
+
+        self.assert_(index.getConnections(JID('a@localhost/r2')) == [c2])
+        self.assert_(sorted([c.id for c in index.getConnections(JID('a@localhost'))]) == [0, 1])
+        self.assert_(index.getConnections(JID('a@localhost/r3')) == [])
+        self.assert_(index.getConnections(JID('c@localhost')) == [])
+        self.assert_(index['b@localhost'] == {'r1' : c3})
+
+    def testUnbind(self):
+        index = ResourceIndex()
+        c1, c2 = [TestResourceIndex.FakeConn(i) for i in range(2)]
+        index.bind(c1, 'a@localhost', 'r1')
+        index.bind(c2, 'a@localhost', 'r2')
+
+        index.unbind(c1)
+        self.assert_(index == {'a@localhost' : {'r2' : c2}})
+        # unbinding twice or without binding does nothing
+        index.unbind(c1)
+
+        # rebinding moves the connection
+        index.bind(c2, 'a@localhost', 'r3')
+        self.assert_(index == {'a@localhost' : {'r3' : c2}})
+
+        index.unbind(c2)
+        self.assert_(index == {})
+
+if __name__ == '__main__':
+    unittest.main()
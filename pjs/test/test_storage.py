@@ -0,0 +1,267 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from datetime import datetime, timedelta
+
+import pjs.db
+import pjs.jid
+import pjs.roster
+import pjs.storage
+import pjs.storage.sqlitestorage
+
+from pjs.db import closeAll
+from pjs.jid import JID
+from pjs.migrations import migrate
+from pjs.roster import Roster, Subscription, clearCache
+from pjs.storage import getStorage, setStorage, ConflictError
+from pjs.storage.memory import MemoryStorage
+from pjs.storage.sqlitestorage import SQLiteStorage
+
+class StorageTests:
+    """The tests every backend has to pass. Mixed into a TestCase that sets
+    self.storage.
+    """
+
+    def testAccounts(self):
+        """Creating and looking up accounts"""
+        s = self.storage
+        uid = s.addAccount('alice@localhost', 'secret')
+        self.assert_(s.getId('alice@localhost') == uid)
+        self.assert_(s.getJID(uid) == 'alice@localhost')
+        self.assert_(s.getPassword('alice@localhost') == 'secret')
+        self.assert_(s.isRegistered('alice@localhost'))
+
+        self.assert_(s.getId('bob@localhost') is None)
+        self.assert_(s.getJID(uid + 1000) is None)
+        self.assert_(s.getPassword('bob@localhost') is None)
+        self.assert_(not s.isRegistered('bob@localhost'))
+
+        self.assertRaises(ConflictError, s.addAccount, 'alice@localhost', 'x')
+        self.assert_(s.getPassword('alice@localhost') == 'secret')
+
+    def testRoster(self):
+        """Adding, changing and removing contacts"""
+        s = self.storage
+        uid = s.addAccount('alice@localhost', 'secret')
+        self.assert_(s.getRoster(uid) == (0, []))
+
+        cid, ver, new = s.updateContact(uid, 'bob@localhost', 'Bob', ['friends'])
+        self.assert_(new and ver == 1)
+        # contacts are known, but aren't users
+        self.assert_(s.getId('bob@localhost') == cid)
+        self.assert_(not s.isRegistered('bob@localhost'))
+
+        # the subscription stays if it's not given
+        s.setSubscription(uid, cid, Subscription.TO)
+        cid2, ver, new = s.updateContact(uid, 'bob@localhost', 'Bobby',
+                                         ['work', 'friends'])
+        self.assert_(cid2 == cid and ver == 3 and not new)
+        version, items = s.getRoster(uid)
+        self.assert_(version == 3 and len(items) == 1)
+        rcid, cjid, name, sub, groups = items[0]
+        self.assert_(rcid == cid and cjid == 'bob@localhost')
+        self.assert_(name == 'Bobby' and sub == Subscription.TO)
+        self.assert_(sorted(groups) == ['friends', 'work'])
+
+        self.assert_(s.setSubscription(uid, cid + 1000, Subscription.BOTH) is None)
+        self.assert_(s.removeContact(uid, 'carol@localhost') is None)
+        self.assert_(s.removeContact(uid, 'bob@localhost') == (cid, 4))
+        self.assert_(s.getRoster(uid) == (4, []))
+
+    def testRosterChanges(self):
+        """Only the last change of each contact is kept"""
+        s = self.storage
+        uid = s.addAccount('alice@localhost', 'secret')
+        bob = s.updateContact(uid, 'bob@localhost', '', [])[0]
+        s.updateContact(uid, 'carol@localhost', '', [])
+        s.setSubscription(uid, bob, Subscription.FROM)
+        self.assert_(s.getRosterChanges(uid, 0) == [(2, 'carol@localhost'),
+                                                    (3, 'bob@localhost')])
+        self.assert_(s.getRosterChanges(uid, 2) == [(3, 'bob@localhost')])
+        self.assert_(s.getRosterChanges(uid, 3) == [])
+
+    def testOffline(self):
+        """Offline messages come out oldest first and can be deleted"""
+        s = self.storage
+        alice = s.addAccount('alice@localhost', 'secret')
+        bob = s.addAccount('bob@localhost', 'secret')
+        start = datetime(2010, 1, 1)
+        s.storeOfflineMessages([(bob, alice, start + timedelta(seconds=i),
+                                 u'msg %d' % i) for i in [2, 0, 1]])
+        s.storeOfflineMessages([(alice, bob, start, u'other')])
+
+        page = s.getOfflineMessages(alice, 2)
+        self.assert_([m[3] for m in page] == [u'msg 0', u'msg 1'])
+        self.assert_(page[0][1] == 'bob@localhost')
+        self.assert_(page[0][2] == start)
+
+        s.deleteOfflineMessages([m[0] for m in page])
+        page = s.getOfflineMessages(alice, 2)
+        self.assert_([m[3] for m in page] == [u'msg 2'])
+        s.deleteOfflineMessages([m[0] for m in page])
+        s.deleteOfflineMessages([])
+        self.assert_(s.getOfflineMessages(alice, 2) == [])
+        self.assert_(len(s.getOfflineMessages(bob, 2)) == 1)
+
+class TestSQLiteStorage(unittest.TestCase, StorageTests):
+    """Testing the SQLite backend"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.oldName = pjs.db.dbname
+        fd, self.name = tempfile.mkstemp('.db')
+        os.close(fd)
+        migrate(self.name)
+        self.storage = SQLiteStorage()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        closeAll()
+        pjs.db.dbname = self.oldName
+        os.remove(self.name)
+
+    def testRosterSnapshot(self):
+        """A roster read doesn't see a change made while it's being read"""
+        s = self.storage
+        uid = s.addAccount('alice@localhost', 'secret')
+        s.updateContact(uid, 'bob@localhost', '', [])
+
+        class Cursor:
+            """Makes a change from another thread before the version is
+            read
+            """
+            def __init__(self, c):
+                self.c = c
+            def execute(self, sql, args=()):
+                if sql.startswith('SELECT version'):
+                    t = threading.Thread(target=s.updateContact,
+                                         args=(uid, 'carol@localhost', '', []))
+                    t.start()
+                    t.join()
+                return self.c.execute(sql, args)
+            def __getattr__(self, name):
+                return getattr(self.c, name)
+            def __iter__(self):
+                return iter(self.c)
+        class Connection:
+            def cursor(self):
+                return Cursor(pjs.db.DBautocommit().cursor())
+
+        old = pjs.storage.sqlitestorage.DBautocommit
+        pjs.storage.sqlitestorage.DBautocommit = Connection
+        try:
+            version, items = s.getRoster(uid)
+        finally:
+            pjs.storage.sqlitestorage.DBautocommit = old
+        self.assert_(version == 1 and len(items) == 1)
+        version, items = s.getRoster(uid)
+        self.assert_(version == 2 and len(items) == 2)
+
+class TestMemoryStorage(unittest.TestCase, StorageTests):
+    """Testing the in-memory backend"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.storage = MemoryStorage()
+
+class TestSetStorage(unittest.TestCase):
+    """Testing the models on another backend"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.storage = MemoryStorage()
+        self.old = setStorage(self.storage)
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        setStorage(self.old)
+
+    def testDefault(self):
+        """SQLite is the default"""
+        setStorage(None)
+        self.assert_(isinstance(getStorage(), SQLiteStorage))
+
+    def testClearsCaches(self):
+        """Switching backends forgets what was cached from the old one"""
+        uid = self.storage.addAccount('alice@localhost', 'secret')
+        self.assert_(JID('alice@localhost').getNumId() == uid)
+        Roster('alice@localhost').getVersion()
+        setStorage(MemoryStorage())
+        self.assert_(pjs.jid._ids.get('alice@localhost') is None)
+        self.assert_(pjs.roster._cache.get('alice@localhost') is None)
+        self.assert_(JID('alice@localhost').getNumId() == -1)
+
+    def testModels(self):
+        """JID and Roster use the backend in use"""
+        self.assert_(getStorage() is self.storage)
+        uid = self.storage.addAccount('alice@localhost', 'secret')
+        self.assert_(JID('alice@localhost').getNumId() == uid)
+        self.assert_(JID('alice@localhost').exists())
+        self.assert_(str(JID(uid, True)) == 'alice@localhost')
+
+        roster = Roster('alice@localhost')
+        cid = roster.updateContact('bob@localhost', ['friends'], 'Bob')
+        roster.setSubscription(cid, Subscription.BOTH)
+        self.assert_(JID('bob@localhost').getNumId() == cid)
+        self.assert_(not JID('bob@localhost').exists())
+        self.assert_(roster.getPresenceSubscribers() == ['bob@localhost'])
+
+        # from the backend, not the cache
+        clearCache()
+        roster = Roster('alice@localhost')
+        roster.loadRoster()
+        self.assert_(roster.version == 2)
+        self.assert_(roster.items[cid].groups == ['friends'])
+        self.assert_([c[1] for c in roster.getChanges('0')] == ['bob@localhost'])
+
+class TestRosterCacheVersions(unittest.TestCase):
+    """Testing that the roster cache doesn't keep stale data"""
+
+    class ChangingStorage(MemoryStorage):
+        """Changes the roster right after reading it, once"""
+        def getRoster(self, uid):
+            res = MemoryStorage.getRoster(self, uid)
+            change = getattr(self, 'change', None)
+            if change is not None:
+                self.change = None
+                change()
+            return res
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.storage = TestRosterCacheVersions.ChangingStorage()
+        self.old = setStorage(self.storage)
+        self.storage.addAccount('alice@localhost', 'secret')
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        setStorage(self.old)
+
+    def testChangeDuringLoad(self):
+        """A load that raced with a change isn't cached"""
+        roster = Roster('alice@localhost')
+        self.storage.change = lambda: \
+            Roster('alice@localhost').updateContact('bob@localhost',
+                                                   subscriptionId=Subscription.BOTH)
+        # the load saw the roster before the change
+        self.assert_(roster.getPresenceSubscribers() == [])
+        self.assert_(pjs.roster._cache.get('alice@localhost') is None)
+        self.assert_(roster.getPresenceSubscribers() == ['bob@localhost'])
+
+    def testMissedChange(self):
+        """A cached roster that missed a change is evicted"""
+        roster = Roster('alice@localhost')
+        self.assert_(roster.getVersion() == 0)
+        # a change made behind the cache's back
+        self.storage.updateContact(roster.uid, 'bob@localhost', '', [],
+                                   Subscription.BOTH)
+        roster.updateContact('carol@localhost', subscriptionId=Subscription.BOTH)
+        self.assert_(pjs.roster._cache.get('alice@localhost') is None)
+        self.assert_(sorted(roster.getPresenceSubscribers()) ==
+                     ['bob@localhost', 'carol@localhost'])
+        self.assert_(roster.getVersion() == 2)
+
+if __name__ == '__main__':
+    unittest.main()
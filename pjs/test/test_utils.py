@@ -1,4 +1,6 @@
-from pjs.utils import FunctionCall
+from pjs.utils import FunctionCall, RawStanza, StanzaTemplate, LRUCache, \
+                      tostring
+from pjs.elementtree.ElementTree import Element, SubElement
 import unittest
 
 class TestFunctionCall(unittest.TestCase):
@@ -52,5 +54,109 @@ class TestFunctionCall(unittest.TestCase):
         self.assert_(hash1 == hash2)
         
         
+class TestTostring(unittest.TestCase):
+    """Serializing Elements"""
+
+    def testNamespaces(self):
+        iq = Element('{jabber:client}iq', {'type' : 'result'})
+        query = SubElement(iq, '{jabber:iq:roster}query')
+        SubElement(query, '{jabber:iq:roster}item', {'jid' : 'a@b'})
+        self.assert_(tostring(iq) == \
+                     u"<iq type='result'><query xmlns='jabber:iq:roster'>" +\
+                     u"<item xmlns='jabber:iq:roster' jid='a@b'/></query></iq>")
+
+    def testEscaping(self):
+        msg = Element('{jabber:server}message', {'to' : "a'b&c"})
+        body = SubElement(msg, 'body')
+        body.text = u'<b>&amp; \xe9</b>'
+        body.tail = '>'
+        lang = SubElement(msg, 'x', {'{http://www.w3.org/XML/1998/namespace}lang' : 'en'})
+        self.assert_(tostring(msg) == \
+                     u"<message to='a&apos;b&amp;c'><body>&lt;b&gt;&amp;amp; " +\
+                     u"\xe9&lt;/b&gt;</body>&gt;<x xml:lang='en'/></message>")
+        self.assert_(tostring(msg, 'utf-8') == tostring(msg).encode('utf-8'))
+
+class TestStanzaTemplate(unittest.TestCase):
+    """Filled templates should serialize like the tree with the attribute set"""
+
+    def testFill(self):
+        pres = Element('{jabber:client}presence', {'from' : 'a@b/c'})
+        status = SubElement(pres, '{jabber:client}status')
+        status.text = u'<away> \xe9'
+        template = StanzaTemplate(pres, 'to')
+        self.assert_(pres.get('to') is None)
+
+        for to in ['d@e', u"f'g@h/\xe9"]:
+            copy = template.fill(to)
+            self.assert_(copy.get('to') == to and copy.get('from') == 'a@b/c')
+            pres.set('to', to)
+            self.assert_(copy.tostring() == tostring(pres))
+
+    def testReplace(self):
+        """The attribute can already be on the tree"""
+        pres = Element('{jabber:client}presence', {'from' : 'a@b/c', 'to' : 'x'})
+        template = StanzaTemplate(pres, 'from')
+        self.assert_(template.fill('y').tostring() == \
+                     tostring(Element('presence', {'from' : 'y', 'to' : 'x'})))
+        self.assert_(pres.get('from') == 'a@b/c')
+
+class TestRawStanza(unittest.TestCase):
+    """Attributes should be spliced into the original bytes"""
+
+    def testUnchanged(self):
+        raw = "<message to='a'><body>\xc3\xa9</body></message>"
+        rs = RawStanza(Element('message', {'to' : 'a'}), raw)
+        self.assert_(rs.tostring() == raw.decode('utf-8'))
+
+    def testSplice(self):
+        raw = """<message type="chat" to='a' id='x from="y"'><body/></message>"""
+        rs = RawStanza(Element('message', {'to' : 'a'}), raw,
+                       {'from' : u'b@localhost/r\xe9s', 'to' : "c'd"})
+        self.assert_(rs.get('to') == "c'd" and rs.get('type') is None)
+        self.assert_(rs.tostring() == \
+                     u"""<message type="chat" to='c&apos;d' id='x from="y"' """ +\
+                     u"""from='b@localhost/r\xe9s'><body/></message>""")
+
+    def testEmptyElement(self):
+        rs = RawStanza(Element('presence'), "<presence />")
+        rs.set('from', 'a')
+        self.assert_(rs.tostring() == u"<presence  from='a'/>")
+
+    def testSameEscaping(self):
+        """Attributes are escaped the same way as by tostring() and fill()"""
+        value = u"<a>&'\xe9"
+        tree = Element('presence', {'to' : value})
+        expected = tostring(tree)
+        self.assert_(expected == u"<presence to='&lt;a&gt;&amp;&apos;\xe9'/>")
+        self.assert_(StanzaTemplate(Element('presence'), 'to').fill(value).tostring() == expected)
+        rs = RawStanza(Element('presence'), "<presence/>", {'to' : value})
+        self.assert_(rs.tostring() == u"<presence to='&lt;a&gt;&amp;&apos;\xe9'/>")
+
+
+class TestLRUCache(unittest.TestCase):
+    """Testing the LRU cache"""
+
+    def testEvict(self):
+        """Least recently used entry is dropped"""
+        c = LRUCache(2)
+        c['a'] = 1
+        c['b'] = 2
+        self.assert_(c.get('a') == 1)
+        c['c'] = 3
+        self.assert_(len(c) == 2)
+        self.assert_('b' not in c)
+        self.assert_(c.get('a') == 1 and c.get('c') == 3)
+
+    def testCounters(self):
+        """Hits and misses are counted"""
+        c = LRUCache()
+        c['a'] = 1
+        c.get('a')
+        c.get('b')
+        c.pop('a')
+        self.assert_(c.hits == 1 and c.misses == 1)
+        self.assert_(c.hitRate() == 0.5)
+        self.assert_(c.get('a') is None)
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -8,7 +8,9 @@ import threading
 import time
 import pjs.conf.handlers as handlers
 
-from pjs.db import DB, sqlite
+from pjs.db import DB, closeAll, sqlite
+from pjs.jid import clearCaches
+from pjs.roster import clearCache as clearRosterCache
 
 from copy import deepcopy
 
@@ -287,6 +289,41 @@ class TestPresenceRoster(unittest.TestCase):
         if test.exc:
             self.fail(test.exc)
 
+    def testRosterVersioning(self):
+        """Roster get with a version (XEP-0237)"""
+        def run():
+            con = self.cl.connect(use_srv=False)
+            if con:
+                auth = self.cl.auth(self.jid.getNode(), self.password, self.jid.getResource(), sasl=1)
+                if auth:
+                    # nothing changed since version 0
+                    iq = xmpp.Iq('get', xmpp.NS_ROSTER)
+                    iq.getTag('query').setAttr('ver', '0')
+                    res = self.cl.SendAndWaitForResponse(iq, WAITLEN)
+                    self.assert_(res and res.getType() == 'result')
+                    self.assert_(res.getTag('query') is None)
+
+                    # unknown version gets the whole roster
+                    iq = xmpp.Iq('get', xmpp.NS_ROSTER)
+                    iq.getTag('query').setAttr('ver', 'unknown')
+                    res = self.cl.SendAndWaitForResponse(iq, WAITLEN)
+                    self.assert_(res and res.getType() == 'result')
+                    query = res.getTag('query')
+                    self.assert_(query.getAttr('ver') == '0')
+                    self.assert_(query.getTag('item').getAttr('jid') == self.jid2.getStripped())
+                else:
+                    self.fail("Authentication failed")
+            else:
+                self.fail("Connection failed")
+
+        test = TestThread(run)
+        test.start()
+        test.join(WAITLEN)
+        if test.isAlive():
+            self.fail("Test took too long to execute")
+        if test.exc:
+            self.fail(test.exc)
+
     # FIXME: This test doesn't work yet, because xmpppy doesn't seem to add the
     # announced resource to its roster list even though it receives the presence
     def testPresence(self):
@@ -479,8 +516,13 @@ class TestSubscriptions(unittest.TestCase):
 
 def deletePresenceDB():
     import os
+    closeAll()
+    clearCaches()
+    clearRosterCache()
     os.remove(TEST_PRESDB_NAME)
 def initPresenceDB():
+    clearCaches()
+    clearRosterCache()
     con = DB(TEST_PRESDB_NAME)
     c = con.cursor()
     try:
@@ -503,6 +545,14 @@ def initPresenceDB():
                     (groupid INTEGER REFERENCES rostergroup NOT NULL,\
                      contactid INTEGER REFERENCES jids NOT NULL,\
                      PRIMARY KEY (groupid, contactid))")
+        c.execute("CREATE TABLE rosterversions\
+                    (userid INTEGER PRIMARY KEY REFERENCES jids NOT NULL,\
+                     version INTEGER NOT NULL DEFAULT 0)")
+        c.execute("CREATE TABLE rosterchanges\
+                    (userid INTEGER REFERENCES jids NOT NULL,\
+                     contactid INTEGER REFERENCES jids NOT NULL,\
+                     version INTEGER NOT NULL,\
+                     PRIMARY KEY (userid, contactid))")
         c.execute("INSERT INTO jids (jid, password) VALUES ('bob@localhost', 'test')")
         c.execute("INSERT INTO jids (jid, password) VALUES ('alice@localhost', 'test')")
         c.execute("INSERT INTO roster (userid, contactid, subscription) VALUES (1, 2, 8)")
@@ -515,8 +565,13 @@ def initPresenceDB():
     
 def deleteNoRosterItemsDB():
     import os
+    closeAll()
+    clearCaches()
+    clearRosterCache()
     os.remove(TEST_NOROSTER_NAME)
 def initNoRosterItemsDB():
+    clearCaches()
+    clearRosterCache()
     con = DB(TEST_NOROSTER_NAME)
     c = con.cursor()
     try:
@@ -539,6 +594,14 @@ def initNoRosterItemsDB():
                     (groupid INTEGER REFERENCES rostergroup NOT NULL,\
                      contactid INTEGER REFERENCES jids NOT NULL,\
                      PRIMARY KEY (groupid, contactid))")
+        c.execute("CREATE TABLE rosterversions\
+                    (userid INTEGER PRIMARY KEY REFERENCES jids NOT NULL,\
+                     version INTEGER NOT NULL DEFAULT 0)")
+        c.execute("CREATE TABLE rosterchanges\
+                    (userid INTEGER REFERENCES jids NOT NULL,\
+                     contactid INTEGER REFERENCES jids NOT NULL,\
+                     version INTEGER NOT NULL,\
+                     PRIMARY KEY (userid, contactid))")
         c.execute("INSERT INTO jids (jid, password) VALUES ('bob@localhost', 'test')")
         c.execute("INSERT INTO jids (jid, password) VALUES ('alice@localhost', 'test')")
         con.commit()
@@ -34,7 +34,7 @@ See the end of the module code for a brief, annotated usage example.
 """
 
 __all__ = ['makeRequests', 'NoResultsPending', 'NoWorkersAvailable',
-  'ThreadPool', 'WorkRequest', 'WorkerThread']
+  'ThreadPool', 'WorkRequest', 'WorkFuture', 'WorkerThread']
 
 __author__ = "Christopher Arndt"
 __version__ = "1.1"
@@ -64,7 +64,7 @@ class WorkerThread(threading.Thread):
         requestsQueue and resultQueue are instances of Queue.Queue passed
         by the ThreadPool class when it creates a new worker thread.
         notifyFunc is executed when done. see
-        connection.LocalTriggerConnection.__doc__
+        pjs.async.trigger.__doc__
         """
         threading.Thread.__init__(self, **kwds)
         self.setDaemon(1)
@@ -96,7 +96,7 @@ class WorkerThread(threading.Thread):
             self.resultQueue.put((request, retVal))
 
             # Wake up asyncore
-            # see connection.LocalTriggerConnection.__doc__
+            # see pjs.async.trigger.__doc__
             if self.notifyFunc:
                 self.notifyFunc()
 
@@ -141,6 +141,45 @@ class WorkRequest:
         self.kwds = kwds or {}
 
 
+class WorkFuture:
+    """The pending result of a WorkRequest submitted with ThreadPool.submit().
+
+    Functions added with addCallback() are called with the future as their
+    only argument exactly once, when the result is picked up by
+    ThreadPool.poll(). That is, they run in the thread that polls the pool,
+    which is the main thread for the server pools. If the callable raised
+    an exception, result is the exception object.
+    """
+
+    def __init__(self, request=None):
+        self.request = request
+        self.done = False
+        self.result = None
+        self._callbacks = []
+
+    def addCallback(self, func):
+        """Call func(future) when the result arrives. If it already has,
+        func is called right away.
+        """
+        if self.done:
+            func(self)
+        else:
+            self._callbacks.append(func)
+
+    def _complete(self, result):
+        """Record the result and fire the callbacks. Does nothing if the
+        future has already completed.
+        """
+        if self.done:
+            return
+        self.done = True
+        self.result = result
+        callbacks = self._callbacks
+        self._callbacks = []
+        for func in callbacks:
+            func(self)
+
+
 class ThreadPool:
     """A thread pool, distributing work requests and collecting results.
 
@@ -155,7 +194,7 @@ class ThreadPool:
         thread pool blocks when queue is full and it tries to put more
         work requests in it.
         notifyFunc is executed by each WorkThread when it's done. see
-        connection.LocalTriggerConnection.__doc__
+        pjs.async.trigger.__doc__
         """
 
         self.notifyFunc = notifyFunc
@@ -185,6 +224,22 @@ class ThreadPool:
         self.requestsQueue.put(request)
         self.workRequests[request.requestID] = request
 
+    def submit(self, callable, args=None, kwds=None, callback=None):
+        """Put a request to execute callable into the work queue and return
+        a WorkFuture for its result. callback is the usual WorkRequest
+        callback; it's called before the future's callbacks.
+        """
+
+        future = WorkFuture()
+        def done(request, result):
+            if callback:
+                callback(request, result)
+            future._complete(result)
+        request = WorkRequest(callable, args, kwds, callback=done)
+        future.request = request
+        self.putRequest(request)
+        return future
+
     def poll(self, block=False):
         """Process any new results in the queue."""
         while 1:
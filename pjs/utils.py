@@ -1,6 +1,7 @@
 """Useful functions that can (and should) be used by handlers"""
 
 from threading import RLock
+from collections import OrderedDict
 from random import random
 
 try:
@@ -14,6 +15,13 @@ import time, os, re, sys
 standardNSre = re.compile(r'^{jabber:(client|server)}', re.UNICODE)
 customNSre = re.compile(r'^{(.*?)}(.*)')
 
+# matches an XML tag up to and including its closing '>'. It's aware of
+# quoted attribute values, which can contain '>'.
+tagEndRe = re.compile(r'''(?:[^'">]|'[^']*'|"[^"]*")*>''')
+# the name at the start of a tag and one attribute in it
+tagNameRe = re.compile(r'<[^\s/>]+')
+attributeRe = re.compile(r'''\s+([^\s=/>]+)\s*=\s*('[^']*'|"[^"]*")''')
+
 # This is used in pjs.async.core.
 class FunctionCall:
     """Creates a simple object that represents the information required for a
@@ -47,36 +55,202 @@ def generateId():
     """Generates a unique id for anything"""
     return sha1(str((random(), time.gmtime(), os.getpid()))).hexdigest()
 
-def tostring(tree):
+# {ns}tag => (u"<tag xmlns='ns'", u"</tag>"). See _tagStrings().
+_tagCache = {}
+# the cache is cleared when it gets this big (ie. from made up tag names)
+maxTagCache = 1024
+
+xmlNS = '{http://www.w3.org/XML/1998/namespace}'
+
+def tostring(tree, encoding=None):
     """Converts ET's Element into an XML string. It assumes the default
     namespace is jabber:client or jabber:server and strips those out.
     For other elements it attaches the xmlns attribute to their ns-clear tags.
     This is a workaround for ET's broken tostring(), which returns crazy stuff
     like:
     <ns0:a xmlns:ns0="asdf"><ns0:b>asdfasdf</ns0:b></ns0:a>
+
+    Text and attribute values are escaped. Returns unicode, or a string in
+    encoding (ie. 'utf-8' for writing to a socket) if it's given.
     """
-    def processTree(tree):
-        res, tag = decurl(tree.tag)
-        res = u'<' + res
-        for k,v in tree.items():
-            res += " %s='%s'" % (k,v)
-        if len(tree) > 0 or tree.text:
-            res += '>'
-            if tree.text:
-                res += tree.text
-            for i in tree:
-                res += processTree(i)
-                if i.tail:
-                    res += i.tail
-            res += '</%s>' % tag
-        else:
-            res += '/>'
+    out = []
+    _serialize(tree, out.append)
+    res = u''.join(out)
+    if encoding:
+        return res.encode(encoding)
+    return res
+
+def _serialize(tree, write, attrs=None):
+    """Writes out tree. attrs are attributes to set on the top element in
+    the output, but not in the tree.
+    """
+    start, end = _tagStrings(tree.tag)
+    write(start)
+    items = tree.items()
+    if attrs:
+        items = dict(items)
+        items.update(attrs)
+        items = items.items()
+    for k, v in items:
+        if k[0] == '{' and k.startswith(xmlNS):
+            k = 'xml:' + k[len(xmlNS):]
+        write(u" %s='%s'" % (k, _escapeAttr(v)))
+    text = tree.text
+    if len(tree) or text:
+        write(u'>')
+        if text:
+            write(_escapeText(text))
+        for i in tree:
+            _serialize(i, write)
+            if i.tail:
+                write(_escapeText(i.tail))
+        write(end)
+    else:
+        write(u'/>')
 
-        return res
+def _tagStrings(tag):
+    """Returns the start of the opening tag and the closing tag for an
+    element's {ns}tag name.
+    """
+    try:
+        return _tagCache[tag]
+    except KeyError:
+        if len(_tagCache) >= maxTagCache:
+            _tagCache.clear()
+        res, name = decurl(tag)
+        strings = _tagCache[tag] = (u'<' + res, u'</%s>' % name)
+        return strings
 
-    res = u''
-    res += processTree(tree)
-    return res
+def _escapeText(text):
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+def _escapeAttr(value):
+    """Escapes value for use in a single-quoted attribute. Used for every
+    attribute written out, so all stanzas escape them the same way.
+    """
+    if not isinstance(value, basestring):
+        value = unicode(value)
+    value = _escapeText(value)
+    if "'" in value:
+        value = value.replace("'", '&apos;')
+    return value
+
+class SerializedStanza:
+    """A stanza that is sent as XML that's already (mostly) serialized,
+    instead of being serialized from its tree. Reads go to the tree, with
+    the attributes that were changed on the stanza taking precedence, so it
+    can be used where routing code expects an Element.
+    """
+    def __init__(self, tree, attrs=None):
+        """tree -- the Element the stanza was made from.
+        attrs -- {name => value} of attributes to set on the stanza.
+        """
+        self.tree = tree
+        self.tag = tree.tag
+        self.attrs = attrs or {}
+
+    def get(self, key, default=None):
+        if key in self.attrs:
+            return self.attrs[key]
+        return self.tree.get(key, default)
+
+    def tostring(self):
+        """Returns the stanza as unicode"""
+        raise NotImplementedError
+
+class RawStanza(SerializedStanza):
+    """A stanza that is sent as the bytes it was received as. Only the
+    attributes that were set on it are spliced into the original start tag.
+
+    Handlers create these from Message.raw (see IncrStreamParser) when they
+    pass a stanza through without changing it.
+    """
+    def __init__(self, tree, raw, attrs=None):
+        """tree -- the Element that was parsed from raw.
+        raw -- the stanza's bytes as received (UTF-8).
+        attrs -- {name => value} of attributes to set on the stanza.
+        """
+        SerializedStanza.__init__(self, tree, attrs)
+        self.raw = raw
+
+    def set(self, key, value):
+        self.attrs[key] = value
+
+    def tostring(self):
+        """Returns the stanza as unicode, with the attributes spliced in"""
+        raw = self.raw
+        if self.attrs:
+            # position of the start tag's '>' or '/>'
+            end = tagEndRe.match(raw).end() - 1
+            if raw[end - 1] == '/':
+                end -= 1
+            head = raw[:end]
+
+            # the existing attributes as name => span of the value
+            spans = {}
+            pos = tagNameRe.match(head).end()
+            m = attributeRe.match(head, pos)
+            while m:
+                spans[m.group(1)] = m.span(2)
+                m = attributeRe.match(head, m.end())
+
+            added = ''
+            replaced = []
+            for k, v in self.attrs.items():
+                v = _escapeAttr(v)
+                if isinstance(v, unicode):
+                    v = v.encode('utf-8')
+                v = "'%s'" % v
+                if k in spans:
+                    replaced.append((spans[k], v))
+                else:
+                    added += " %s=%s" % (k, v)
+
+            # splice from the back so the spans stay valid
+            replaced.sort(reverse=True)
+            for (start, stop), v in replaced:
+                head = head[:start] + v + head[stop:]
+            raw = head + added + raw[end:]
+
+        return raw.decode('utf-8')
+
+class StanzaTemplate:
+    """Serializes a stanza once for sending it to many recipients that each
+    get a different value of one attribute (usually 'to'). The copies made
+    by fill() are put together from the serialized halves, so the tree
+    isn't copied and serialized again for every recipient.
+    """
+    # can't appear in XML, so it can't be confused with the stanza's content
+    placeholder = u'\x00'
+
+    def __init__(self, tree, attr='to'):
+        self.tree = tree
+        self.attr = attr
+        out = []
+        _serialize(tree, out.append, {attr : self.placeholder})
+        self.head, self.tail = u''.join(out).split(self.placeholder, 1)
+
+    def fill(self, value):
+        """Returns a copy of the stanza with the attribute set to value"""
+        return FilledStanza(self, value)
+
+class FilledStanza(SerializedStanza):
+    """A stanza made by StanzaTemplate.fill()"""
+    def __init__(self, template, value):
+        SerializedStanza.__init__(self, template.tree, {template.attr : value})
+        self.template = template
+        self.value = value
+
+    def tostring(self):
+        """Returns the stanza as unicode"""
+        t = self.template
+        return t.head + _escapeAttr(self.value) + t.tail
 
 def decurl(tagName):
     """Returns the "tag xmls='ns'" and 'tag' tuple. This is for parsing out
@@ -122,9 +296,14 @@ class PrioritizedDict(dict):
     Example: d = {'a' : {'name' : 'A'}, 'b' : {'name' : 'B', 'priority' : 1}}
     When iterated over, the 'b' pair with priority 1 will come first, since the
     default priority is 0.
+
+    version is incremented every time the order is recomputed, so that users
+    can cache things derived from the dict. Call reprioritize() after
+    modifying a value in place.
     """
     def __init__(self, d=None):
         self.priolist = []
+        self.version = 0
         if d is not None:
             dict.__init__(self, d)
             self.reprioritize()
@@ -133,6 +312,7 @@ class PrioritizedDict(dict):
     def reprioritize(self):
         self.priolist = dict.keys(self)
         self.priolist.sort(cmp=self.compare)
+        self.version += 1
     def compare(self, x, y):
         return dict.get(self, y).get('priority', 0) - dict.get(self, x).get('priority', 0)
     def __iter__(self):
@@ -216,4 +396,76 @@ class SynchronizedDict(dict):
         try:
             return dict.__contains__(self, item)
         finally:
-            self.lock.release()
\ No newline at end of file
+            self.lock.release()
+
+
+class LRUCache:
+    """A mapping that holds at most maxSize entries. When it's full, adding
+    an entry drops the least recently used one. It can be shared between
+    threads. hits and misses count the lookups with get().
+    """
+    def __init__(self, maxSize=1024):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = RLock()
+
+    def get(self, key, default=None):
+        """Returns the value for key and marks it as recently used, or
+        default if key isn't cached.
+        """
+        self._lock.acquire()
+        try:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+        finally:
+            self._lock.release()
+
+    def __setitem__(self, key, value):
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self.maxSize:
+                self._data.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def pop(self, key, default=None):
+        """Removes key and returns its value, or default if key isn't cached.
+        Doesn't count as a lookup.
+        """
+        self._lock.acquire()
+        try:
+            return self._data.pop(key, default)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def hitRate(self):
+        """Returns the fraction of lookups that were hits (0.0 if there were
+        none).
+        """
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return float(self.hits) / total
@@ -0,0 +1,70 @@
+"""Compares the two ways of fanning out a user's presence to their
+contacts on login: a copy of the tree for every contact, serialized one
+by one (as C2SPresenceHandler used to do), and a StanzaTemplate filled in
+for every contact.
+
+Reports the time to build the routing data and write it out, and how many
+objects are held in the routing data until the routers get to it.
+
+Run from the top directory:
+    PYTHONPATH=. python prototypes/benchmarks/broadcast.py
+"""
+
+import gc
+import time
+
+from copy import deepcopy
+from pjs.elementtree.ElementTree import Element, SubElement
+from pjs.handlers.write import prepareDataForSending
+from pjs.utils import StanzaTemplate
+
+def makePresence():
+    pres = Element('{jabber:client}presence', {'from' : 'alice@localhost/home'})
+    SubElement(pres, '{jabber:client}show').text = u'away'
+    SubElement(pres, '{jabber:client}status').text = u'Out for lunch'
+    SubElement(pres, '{jabber:client}priority').text = u'5'
+    SubElement(pres, '{http://jabber.org/protocol/caps}c', {
+                        'hash' : 'sha-1',
+                        'node' : 'http://example.com/client',
+                        'ver' : 'QgayPKawpkPSDYmwT/WM94uAlu0='
+                        })
+    return pres
+
+def copies(pres, cjids):
+    out = []
+    for cjid in cjids:
+        pres.set('to', cjid)
+        out.append({'to' : cjid, 'data' : deepcopy(pres)})
+    return out
+
+def template(pres, cjids):
+    out = []
+    t = StanzaTemplate(pres, 'to')
+    for cjid in cjids:
+        out.append({'to' : cjid, 'data' : t.fill(cjid)})
+    return out
+
+def bench(func, size, rounds):
+    cjids = ['contact%d@example.com' % i for i in xrange(size)]
+
+    gc.collect()
+    before = len(gc.get_objects())
+    routes = func(makePresence(), cjids)
+    held = len(gc.get_objects()) - before
+    del routes
+
+    start = time.time()
+    for i in xrange(rounds):
+        for d in func(makePresence(), cjids):
+            prepareDataForSending(d['data'])
+    return (time.time() - start) / rounds, held
+
+if __name__ == '__main__':
+    for size in [50, 500, 2000]:
+        rounds = max(10000 / size, 3)
+        oldTime, oldHeld = bench(copies, size, rounds)
+        newTime, newHeld = bench(template, size, rounds)
+        print "%5d contacts: copies %8.3f ms %7d objects  " \
+              "template %8.3f ms %7d objects  (%.1fx faster)" % (
+                size, oldTime * 1000, oldHeld, newTime * 1000, newHeld,
+                oldTime / newTime)
@@ -0,0 +1,79 @@
+"""Compares opening a connection for every query (as pjs.db.DB() used to
+do) with the per-thread pooled connections, on the JID lookup that most
+handlers do (JID.getNumId()) and on the offline message insert.
+
+Reports queries per second for each.
+
+Run from the top directory:
+    PYTHONPATH=. python prototypes/benchmarks/db.py
+"""
+
+import os
+import time
+import tempfile
+import sqlite3 as sqlite
+import pjs.db
+
+from datetime import datetime
+from pjs.db import DB, closeAll
+
+def oldDB(name, isolationLevel="DEFERRED"):
+    """The old pjs.db.DB()"""
+    db = sqlite.connect(name, timeout=10.0, isolation_level=isolationLevel, detect_types=sqlite.PARSE_DECLTYPES)
+    db.row_factory = sqlite.Row
+    return db
+
+def setUp(name, size):
+    con = oldDB(name)
+    con.execute("CREATE TABLE jids (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,\
+                                    jid TEXT NOT NULL,\
+                                    password TEXT NOT NULL,\
+                                    UNIQUE(jid))")
+    con.execute("CREATE TABLE offline (fromid INTEGER REFERENCES jids NOT NULL,\
+                                       toid INTEGER REFERENCES jids NOT NULL,\
+                                       time TIMESTAMP,\
+                                       content TEXT)")
+    con.executemany("INSERT INTO jids (jid, password) VALUES (?, 'test')",
+                    [('user%d@localhost' % i,) for i in xrange(size)])
+    con.commit()
+    con.close()
+
+def lookup(connect, size, rounds):
+    start = time.time()
+    for i in xrange(rounds):
+        c = connect(None).cursor()
+        c.execute("SELECT id FROM jids WHERE jid = ?",
+                  ('user%d@localhost' % (i % size),))
+        c.fetchone()
+    return rounds / (time.time() - start)
+
+def insert(connect, size, rounds):
+    start = time.time()
+    for i in xrange(rounds):
+        con = connect("DEFERRED")
+        c = con.cursor()
+        c.execute("INSERT INTO offline (fromid, toid, time, content) \
+                   VALUES (?, ?, ?, ?)",
+                  (i % size, (i + 1) % size, datetime.now(), u'Hello'))
+        con.commit()
+        c.close()
+    return rounds / (time.time() - start)
+
+if __name__ == '__main__':
+    size = 1000
+    fd, name = tempfile.mkstemp('.db')
+    os.close(fd)
+    try:
+        setUp(name, size)
+        pjs.db.dbname = name
+        old = lambda level: oldDB(name, level)
+        new = lambda level: DB(isolationLevel=level)
+        for label, func, rounds in [('lookup', lookup, 20000),
+                                    ('insert', insert, 2000)]:
+            before = func(old, size, rounds)
+            after = func(new, size, rounds)
+            print "%s: per-call connection %8.0f q/s  pooled %8.0f q/s  (%.1fx)" % (
+                    label, before, after, after / before)
+    finally:
+        closeAll()
+        os.remove(name)
@@ -0,0 +1,102 @@
+"""Shows the query plans and timings of the offline message and roster
+group queries before and after the indexes of schema version 3 (see
+pjs.migrations), on a DB with 100k users, 1M offline messages and 10
+contacts in a group for every user.
+
+Building the DB takes a while.
+
+Run from the top directory:
+    PYTHONPATH=. python prototypes/benchmarks/indexes.py
+"""
+
+import os
+import random
+import time
+import tempfile
+import pjs.db
+
+from datetime import datetime, timedelta
+from pjs.db import DB, closeAll
+from pjs.migrations import migrate
+
+USERS = 100000
+OFFLINE = 1000000
+CONTACTS = 10
+
+QUERIES = [
+    ('offline select',
+     "SELECT fromid, time, content FROM offline WHERE toid = ? ORDER BY time ASC",
+     lambda: (random.randint(1, USERS),)),
+    ('offline delete',
+     "DELETE FROM offline WHERE toid = ?",
+     lambda: (random.randint(1, USERS),)),
+    ('remove contact from groups',
+     "DELETE FROM rostergroupitems\
+      WHERE rostergroupitems.groupid IN (\
+          SELECT rgs.groupid FROM rostergroups AS rgs\
+          JOIN rostergroupitems AS rgi ON rgi.groupid = rgs.groupid\
+          WHERE rgs.userid = ?\
+       ) AND rostergroupitems.contactid = ?",
+     lambda: (random.randint(1, USERS), random.randint(1, USERS))),
+    ('groups of user',
+     "SELECT rgi.contactid, rgs.name\
+      FROM rostergroups AS rgs\
+          JOIN rostergroupitems AS rgi ON rgi.groupid = rgs.groupid\
+      WHERE rgs.userid = ?",
+     lambda: (random.randint(1, USERS),)),
+    ]
+
+def populate():
+    con = DB()
+    start = datetime.now()
+    con.executemany("INSERT INTO jids (jid, password) VALUES (?, 'test')",
+                    (('user%d@localhost' % i,) for i in xrange(USERS)))
+    con.executemany("INSERT INTO offline (fromid, toid, time, content)\
+                     VALUES (?, ?, ?, 'hello')",
+                    ((random.randint(1, USERS), random.randint(1, USERS),
+                      start + timedelta(seconds=i)) for i in xrange(OFFLINE)))
+    con.executemany("INSERT INTO rostergroups (userid, name)\
+                     VALUES (?, 'Friends')",
+                    ((i,) for i in xrange(1, USERS + 1)))
+    con.executemany("INSERT INTO rostergroupitems (groupid, contactid)\
+                     VALUES (?, ?)",
+                    ((i, (i + j) % USERS + 1) for i in xrange(1, USERS + 1)
+                                              for j in xrange(CONTACTS)))
+    con.commit()
+
+def bench(rounds=200):
+    con = DB()
+    for label, sql, args in QUERIES:
+        plan = con.execute("EXPLAIN QUERY PLAN " + sql, args()).fetchall()
+        start = time.time()
+        for i in xrange(rounds):
+            con.execute(sql, args()).fetchall()
+        # don't actually delete anything
+        con.rollback()
+        elapsed = (time.time() - start) / rounds
+        print "  %-28s %9.3f ms" % (label, elapsed * 1000)
+        for row in plan:
+            print "      %s" % row[-1]
+
+if __name__ == '__main__':
+    fd, name = tempfile.mkstemp('.db')
+    os.close(fd)
+    try:
+        migrate(name, 2)
+        start = time.time()
+        populate()
+        print "populated in %.1f s" % (time.time() - start)
+
+        print "schema version 2 (no indexes):"
+        bench(rounds=5)
+
+        start = time.time()
+        migrate()
+        print "upgraded to version 3 in %.1f s" % (time.time() - start)
+        # reconnect so that no statements planned without the indexes are
+        # reused
+        closeAll()
+        bench()
+    finally:
+        closeAll()
+        os.remove(name)
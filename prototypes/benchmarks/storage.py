@@ -0,0 +1,86 @@
+"""Compares the SQLite and in-memory storage backends (see pjs.storage) on
+the operations the handlers do: password lookups at login, roster loads
+and changes, and storing and paging through offline messages.
+
+Run from the top directory:
+    PYTHONPATH=. python prototypes/benchmarks/storage.py
+"""
+
+import os
+import time
+import tempfile
+import pjs.db
+
+from datetime import datetime
+from pjs.db import closeAll
+from pjs.migrations import migrate
+from pjs.roster import Subscription
+from pjs.storage.memory import MemoryStorage
+from pjs.storage.sqlitestorage import SQLiteStorage
+
+USERS = 1000
+CONTACTS = 20
+MESSAGES = 5000
+
+def timed(func, count):
+    start = time.time()
+    func()
+    return (time.time() - start) / count * 1000000
+
+def bench(s):
+    results = []
+    uids = []
+    def accounts():
+        for i in xrange(USERS):
+            uids.append(s.addAccount('user%d@localhost' % i, 'test'))
+    results.append(('create account', timed(accounts, USERS)))
+
+    def passwords():
+        for i in xrange(USERS):
+            s.getPassword('user%d@localhost' % i)
+    results.append(('password lookup', timed(passwords, USERS)))
+
+    users = uids[:USERS / 10]
+    def contacts():
+        for uid in users:
+            for j in xrange(CONTACTS):
+                cid = s.updateContact(uid, 'contact%d@example.com' % j,
+                                      'Contact', ['friends'])[0]
+                s.setSubscription(uid, cid, Subscription.BOTH)
+    results.append(('add contact', timed(contacts, len(users) * CONTACTS)))
+
+    def rosters():
+        for uid in users:
+            s.getRoster(uid)
+    results.append(('load roster', timed(rosters, len(users))))
+
+    fromid, toid = uids[0], uids[1]
+    def store():
+        for i in xrange(0, MESSAGES, 100):
+            s.storeOfflineMessages([(fromid, toid, datetime.now(), u'hello')
+                                    for j in xrange(100)])
+    results.append(('store offline (100/batch)', timed(store, MESSAGES)))
+
+    def deliver():
+        while True:
+            page = s.getOfflineMessages(toid, 100)
+            if not page:
+                break
+            s.deleteOfflineMessages([m[0] for m in page])
+    results.append(('deliver offline (100/page)', timed(deliver, MESSAGES)))
+    return results
+
+if __name__ == '__main__':
+    fd, name = tempfile.mkstemp('.db')
+    os.close(fd)
+    try:
+        migrate(name)
+        sqliteResults = bench(SQLiteStorage())
+    finally:
+        closeAll()
+        os.remove(name)
+    memoryResults = bench(MemoryStorage())
+
+    print "%-28s %12s %12s" % ('per operation', 'sqlite', 'memory')
+    for (label, a), (label, b) in zip(sqliteResults, memoryResults):
+        print "%-28s %9.1f us %9.1f us" % (label, a, b)
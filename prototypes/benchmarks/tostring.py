@@ -0,0 +1,69 @@
+"""Compares pjs.utils.tostring() with the concatenating serializer it
+replaced, on roster-sized trees.
+
+Run from the top directory:
+    PYTHONPATH=. python prototypes/benchmarks/tostring.py
+"""
+
+import time
+
+from pjs.elementtree.ElementTree import Element, SubElement
+from pjs.utils import tostring, decurl
+
+def oldTostring(tree):
+    """The old pjs.utils.tostring()"""
+    def processTree(tree):
+        res, tag = decurl(tree.tag)
+        res = u'<' + res
+        for k,v in tree.items():
+            res += " %s='%s'" % (k,v)
+        if len(tree) > 0 or tree.text:
+            res += '>'
+            if tree.text:
+                res += tree.text
+            for i in tree:
+                res += processTree(i)
+                if i.tail:
+                    res += i.tail
+            res += '</%s>' % tag
+        else:
+            res += '/>'
+
+        return res
+
+    res = u''
+    res += processTree(tree)
+    return res
+
+def makeRoster(size):
+    iq = Element('{jabber:client}iq', {
+                                       'type' : 'result',
+                                       'id' : 'roster_1',
+                                       'to' : 'alice@localhost/home'
+                                       })
+    query = SubElement(iq, '{jabber:iq:roster}query')
+    for i in xrange(size):
+        item = SubElement(query, '{jabber:iq:roster}item', {
+                                   'jid' : 'contact%d@example.com' % i,
+                                   'name' : u'Contact %d' % i,
+                                   'subscription' : 'both'
+                                   })
+        group = SubElement(item, '{jabber:iq:roster}group')
+        group.text = u'Friends'
+    return iq
+
+def bench(func, tree, rounds):
+    start = time.time()
+    for i in xrange(rounds):
+        func(tree)
+    return (time.time() - start) / rounds
+
+if __name__ == '__main__':
+    for size in [10, 100, 500, 2000]:
+        tree = makeRoster(size)
+        rounds = max(20000 / size, 5)
+        old = bench(oldTostring, tree, rounds)
+        new = bench(tostring, tree, rounds)
+        newBytes = bench(lambda t: tostring(t, 'utf-8'), tree, rounds)
+        print "%5d items: old %8.3f ms  new %8.3f ms  new utf-8 %8.3f ms  (%.1fx)" % (
+                size, old * 1000, new * 1000, newBytes * 1000, old / new)